@@ -0,0 +1,106 @@
+"""
+compares the throughput of a single stream with a segmented (range requests) download against a
+local stand-in server that delays every request (latency) and throttles every connection
+(bandwidth), like a cdn capping the speed per connection. run from the folder holding the repo:
+    python -m comfy_runner.benchmarks.download_throughput [size_mb] [segments] [latency_ms] [connection_mb_per_sec]
+"""
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from ..utils.download_engine import DownloadEngine, TransferControl
+
+SEND_CHUNK_SIZE = 64 * 1024
+
+
+def make_handler(data, latency, connection_bandwidth):
+    class StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(latency)
+            start, end, status = 0, len(data) - 1, 200
+            match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+            if match:
+                start = int(match.group(1))
+                end = min(int(match.group(2)) if match.group(2) else end, end)
+                status = 206
+
+            self.send_response(status)
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("ETag", '"stand-in"')
+            self.send_header("Accept-Ranges", "bytes")
+            if status == 206:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+            self.end_headers()
+
+            sent, started = 0, time.monotonic()
+            for offset in range(start, end + 1, SEND_CHUNK_SIZE):
+                try:
+                    self.wfile.write(data[offset : min(offset + SEND_CHUNK_SIZE, end + 1)])
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                sent += min(SEND_CHUNK_SIZE, end + 1 - offset)
+                # sleeping off what was sent ahead of the connection bandwidth
+                ahead = sent / connection_bandwidth - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    return StandInHandler
+
+
+def timed_download(url, file_path, segments):
+    engine = DownloadEngine(
+        segments=segments,
+        min_segment_size=1,
+        # own limits, the process wide ones would cap the connections
+        transfer_control=TransferControl(host_connections=segments + 1, bandwidth_limit=0),
+    )
+    start = time.perf_counter()
+    _, sha256 = engine.download(url, file_path, show_progress=False, compute_sha256=True)
+    return time.perf_counter() - start, sha256
+
+
+def main(size_mb=64, segments=8, latency_ms=50, connection_mb_per_sec=8):
+    size, segments = int(size_mb * 1024 * 1024), int(segments)
+    data = os.urandom(size)
+    expected = hashlib.sha256(data).hexdigest()
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), make_handler(data, latency_ms / 1000, connection_mb_per_sec * 1024 * 1024)
+    )
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/model.safetensors"
+    print(
+        f"{size_mb:g} MB file, {latency_ms:g} ms latency, {connection_mb_per_sec:g} MB/s per connection"
+    )
+
+    tmp_dir = tempfile.mkdtemp()
+    failures = 0
+    try:
+        results = {}
+        for count in (1, segments):
+            elapsed, sha256 = timed_download(url, os.path.join(tmp_dir, f"model_{count}.safetensors"), count)
+            results[count] = elapsed
+            if sha256 != expected:
+                failures += 1
+                print(f"sha256 mismatch with {count} connection(s)")
+            print(f"{count:>3} connection(s): {elapsed:.2f} s, {size / elapsed / 1024 / 1024:.1f} MB/s")
+        print(f"speedup: {results[1] / results[segments]:.2f}x")
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return failures
+
+
+if __name__ == "__main__":
+    sys.exit(1 if main(*[float(a) for a in sys.argv[1:]]) else 0)
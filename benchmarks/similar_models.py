@@ -0,0 +1,90 @@
+"""
+compares the similar model suggestions of TrigramIndex with the linear fuzzy scan it replaces
+(fuzzy_text_match over every catalog name) and times both. run from the folder holding the repo:
+    python -m comfy_runner.benchmarks.similar_models [num_queries] [seed]
+"""
+import json
+import os
+import random
+import sys
+import time
+
+from ..constants import COMFY_MODEL_PATH_LIST, MODEL_DOWNLOAD_PATH_LIST
+from ..utils.common import find_git_root, fuzzy_text_match
+from ..utils.trigram_index import TrigramIndex
+
+# queries that a top-k candidate cut got wrong
+FIXED_QUERIES = ["A.safetensors", "inpainting.safetensors", "edg.safetensors", "a.ckpt", "x.pth"]
+EXTENSIONS = [".safetensors", ".ckpt", ".pth", ".bin", ".pt"]
+
+
+def load_name_lists():
+    root_dir = find_git_root(os.path.dirname(__file__))
+    local_names, comfy_names = [], []
+    for path in MODEL_DOWNLOAD_PATH_LIST:
+        path = os.path.join(root_dir, path)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                local_names += [n for n in json.load(f) if n not in local_names]
+    for path in COMFY_MODEL_PATH_LIST:
+        path = os.path.join(root_dir, path)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                comfy_names += [m["filename"] for m in json.load(f)["models"]]
+    return local_names, list(dict.fromkeys(comfy_names))
+
+
+def perturb(name, rng):
+    stem, ext = os.path.splitext(name)
+    op = rng.randrange(7)
+    if op == 0 and len(stem) > 3:
+        i = rng.randrange(len(stem))
+        stem = stem[:i] + stem[i + 1 :]
+    elif op == 1:
+        stem = stem.replace("_", "-") if "_" in stem else stem.replace("-", "_")
+    elif op == 2:
+        stem += rng.choice(["_v2", "-fp16", "_pruned", "1"])
+    elif op == 3:
+        ext = rng.choice(EXTENSIONS)
+    elif op == 4:
+        stem = stem[: max(1, len(stem) // rng.choice([2, 3, 5]))]
+    elif op == 5:
+        stem = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(1, 4)))
+    else:
+        stem = stem.upper()
+    return stem + ext
+
+
+def main(num_queries=600, seed=0):
+    rng = random.Random(seed)
+    local_names, comfy_names = load_name_lists()
+    all_names = local_names + comfy_names
+    queries = FIXED_QUERIES + [perturb(rng.choice(all_names), rng) for _ in range(num_queries)]
+    print(f"{len(local_names)} local + {len(comfy_names)} comfy names, {len(queries)} queries")
+
+    mismatches, linear_time, indexed_time = 0, 0, 0
+    for name_list in (local_names, comfy_names):
+        if not name_list:
+            continue
+        start = time.perf_counter()
+        index = TrigramIndex(name_list)
+        print(f"index of {len(name_list)} names built in {(time.perf_counter() - start) * 1000:.1f} ms")
+        for query in queries:
+            start = time.perf_counter()
+            expected = fuzzy_text_match(name_list, query)
+            linear_time += time.perf_counter() - start
+            start = time.perf_counter()
+            res = index.match(query)
+            indexed_time += time.perf_counter() - start
+            if res != expected:
+                mismatches += 1
+                print(f"mismatch {query!r}: linear {expected} indexed {res}")
+
+    print(f"mismatches: {mismatches}")
+    print(f"linear:  {linear_time * 1000 / len(queries):.2f} ms/query")
+    print(f"indexed: {indexed_time * 1000 / len(queries):.2f} ms/query")
+    return mismatches
+
+
+if __name__ == "__main__":
+    sys.exit(1 if main(*[int(a) for a in sys.argv[1:]]) else 0)
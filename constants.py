@@ -6,9 +6,56 @@ load_dotenv()
 APP_PORT = 4333
 SERVER_ADDR = "http://127.0.0.1"
 
+# comfy server readiness probing (in secs), the probe delay doubles on every failed attempt
+SERVER_STARTUP_TIMEOUT = 300
+SERVER_PROBE_INITIAL_DELAY = 0.05
+SERVER_PROBE_MAX_DELAY = 2
+SERVER_QUEUE_POLL_INTERVAL = 0.5
+
+# blue/green restarts boot the replacement server on the standby port and give the old
+# one this long (in secs) to finish its queue before it is terminated. the standby port of a
+# runner is its port + the offset, so runners on different ports (e.g. a worker pool) never share it
+STANDBY_PORT_OFFSET = 1000
+SERVER_DRAIN_TIMEOUT = 600
+
+# ports used by ComfyWorkerPool instances (end excluded)
+WORKER_POOL_PORT_RANGE = (4334, 4342)
+
 current_dir = os.path.dirname(os.path.abspath(__file__))
 comfy_dir = os.path.join(os.path.dirname(current_dir), 'ComfyUI/')
 COMFY_BASE_PATH = os.getenv("COMFY_BASE_PATH", comfy_dir)
+# bare mirrors of comfy, the manager and the custom node repos, shared by every clone on the machine
+GIT_CACHE_PATH = os.getenv("GIT_CACHE_PATH", os.path.join(os.path.expanduser("~"), ".cache", "comfy_runner", "git"))
+# custom node repos cloned in parallel
+NODE_INSTALL_WORKERS = 8
+# environment lock written by setup_workflow and used by restore_from_lock
+ENV_LOCK_FILE_PATH = "./comfy_env.lock.json"
+RESTORE_DOWNLOAD_WORKERS = 4
+# local wheels for comfy and the custom node dependencies, installs skip pypi when this folder exists
+WHEELHOUSE_PATH = os.getenv("WHEELHOUSE_PATH", os.path.join(os.path.expanduser("~"), ".cache", "comfy_runner", "wheels"))
+# offline provisioning, installs fail (instead of falling back to pypi) when a wheel is missing
+WHEELHOUSE_OFFLINE = os.getenv("WHEELHOUSE_OFFLINE", "0") == "1"
+# sha256 of the model files, cached by (inode, size, mtime) so unchanged files aren't hashed again
+MODEL_HASH_DB_PATH = os.getenv("MODEL_HASH_DB_PATH", os.path.join(COMFY_BASE_PATH, ".comfy_runner_hashes.db"))
+# content addressed store of the downloaded models (keyed by sha256), the model folders only hold
+# hardlinks (symlinks across filesystems) to it. point it to the same folder to share it between installs
+MODEL_STORE_PATH = os.getenv("MODEL_STORE_PATH", os.path.join(COMFY_BASE_PATH, ".comfy_runner_store"))
+# compiled model catalogs (data/*.json + the comfy model lists), rebuilt when a source changes
+MODEL_CATALOG_DIR = os.getenv("MODEL_CATALOG_DIR", os.path.join(os.path.expanduser("~"), ".cache", "comfy_runner"))
+# setup plans of the already provisioned workflows kept in memory
+WORKFLOW_PLAN_CACHE_SIZE = 128
+# large files are downloaded over up to DOWNLOAD_SEGMENTS connections (if the server supports ranges)
+DOWNLOAD_SEGMENTS = 8
+DOWNLOAD_MIN_SEGMENT_SIZE = 32 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = 60
+# how often (in secs) the progress of a ranged download is saved next to its .part file
+DOWNLOAD_STATE_INTERVAL = 5
+# files downloaded at the same time, connections open to a single host and the global cap
+# on the download speed (bytes/sec, 0 means no cap)
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_HOST_CONNECTIONS = int(os.getenv("DOWNLOAD_HOST_CONNECTIONS", 16))
+DOWNLOAD_BANDWIDTH_LIMIT = int(os.getenv("DOWNLOAD_BANDWIDTH_LIMIT", 0))
 MODEL_DOWNLOAD_PATH_LIST = ["./data/civit_model_weights.json", "./data/replicate_model_weights.json", "./data/huggingface_weights.json"]
 COMFY_MODEL_PATH_LIST = [ "../ComfyUI/custom_nodes/ComfyUI-Manager/model-list.json", "./data/extra_comfy_weights.json"]
 
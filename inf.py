@@ -1,13 +1,11 @@
 import glob
 import json
 import os
-import platform
 import time
-import sys
 import traceback
-import psutil
-import subprocess
-import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import websocket
 import uuid
 from git import Repo
@@ -16,185 +14,316 @@ from .utils.node_installer import get_node_installer
 from .constants import (
     APP_PORT,
     COMFY_BASE_PATH,
-    DEBUG_LOG_ENABLED,
+    ENV_LOCK_FILE_PATH,
     MODEL_DOWNLOAD_PATH_LIST,
     MODEL_FILETYPES,
-    OPTIONAL_MODELS,
+    RESTORE_DOWNLOAD_WORKERS,
     SERVER_ADDR,
+    SERVER_DRAIN_TIMEOUT,
+    STANDBY_PORT_OFFSET,
+    WHEELHOUSE_PATH,
     comfy_dir,
 )
+from .utils.bootstrap import BootstrapState, read_git_head
 from .utils.comfy.api import ComfyAPI
 from .utils.comfy.methods import ComfyMethod
 from .utils.common import (
     clear_directory,
     copy_files,
     find_file_in_directory,
-    find_process_by_port,
-    search_file,
 )
-from .utils.file_downloader import FileStatus, ModelDownloader
+from .utils.download_scheduler import DownloadScheduler
+from .utils.env_lock import EnvironmentLock
+from .utils.git_cache import GitCache
+from .utils.file_downloader import FileStatus, ModelDownloader, get_model_key
 from .utils.logger import LoggingType, app_logger
+from .utils.model_index import ModelIndex
+from .utils.node_resolver import NodeResolver
+from .utils.restart_policy import RestartAction, RestartPolicy
+from .utils.server_supervisor import ServerSupervisor, read_active_port, write_active_port
+from .utils.wheelhouse import Wheelhouse
+from .utils.workflow_ir import WorkflowIR, get_workflow_ir
+from .utils.workflow_plan import (
+    WorkflowPlan,
+    WorkflowPlanCache,
+    prune_workflow,
+    workflow_structure_hash,
+)
+from .utils.workflow_template import WorkflowTemplate
+from .utils.workflow_validator import PROVISIONABLE_ERRORS, ValidationErrorType, WorkflowValidator
 
 
 class ComfyRunner:
-    def __init__(self):
-        self.comfy_api = ComfyAPI(SERVER_ADDR, APP_PORT)
+    def __init__(
+        self,
+        port=APP_PORT,
+        input_dir="./ComfyUI/input",
+        output_dir="./ComfyUI/output",
+        server_args=[],
+        provision_lock=None,
+        blue_green=False,
+        standby_port=None,
+    ):
+        """
+        port:               port of the comfy server this runner talks to
+        input_dir:          folder the workflow input files are copied into
+        output_dir:         folder comfy saves the generations in
+        server_args:        extra cli args passed to ComfyUI/main.py
+        provision_lock:     lock held while installing nodes/models, shared by runners using the same ComfyUI
+        blue_green:         restart by booting a new server on standby_port and switching over once it is ready
+        standby_port:       port the server alternates with in blue_green mode (port + STANDBY_PORT_OFFSET by default)
+        """
+        self.port = port
+        self.base_port = port
+        self.standby_port = standby_port or port + STANDBY_PORT_OFFSET
+        # a previous runner might have swapped the server over to the standby port
+        active_port = read_active_port(port)
+        if active_port == self.standby_port and ServerSupervisor(SERVER_ADDR, active_port).is_alive():
+            self.port = active_port
+        self.blue_green = blue_green
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.server_args = server_args
+        self.provision_lock = provision_lock or threading.Lock()
+        self.comfy_api = ComfyAPI(SERVER_ADDR, self.port)
+        self.server_supervisor = ServerSupervisor(
+            SERVER_ADDR, self.port, server_args=server_args
+        )
         self.model_downloader = ModelDownloader(MODEL_DOWNLOAD_PATH_LIST)
+        self.download_scheduler = DownloadScheduler()
+        self.restart_policy = RestartPolicy(COMFY_BASE_PATH + "custom_nodes")
+        self.git_cache = GitCache()
+        self.model_index = ModelIndex(
+            [COMFY_BASE_PATH + "models/", COMFY_BASE_PATH + "custom_nodes/"],
+            persist_path=COMFY_BASE_PATH + ".comfy_runner_model_index.json",
+        )
+        self.plan_cache = WorkflowPlanCache()
+        self.workflow_validator = WorkflowValidator(
+            COMFY_BASE_PATH + ".comfy_runner_object_info.json"
+        )
+        self.node_resolver = NodeResolver(
+            self.comfy_api,
+            snapshot_path=self.workflow_validator.snapshot_path,
+            fingerprint=lambda: self._get_node_fingerprint(self.loaded_custom_nodes),
+        )
+        self.workflow_templates = {}  # name -> registered workflow, see register_workflow
+        # custom nodes on disk when the server booted (None if it was started by someone else).
+        # runners sharing custom_nodes restart when another one installed nodes since then
+        self.loaded_custom_nodes = None
+
+        # generations waiting for their output, per port (used while draining old servers)
+        self.inflight_lock = threading.Lock()
+        self.inflight_generations = {}
+        self.drain_thread = None
+        self.draining = False
 
     # TODO: create mixins for these kind of methods
     def is_server_running(self):
-        pid = find_process_by_port(APP_PORT)
-        return True if pid else False
+        return self.server_supervisor.is_running()
 
     def start_server(self):
         # checking if comfy is already running
         if not self.is_server_running():
-            kwargs = {
-                "shell": platform.system() == "Windows",
-            }
-            # TODO: remove comfyUI output from the console
-            if not DEBUG_LOG_ENABLED:
-                kwargs["stdout"] = subprocess.DEVNULL
-                kwargs["stderr"] = subprocess.DEVNULL
-
-            python_executable = sys.executable
-            self.server_process = subprocess.Popen(
-                [python_executable, "./ComfyUI/main.py", "--port", str(APP_PORT)],
-                **kwargs,
-            )
-
-            # waiting for server to start accepting requests
-            while not self.is_server_running():
-                time.sleep(0.5)
-
+            self.loaded_custom_nodes = self.restart_policy.snapshot()
+            self.server_supervisor.start()
+            write_active_port(self.base_port, self.port)
+            self.node_resolver.invalidate(registered_only=True)
             app_logger.log(LoggingType.DEBUG, "comfy server is running")
         else:
             try:
-                if not self.comfy_api.health_check():
-                    raise Exception(f"Port {APP_PORT} blocked")
+                # the process is up but the server might still be booting
+                if not self.server_supervisor.wait_until_ready():
+                    raise Exception(f"Port {self.port} blocked")
                 else:
                     app_logger.log(LoggingType.DEBUG, "Server already running")
             except Exception as e:
-                raise Exception(f"Port {APP_PORT} blocked")
+                raise Exception(f"Port {self.port} blocked")
+
+    def stop_server(self, drain=False, drain_timeout=SERVER_DRAIN_TIMEOUT):
+        """
+        drain:          stop accepting new generations and wait for the queued ones to finish first
+        drain_timeout:  max time (in secs) to wait for the queue, generations still queued after it are killed
+        returns the drain report {'finished': [prompt_id, ...], 'killed': [prompt_id, ...]} when draining
+        """
+        if not drain:
+            self.server_supervisor.stop()
+            write_active_port(self.base_port, None)
+            return None
+
+        self.draining = True
+        try:
+            report = self._drain(self.server_supervisor, drain_timeout)
+            self.server_supervisor.stop()
+            write_active_port(self.base_port, None)
+        finally:
+            self.draining = False
+
+        if report["killed"]:
+            app_logger.log(
+                LoggingType.WARNING,
+                f"Drain timed out, {len(report['killed'])} generation(s) killed",
+            )
+        return report
+
+    def restart_server(self):
+        if self.blue_green:
+            self.swap_server()
+        else:
+            self.stop_server()
+            self.start_server()
+        self.node_resolver.invalidate(registered_only=True)
+
+    def swap_server(self):
+        """
+        boots a replacement server on the spare port and switches the api over once it is
+        ready. the old server finishes its queue in the background and is then terminated
+        """
+        # the previous server might still be draining on the port we are about to use
+        if self.drain_thread is not None:
+            self.drain_thread.join()
+
+        new_port = self.standby_port if self.port == self.base_port else self.base_port
+        standby = ServerSupervisor(SERVER_ADDR, new_port, server_args=self.server_args)
+        if standby.is_alive():
+            standby.stop()
+        self.loaded_custom_nodes = self.restart_policy.snapshot()
+        standby.start()
+
+        old_supervisor = self.server_supervisor
+        self.server_supervisor = standby
+        self.port = new_port
+        self.comfy_api.switch_server(SERVER_ADDR, new_port)
+        # new runners on base_port connect to this server instead of starting another one
+        write_active_port(self.base_port, new_port)
+        app_logger.log(
+            LoggingType.INFO,
+            f"Switched comfy server from port {old_supervisor.port} to {new_port}",
+        )
+
+        self.drain_thread = threading.Thread(
+            target=self._drain_and_stop, args=(old_supervisor,), daemon=True
+        )
+        self.drain_thread.start()
+
+    def _drain(self, supervisor, timeout):
+        deadline = time.monotonic() + timeout
+        report = supervisor.drain(timeout)
+        # the queue can be empty while a caller is still fetching its output
+        while self.inflight_generations.get(supervisor.port) and time.monotonic() < deadline:
+            time.sleep(0.1)
 
-    def stop_server(self):
-        pid = find_process_by_port(APP_PORT)
-        if pid:
-            process = psutil.Process(pid)
-            process.terminate()
-            process.wait()
+        return report
+
+    def _drain_and_stop(self, supervisor, timeout=SERVER_DRAIN_TIMEOUT):
+        report = self._drain(supervisor, timeout)
+        supervisor.stop()
+        app_logger.log(
+            LoggingType.DEBUG,
+            f"Old comfy server on port {supervisor.port} stopped, "
+            f"{len(report['finished'])} finished / {len(report['killed'])} killed",
+        )
+
+    def _begin_generation(self, port):
+        with self.inflight_lock:
+            if self.draining:
+                raise Exception("Comfy server is draining, not accepting new generations")
+            self.inflight_generations[port] = self.inflight_generations.get(port, 0) + 1
+
+    def _end_generation(self, port):
+        with self.inflight_lock:
+            self.inflight_generations[port] -= 1
+
+    def refresh_models(self):
+        # comfy rescans the model folders while building the node info, so the new
+        # models show up in the loaders without restarting the server
+        try:
+            self.comfy_api.get_registered_nodes()
+        except Exception as e:
+            app_logger.log(LoggingType.DEBUG, f"unable to refresh models {str(e)}")
 
     def clear_comfy_logs(self):
-        log_file_list = glob.glob("comfyui*.log")
+        # the manager names the logs after the --port of the server (comfyui_<port>.log, .prev.log..),
+        # only the ones of this runner's ports are removed, other runners share the working dir
+        log_file_list = []
+        for port in (self.base_port, self.standby_port):
+            log_file_list += glob.glob(f"comfyui_{port}.*log")
         for file in log_file_list:
             if os.path.exists(file):
                 os.remove(file)
 
-    def get_output(self, ws, prompt, client_id, output_node_ids):
-        prompt_id = self.comfy_api.queue_prompt(prompt, client_id)["prompt_id"]
+    def _get_node_outputs(self, ws, prompt, client_id, output_node_ids, comfy_api=None):
+        """
+        queues the prompt and waits for it, returns {node_id: output} of the requested nodes
+        (every node if output_node_ids is empty). returns as soon as the requested nodes are
+        executed when nothing else is left to run (e.g. pruned workflows)
+        comfy_api:  pins the call to the server the websocket is connected to
+        """
+        comfy_api = comfy_api or self.comfy_api
+        prompt_id = comfy_api.queue_prompt(prompt, client_id)["prompt_id"]
+        output_node_ids = [str(id) for id in output_node_ids] if output_node_ids else []
+        # comfy keeps running the rest of the prompt after the requested nodes, returning then would
+        # let it write into the output folder while it is cleared (and delay the next prompt anyway).
+        # only safe if every node of the prompt is one the requested outputs depend on
+        early_return = bool(output_node_ids) and WorkflowIR(prompt).get_ancestors(output_node_ids) == set(prompt)
 
-        # waiting for the execution to finish
+        # waiting for the execution to finish (or just for the requested output nodes)
+        executed_outputs = {}  # node_id -> output sent with the 'executed' event
         while True:
             out = ws.recv()
             if isinstance(out, str):
                 message = json.loads(out)
+                data = message.get("data", {})
                 if message["type"] == "executing":
-                    data = message["data"]
                     if data["node"] is None and data["prompt_id"] == prompt_id:
                         break  # Execution is done
+                elif message["type"] == "executed" and data.get("prompt_id") == prompt_id:
+                    if data.get("output") is not None:
+                        executed_outputs[str(data["node"])] = data["output"]
+                    if early_return and all(id in executed_outputs for id in output_node_ids):
+                        break  # nothing else runs after the requested outputs
             else:
                 continue  # previews are binary data
 
-        # fetching results
-        history = self.comfy_api.get_history(prompt_id)[prompt_id]
-        output_list = {"file_list": [], "text_output": []}
-        output_node_ids = [str(id) for id in output_node_ids] if output_node_ids else []
-        for node_id in history["outputs"]:
-            if (
-                output_node_ids and len(output_node_ids) and node_id in output_node_ids
-            ) or not output_node_ids:
-                node_output = history["outputs"][node_id]
-                if "gifs" in node_output:
-                    for gif in node_output["gifs"]:
-                        output_list["file_list"].append(gif["filename"])
-
-                if "text" in node_output:
-                    for txt in node_output["text"]:
-                        output_list["text_output"].append(txt)
-
-                if "images" in node_output:
-                    for img in node_output["images"]:
-                        output_list["file_list"].append(img["filename"])
-
-        return output_list
-
-    def filter_missing_node(self, workflow):
-        mappings = self.comfy_api.get_node_mapping_list()
-        custom_node_list = self.comfy_api.get_all_custom_node_list()
-        data = custom_node_list["custom_nodes"]
-
-        # Build regex->url map
-        regex_to_url = [
-            {"regex": re.compile(item["nodename_pattern"]), "url": item["files"][0]}
-            for item in data
-            if item.get("nodename_pattern")
-        ]
-
-        # Build name->url map
-        name_to_url = {
-            name: url for url, names in mappings.items() for name in names[0]
+        # fetching results, the history is only saved once the whole prompt is done
+        if early_return and all(id in executed_outputs for id in output_node_ids):
+            outputs = executed_outputs
+        else:
+            outputs = comfy_api.get_history(prompt_id)[prompt_id]["outputs"]
+        return {
+            node_id: node_output
+            for node_id, node_output in outputs.items()
+            if not output_node_ids or node_id in output_node_ids
         }
 
-        registered_nodes = self.comfy_api.get_registered_nodes()
-
-        missing_nodes = set()
-        nodes = [node for _, node in workflow.items()]
-
-        for node in nodes:
-            node_type = node.get("class_type", "")
-            if node_type.startswith("workflow/"):
-                continue
+    def get_output(self, ws, prompt, client_id, output_node_ids, comfy_api=None):
+        outputs = self._get_node_outputs(ws, prompt, client_id, output_node_ids, comfy_api)
+        output_list = {"file_list": [], "text_output": []}
+        for node_output in outputs.values():
+            if "gifs" in node_output:
+                for gif in node_output["gifs"]:
+                    output_list["file_list"].append(gif["filename"])
 
-            if node_type not in registered_nodes:
-                url = name_to_url.get(node_type.strip(), "")
-                if url:
-                    missing_nodes.add(url)
-                else:
-                    for regex_item in regex_to_url:
-                        if regex_item["regex"].search(node_type):
-                            missing_nodes.add(regex_item["url"])
+            if "text" in node_output:
+                for txt in node_output["text"]:
+                    output_list["text_output"].append(txt)
 
-        unresolved_nodes = []  # not yet implemented in comfy
+            if "images" in node_output:
+                for img in node_output["images"]:
+                    output_list["file_list"].append(img["filename"])
 
-        for node_type in unresolved_nodes:
-            url = name_to_url.get(node_type, "")
-            if url:
-                missing_nodes.add(url)
+        return output_list
 
-        ans = [
-            node
-            for node in data
-            if any(file in missing_nodes for file in node.get("files", []))
-        ]
-        # print("********* missing nodes found: ", ans)
-        return ans
+    def filter_missing_node(self, workflow):
+        # the manager tables and the registered nodes are cached by the resolver
+        ir = get_workflow_ir(workflow)
+        return self.node_resolver.find_missing_nodes(ir.get_class_types())
 
     def download_models(
         self, workflow, extra_models_list, ignore_model_list=[]
     ) -> dict:
         models_downloaded = False
         self.model_downloader.load_comfy_models()
-        models_to_download = []
-
-        for node in workflow:
-            if "inputs" in workflow[node]:
-                for input in workflow[node]["inputs"].values():
-                    if (
-                        isinstance(input, str)
-                        and any(input.endswith(ft) for ft in MODEL_FILETYPES)
-                        and not any(input.endswith(m) for m in OPTIONAL_MODELS)
-                    ):
-                        models_to_download.append(input)
+        models_to_download = [ref.value for ref in get_workflow_ir(workflow).model_refs]
 
         # filtering ignored models
         m_l = []
@@ -215,17 +344,30 @@ class ComfyRunner:
                 app_logger.log(LoggingType.DEBUG, f"Ignoring model {m['filename']}")
 
         m_l = []
+        self.model_index.refresh()
         for model in models_to_download:
             base = None
             base, model = os.path.split(model)
-            if not search_file(model, COMFY_BASE_PATH, parent_folder=base):
+            if not self.model_index.contains(model):
                 m_l.append(model)
         models_to_download = m_l
 
-        for model in models_to_download:
-            status, similar_models, file_status = self.model_downloader.download_model(
-                model
+        # the workflow models and the extra models are downloaded at the same time
+        task_list = [
+            partial(self.model_downloader.download_model, model, show_progress=False)
+            for model in models_to_download
+        ] + [
+            partial(
+                self.model_downloader.download_file,
+                model["filename"], model["url"], model["dest"], model.get("sha256"), show_progress=False,
             )
+            for model in extra_models_list
+        ]
+        results = self.download_scheduler.run(task_list)
+
+        for model, (status, similar_models, file_status) in zip(
+            models_to_download, results[: len(models_to_download)]
+        ):
             if not status:
                 models_not_found.append(
                     {"model": model, "similar_models": similar_models}
@@ -233,11 +375,10 @@ class ComfyRunner:
             elif file_status == FileStatus.NEW_DOWNLOAD.value:
                 models_downloaded = True
 
-        # downloading extra models
-        for model in extra_models_list:
-            status, file_status = self.model_downloader.download_file(
-                model["filename"], model["url"], model["dest"]
-            )
+        # extra models
+        for model, (status, file_status) in zip(
+            extra_models_list, results[len(models_to_download) :]
+        ):
             if status:
                 models_downloaded = (
                     True if file_status == FileStatus.NEW_DOWNLOAD.value else False
@@ -248,8 +389,9 @@ class ComfyRunner:
                         break
 
         # checking if models_not_found are already inside comfy
+        self.model_index.refresh()
         for model in models_not_found:
-            if search_file(model["model"].split("/")[-1], COMFY_BASE_PATH):
+            if self.model_index.contains(model["model"].split("/")[-1]):
                 models_not_found.remove(model)
 
         return {
@@ -261,8 +403,54 @@ class ComfyRunner:
             "status": False if len(models_not_found) else True,
         }
 
+    def get_download_progress(self):
+        """
+        progress of the model downloads running now
+        returns {'active', 'downloaded', 'total', 'speed', 'eta'} (bytes, bytes/sec and secs)
+        """
+        return self.download_scheduler.get_progress()
+
+    def verify_models(self, max_workers=None):
+        """
+        hashes every model file (only the new or modified ones, the rest come from the hash cache)
+        and compares them with the sha256 of their catalog entries.
+        returns {'valid': [...], 'invalid': [...], 'unknown': [...]} (unknown = no expected hash)
+        """
+        self.model_downloader.load_comfy_models()
+        self.model_index.refresh()
+        file_list, expected_hashes = [], {}
+        for filename, path_list in self.model_index.files.items():
+            if not any(filename.endswith(ft) for ft in MODEL_FILETYPES):
+                continue
+            file_list += path_list
+            # same named files in different folders (e.g. pytorch_model.bin) have different hashes
+            for file_path in path_list:
+                sha256 = self.model_downloader.get_model_hash(get_model_key(file_path))
+                if sha256:
+                    expected_hashes[file_path] = sha256
+
+        report = self.model_downloader.hash_cache.verify_files(
+            file_list, expected_hashes, max_workers
+        )
+        for file_path in report["invalid"]:
+            app_logger.log(LoggingType.ERROR, f"{file_path} doesn't match its sha256")
+        return report
+
+    def _queue_node_install(self, node, git_nodes):
+        # git repos are collected and installed together, the rest goes through the manager
+        if node.get("install_type") == "git-clone":
+            for url in node["files"]:
+                git_nodes.append({"url": url, "pip": node.get("pip", [])})
+        else:
+            status = self.comfy_api.install_custom_node(node)
+            if status != {}:
+                app_logger.log(
+                    LoggingType.ERROR, f"Failed to install custom node {node['title']}"
+                )
+
     def download_custom_nodes(self, workflow, extra_node_urls) -> dict:
         nodes_installed = False
+        git_nodes = []  # [{'url': git_url, 'commit_hash': xyz, 'pip': [...]}, ...]
 
         # installing missing nodes
         missing_nodes = self.filter_missing_node(workflow)
@@ -286,20 +474,13 @@ class ComfyRunner:
             app_logger.log(LoggingType.DEBUG, f"Installing {node['title']}")
             if node["installed"] in ["False", False]:
                 nodes_installed = True
-                status = self.comfy_api.install_custom_node(node)
-                if status != {}:
-                    app_logger.log(
-                        LoggingType.ERROR,
-                        "Failed to install custom node ",
-                        node["title"],
-                    )
+                self._queue_node_install(node, git_nodes)
 
         # installing custom git repos
         nodes_to_install_with_commit_hash = []
         nodes_to_install = []
         if len(extra_node_url_dict.keys()):
-            custom_node_list = self.comfy_api.get_all_custom_node_list()
-            custom_node_list = custom_node_list["custom_nodes"]
+            custom_node_list = self.node_resolver.get_custom_node_list()
             url_node_map = {}
             for node in custom_node_list:
                 if node["reference"] not in url_node_map:
@@ -329,27 +510,26 @@ class ComfyRunner:
             for n in nodes_to_install:
                 nodes_installed = True
                 app_logger.log(LoggingType.DEBUG, f"Installing {n['reference']}")
-                status = self.comfy_api.install_custom_node(n)
-                if status != {}:
-                    app_logger.log(
-                        LoggingType.ERROR, "Failed to install custom node ", n["title"]
-                    )
+                self._queue_node_install(n, git_nodes)
 
-            custom_node_installer = get_node_installer()
             for n in nodes_to_install_with_commit_hash:
                 app_logger.log(LoggingType.DEBUG, f"Installing {n['title']}")
                 nodes_installed = True
-                json_data = {
-                    "files": [n["url"]],
-                    "install_type": "git-clone",
-                    "commit_hash": [n["commit_hash"]],
-                }
-                status = custom_node_installer.install_node(json_data)
-                if not status:
+                git_nodes.append({"url": n["url"], "commit_hash": n["commit_hash"]})
+
+        # cloned in parallel with a single pip resolution for all of them
+        if len(git_nodes):
+            results = get_node_installer().install_nodes(git_nodes)
+            for url, error in results.items():
+                if error:
                     app_logger.log(
-                        LoggingType.ERROR, "Failed to install custom node ", n["title"]
+                        LoggingType.ERROR, f"Failed to install custom node {url}: {error}"
                     )
 
+        # the installed flags of the manager list changed
+        if nodes_installed:
+            self.node_resolver.invalidate()
+
         return {
             "data": {"nodes_installed": nodes_installed},
             "message": "",
@@ -357,7 +537,9 @@ class ComfyRunner:
         }
 
     def load_workflow(self, workflow_input):
-        if os.path.exists(workflow_input):
+        if isinstance(workflow_input, dict):
+            pass  # already parsed (e.g. registered workflows)
+        elif os.path.exists(workflow_input):
             try:
                 with open(workflow_input, "r", encoding="utf-8") as file:
                     workflow_input = json.load(file)
@@ -423,6 +605,535 @@ class ComfyRunner:
         )
         return None
 
+    def bootstrap_comfy(
+        self,
+        comfy_repo_url="https://github.com/comfyanonymous/ComfyUI",
+        comfy_commit_hash=None,
+        force=False,
+    ):
+        """
+        clones comfy and the manager and installs comfy's requirements. this is skipped when
+        the fingerprint recorded by the last bootstrap (requirements hash, comfy and manager
+        commits, interpreter) still matches, force re-verifies everything
+        """
+        bootstrap_state = BootstrapState(COMFY_BASE_PATH)
+        if not force and bootstrap_state.is_current(comfy_commit_hash):
+            app_logger.log(LoggingType.DEBUG, "Comfy setup unchanged, skipping bootstrap")
+            return True
+
+        # cloning comfy repo
+        app_logger.log(LoggingType.DEBUG, "cloning comfy repo")
+        comfy_manager_url = "https://github.com/ltdrdata/ComfyUI-Manager"
+        if not os.path.exists(COMFY_BASE_PATH):
+            comfy_repo = self.git_cache.clone(comfy_repo_url, COMFY_BASE_PATH, recursive=False)
+
+        if comfy_commit_hash is not None:
+            try:
+                comfy_repo = Repo(COMFY_BASE_PATH)
+                current_hash = comfy_repo.rev_parse("HEAD")
+                if str(current_hash) == comfy_commit_hash:
+                    app_logger.log(
+                        LoggingType.DEBUG,
+                        f"ComfyUI at stable commit hash",
+                    )
+                else:
+                    app_logger.log(
+                        LoggingType.DEBUG,
+                        f"Moving ComfyUI to commit {comfy_commit_hash}",
+                    )
+                    comfy_repo.git.checkout(comfy_commit_hash)
+            except Exception as e:
+                print("unable to checkout Comfy, aborting")
+                return False
+
+        if not os.path.exists(COMFY_BASE_PATH + "custom_nodes/ComfyUI-Manager"):
+            self.git_cache.clone(
+                comfy_manager_url,
+                COMFY_BASE_PATH + "custom_nodes/ComfyUI-Manager",
+                recursive=False,
+            )
+
+        # installing requirements
+        EnvironmentLock.save_pip_baseline(COMFY_BASE_PATH)
+        app_logger.log(
+            LoggingType.DEBUG, "Checking comfy requirements, please wait..."
+        )
+        Wheelhouse().install(["-r", COMFY_BASE_PATH + "requirements.txt"], quiet=True)
+
+        bootstrap_state.save()
+        return True
+
+    def prepare_workflow(
+        self,
+        workflow_input,
+        file_path_list=[],
+        extra_models_list=[],
+        extra_node_urls=[],
+        ignore_model_list=[],
+        comfy_commit_hash=None,
+        comfy_repo_url="https://github.com/comfyanonymous/ComfyUI",
+        force_bootstrap=False,
+        plan_key=None,
+        ir=None,
+        validated=False,
+    ):
+        """
+        sets up comfy, installs the missing nodes and models of the workflow and starts the server.
+        plan_key:   workflow_structure_hash of the workflow if already known (registered workflows)
+        ir:         WorkflowIR of the workflow if already built (registered workflows)
+        validated:  the workflow was already validated (registered workflows)
+        returns the workflow with the model paths updated (or None if the setup failed)
+        """
+        # TODO: add support for image and normal json files
+        workflow = self.load_workflow(workflow_input)
+        if not workflow:
+            app_logger.log(LoggingType.ERROR, "Invalid workflow file")
+            return None
+
+        # rejecting broken workflows before anything is installed
+        errors = [] if validated else self._get_blocking_errors(workflow, comfy_commit_hash, extra_node_urls)
+        # None: the snapshot might be outdated, checked again once the setup is done
+        revalidate = errors is None
+        if not revalidate and len(errors):
+            self._log_validation_errors(errors)
+            return None
+
+        # single pass over the workflow, shared by the setup stages below
+        ir = ir or (None if plan_key else WorkflowIR(workflow))
+
+        # workflows that only differ in their scalar inputs reuse the previous setup
+        plan_key = plan_key or self._plan_key(
+            ir, extra_models_list, extra_node_urls, ignore_model_list, comfy_commit_hash, comfy_repo_url
+        )
+
+        # runners sharing a ComfyUI install (e.g. a worker pool) provision one at a time
+        with self.provision_lock:
+            if not self.bootstrap_comfy(comfy_repo_url, comfy_commit_hash, force_bootstrap):
+                return None
+
+            # clearing the previous logs
+            if not self.is_server_running():
+                self.clear_comfy_logs()
+
+            # start the comfy server if not already running
+            self.start_server()
+
+            self.model_index.refresh()
+            plan = self.plan_cache.get(
+                plan_key, self.restart_policy.snapshot(), self.model_index.version
+            )
+            if plan:
+                app_logger.log(LoggingType.DEBUG, "Using the cached workflow plan")
+            else:
+                ir = ir or WorkflowIR(workflow)
+                if not self._provision_workflow(
+                    ir, extra_models_list, extra_node_urls, ignore_model_list
+                ):
+                    return None
+
+            if revalidate:
+                # the server now runs with the workflow's comfy commit and nodes
+                self.node_resolver.get_registered_nodes()
+                errors = self._get_blocking_errors(workflow)
+                if len(errors):
+                    self._log_validation_errors(errors)
+                    return None
+
+        if len(file_path_list):
+            clear_directory(self.input_dir)
+            for filepath in file_path_list:
+                if isinstance(filepath, str):
+                    filepath, dest_path = filepath, self.input_dir + "/"
+                else:
+                    filepath, dest_path = (
+                        filepath["filepath"],
+                        self.input_dir + "/" + filepath["dest_folder"] + "/",
+                    )
+                copy_files(filepath, dest_path, overwrite=True)
+
+        if not plan:
+            self.model_index.refresh()
+            plan = WorkflowPlan(
+                self._resolve_model_paths(ir),
+                self.restart_policy.snapshot(),
+                self.model_index.version,
+            )
+            self.plan_cache.put(plan_key, plan)
+
+        return plan.apply(workflow)
+
+    def validate_workflow(self, workflow_input):
+        """
+        checks the workflow against the /object_info snapshot of the last server run, the server
+        doesn't need to be running. returns a list of errors
+        {'type', 'node_id', 'class_type', 'input', 'message'}. unknown class_types and missing
+        models are reported too although the setup installs them
+        """
+        workflow = self.load_workflow(workflow_input)
+        if not workflow:
+            return [
+                {
+                    "type": "invalid_workflow",
+                    "node_id": None,
+                    "class_type": None,
+                    "input": None,
+                    "message": "not an API json workflow",
+                }
+            ]
+        return self.workflow_validator.validate(workflow)
+
+    def _get_node_fingerprint(self, custom_nodes):
+        # what /object_info depends on, None if the custom nodes are unknown
+        if custom_nodes is None:
+            return None
+        return {"comfy_head": read_git_head(COMFY_BASE_PATH), "custom_nodes": custom_nodes}
+
+    def _get_blocking_errors(self, workflow, comfy_commit_hash=None, extra_node_urls=[]):
+        """
+        the errors that the setup can't fix. they are only trusted when the /object_info snapshot
+        was taken with the comfy commit and custom nodes the workflow will run with, otherwise
+        they are logged as warnings and None is returned (validate again after the setup)
+        comfy_commit_hash, extra_node_urls:     setup args that can change the registered nodes
+        """
+        all_errors = self.validate_workflow(workflow)
+        errors = [e for e in all_errors if e["type"] not in PROVISIONABLE_ERRORS]
+        if not len(errors):
+            return errors
+
+        fingerprint = self._get_node_fingerprint(self.restart_policy.snapshot())
+        setup_changes_nodes = (
+            len(extra_node_urls)
+            or (comfy_commit_hash is not None and comfy_commit_hash != fingerprint["comfy_head"])
+            or any(e["type"] == ValidationErrorType.UNKNOWN_CLASS_TYPE.value for e in all_errors)
+        )
+        if not setup_changes_nodes and self.workflow_validator.is_current(fingerprint):
+            return errors
+
+        self._log_validation_errors(errors, LoggingType.WARNING)
+        app_logger.log(
+            LoggingType.WARNING, "The node definitions might be outdated, validating again after the setup"
+        )
+        return None
+
+    def _log_validation_errors(self, errors, log_type=LoggingType.ERROR):
+        for error in errors:
+            app_logger.log(
+                log_type,
+                f"Node {error['node_id']} ({error['class_type']}) {error['input'] or ''}: {error['message']}",
+            )
+
+    def _plan_key(
+        self, workflow, extra_models_list, extra_node_urls, ignore_model_list, comfy_commit_hash, comfy_repo_url
+    ):
+        return workflow_structure_hash(
+            workflow,
+            [extra_models_list, extra_node_urls, ignore_model_list, comfy_commit_hash, comfy_repo_url],
+        )
+
+    def _provision_workflow(
+        self, workflow, extra_models_list, extra_node_urls, ignore_model_list
+    ):
+        # installs the missing nodes and models, returns False if the setup failed
+        # download custom nodes
+        custom_nodes_before = self.restart_policy.snapshot()
+        res_custom_nodes = self.download_custom_nodes(workflow, extra_node_urls)
+        if not res_custom_nodes["status"]:
+            app_logger.log(LoggingType.ERROR, res_custom_nodes["message"])
+            return False
+
+        # download models if not already present
+        res_models = self.download_models(
+            workflow, extra_models_list, ignore_model_list
+        )
+        if not res_models["status"]:
+            app_logger.log(LoggingType.ERROR, res_models["message"])
+            if len(res_models["data"]["models_not_found"]):
+                app_logger.log(
+                    LoggingType.INFO,
+                    "Please provide custom model urls for the models listed below or modify the workflow json to one of the alternative models listed",
+                )
+                for model in res_models["data"]["models_not_found"]:
+                    print("Model: ", model["model"])
+                    print("Alternatives: ")
+                    if len(model["similar_models"]):
+                        for alternative in model["similar_models"]:
+                            print(" - ", alternative)
+                    else:
+                        print(" - None")
+                    print("---------------------------")
+            return False
+
+        # restart the server only if new node code was installed, models just need a refresh.
+        # compared with what the server loaded, nodes can also be installed by other runners
+        # sharing custom_nodes (ComfyWorkerPool)
+        restart_action, _ = self.restart_policy.decide(
+            custom_nodes_before if self.loaded_custom_nodes is None else self.loaded_custom_nodes,
+            self.restart_policy.snapshot(),
+            res_models["data"]["models_downloaded"],
+        )
+        if (
+            restart_action != RestartAction.RESTART
+            and self.loaded_custom_nodes is None
+            and self.is_server_running()
+        ):
+            # server booted by someone else, checking that it registered the installed nodes
+            self.node_resolver.invalidate(registered_only=True)
+            for node in self.node_resolver.find_missing_nodes(get_workflow_ir(workflow).get_class_types()):
+                repo_name = os.path.splitext(os.path.basename(node["files"][0].rstrip("/")))[0]
+                if os.path.exists(os.path.join(COMFY_BASE_PATH, "custom_nodes", repo_name)):
+                    restart_action = RestartAction.RESTART
+                    break
+        if restart_action == RestartAction.RESTART:
+            app_logger.log(LoggingType.INFO, "Restarting the server")
+            self.restart_server()
+        elif restart_action == RestartAction.REFRESH_MODELS:
+            self.refresh_models()
+
+        return True
+
+    def _resolve_model_paths(self, workflow):
+        # returns the [(node_id, key, model_path), ...] rewrites of the model inputs
+        # checkpoints, lora, default etc..
+        comfy_directory = COMFY_BASE_PATH + "models/"
+        comfy_model_folders = [
+            folder
+            for folder in os.listdir(comfy_directory)
+            if os.path.isdir(os.path.join(comfy_directory, folder))
+        ]
+        # update model paths e.g. 'v3_sd15_sparsectrl_rgb.ckpt' --> 'SD1.5/animatediff/v3_sd15_sparsectrl_rgb.ckpt'
+        model_rewrites = []
+        for ref in get_workflow_ir(workflow).model_refs:
+            base, input = ref.base, ref.filename
+            model_path_list = [
+                p
+                for p in self.model_index.find(input)
+                if p.startswith(comfy_directory)
+            ]
+            if len(model_path_list):
+                # selecting the model_path which has the base, if neither has the base then selecting the first one
+                model_path = model_path_list[0]
+                if base:
+                    matching_text_seq = (
+                        ["SD1.5"]
+                        if base in ["SD1.5", "SD1.x"]
+                        else ["SDXL"]
+                    )
+                    for txt in matching_text_seq:
+                        for p in model_path_list:
+                            if txt in p:
+                                model_path = p
+                                break
+
+                model_path = model_path.replace(comfy_directory, "")
+                if any(
+                    model_path.startswith(folder)
+                    for folder in comfy_model_folders
+                ):
+                    model_path = model_path.split(os.path.sep, 1)[-1]
+                app_logger.log(
+                    LoggingType.DEBUG,
+                    f"Updating {input} to {model_path}",
+                )
+                model_rewrites.append((ref.node_id, ref.input_name, model_path))
+
+        return model_rewrites
+
+    def create_lock(self, lock_file_path=ENV_LOCK_FILE_PATH):
+        lock = EnvironmentLock(COMFY_BASE_PATH)
+        lock.create(self.model_downloader.get_model_url)
+        lock.save(lock_file_path)
+        app_logger.log(LoggingType.INFO, f"Environment lock saved to {lock_file_path}")
+        return lock
+
+    def _checkout_commit(self, repo_path, commit_hash):
+        repo = Repo(repo_path)
+        try:
+            repo.git.checkout(commit_hash)
+        except Exception:
+            repo.git.fetch("origin", commit_hash)
+            repo.git.checkout(commit_hash)
+
+    def _restore_models(self, models):
+        def restore_model(model):
+            model_path = os.path.join(COMFY_BASE_PATH, model["path"])
+            if os.path.exists(model_path) and os.path.getsize(model_path) != model["size"]:
+                os.remove(model_path)
+            status, _ = self.model_downloader.download_file(
+                os.path.basename(model_path), model["url"], os.path.dirname(model_path)
+            )
+            return status
+
+        with ThreadPoolExecutor(max_workers=RESTORE_DOWNLOAD_WORKERS) as executor:
+            return list(executor.map(restore_model, [m for m in models if m["url"]]))
+
+    def restore_from_lock(self, lock_file_path=ENV_LOCK_FILE_PATH, verify_only=False):
+        """
+        provisions this worker from a lock created by setup_workflow (without the manager api).
+        the models are downloaded while the nodes and packages are installed.
+        verify_only:    only check the worker against the lock (takes well under a second)
+        returns the list of mismatches between the worker and the lock (empty if it matches)
+        """
+        lock = EnvironmentLock.load(COMFY_BASE_PATH, lock_file_path)
+        mismatches = lock.verify()
+        if verify_only or not len(mismatches):
+            return mismatches
+
+        app_logger.log(LoggingType.INFO, f"Restoring {len(mismatches)} mismatch(es) from the lock")
+        with self.provision_lock:
+            comfy = lock.data["comfy"]
+            if not os.path.exists(COMFY_BASE_PATH):
+                self.git_cache.clone(comfy["url"], COMFY_BASE_PATH, recursive=False)
+            if read_git_head(COMFY_BASE_PATH) != comfy["commit"]:
+                self._checkout_commit(COMFY_BASE_PATH, comfy["commit"])
+
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                models_future = executor.submit(self._restore_models, lock.data["models"])
+
+                nodes_to_install = []
+                for node in lock.data["custom_nodes"]:
+                    node_path = os.path.join(COMFY_BASE_PATH, "custom_nodes", node["name"])
+                    if not os.path.exists(node_path):
+                        nodes_to_install.append({"url": node["url"], "commit_hash": node["commit"]})
+                    elif read_git_head(node_path) != node["commit"]:
+                        self._checkout_commit(node_path, node["commit"])
+
+                results = get_node_installer().install_nodes(
+                    nodes_to_install, requirements=lock.data["pip"]
+                )
+                for url, error in results.items():
+                    if error:
+                        app_logger.log(LoggingType.ERROR, f"Failed to restore {url}: {error}")
+                self.node_resolver.invalidate()
+
+                models_future.result()
+
+            bootstrap_state = BootstrapState(COMFY_BASE_PATH)
+            bootstrap_state.save()
+
+        mismatches = lock.verify()
+        if len(mismatches):
+            app_logger.log(LoggingType.ERROR, f"Worker doesn't match the lock: {mismatches}")
+        return mismatches
+
+    def build_wheelhouse(self, wheelhouse_path=WHEELHOUSE_PATH, lock_file_path=None):
+        """
+        collects the wheels of comfy and every installed custom node (or the pinned packages
+        of a lock) so that workers can install them without reaching pypi
+        """
+        wheelhouse = Wheelhouse(wheelhouse_path)
+        if lock_file_path:
+            lock = EnvironmentLock.load(COMFY_BASE_PATH, lock_file_path)
+            wheelhouse.build(packages=lock.data["pip"])
+        else:
+            wheelhouse.build_for_comfy(COMFY_BASE_PATH)
+        return wheelhouse
+
+    def connect_ws(self, client_id, port=None):
+        ws = websocket.WebSocket()
+        host = SERVER_ADDR + ":" + str(port or self.port)
+        host = host.replace("http://", "").replace("https://", "")
+        ws.connect("ws://{}/ws?clientId={}".format(host, client_id))
+        return ws
+
+    def register_workflow(
+        self,
+        name,
+        workflow,
+        parameters={},
+        extra_models_list=[],
+        extra_node_urls=[],
+        ignore_model_list=[],
+        comfy_commit_hash=None,
+        output_node_ids=None,
+        prune_unused_nodes=False,
+    ):
+        """
+        parses and validates a workflow once so that it can be run with just the changed values.
+        name:           used with run
+        workflow:       API json of the workflow. Can be a filepath, str or dict
+        parameters:     named bindings to node inputs e.g. {'prompt': '6.inputs.text', 'seed': '3.inputs.seed'}
+        the other params are the same as in predict and apply to every run of the workflow
+        """
+        parsed_workflow = self.load_workflow(workflow)
+        if not parsed_workflow:
+            raise ValueError(f"Invalid workflow {name}")
+
+        if prune_unused_nodes and output_node_ids:
+            # pruned once here instead of on every run
+            parsed_workflow = prune_workflow(parsed_workflow, output_node_ids)
+
+        errors = self._get_blocking_errors(parsed_workflow, comfy_commit_hash, extra_node_urls)
+        if errors is not None and len(errors):
+            raise ValueError(
+                f"Invalid workflow {name}: "
+                + "; ".join(f"node {e['node_id']} {e['input'] or ''}: {e['message']}" for e in errors)
+            )
+
+        # parsed once here, the runs only pay for the values they change
+        ir = WorkflowIR(parsed_workflow)
+        template = WorkflowTemplate(
+            name,
+            parsed_workflow,
+            parameters,
+            self._plan_key(
+                ir,
+                extra_models_list,
+                extra_node_urls,
+                ignore_model_list,
+                comfy_commit_hash,
+                "https://github.com/comfyanonymous/ComfyUI",
+            ),
+            ir,
+        )
+        self.workflow_templates[name] = {
+            "template": template,
+            "extra_models_list": extra_models_list,
+            "extra_node_urls": extra_node_urls,
+            "ignore_model_list": ignore_model_list,
+            "comfy_commit_hash": comfy_commit_hash,
+            "output_node_ids": output_node_ids,
+            # False when the node definitions were outdated, the runs validate it then
+            "validated": errors is not None,
+        }
+        return template
+
+    def run(
+        self,
+        name,
+        file_path_list=[],
+        output_folder="./output",
+        client_id=None,
+        stop_server_after_completion=False,
+        **values,
+    ):
+        """
+        runs a registered workflow with the given parameter values e.g. run('txt2img', seed=4, prompt='a cat').
+        the values are applied to a copy of the template, the parsed workflow is never modified
+        """
+        if name not in self.workflow_templates:
+            raise ValueError(f"Workflow {name} is not registered")
+
+        registered = self.workflow_templates[name]
+        template = registered["template"]
+        workflow, plan_key = template.bind(**values)
+        # values that change links or models get the workflow checked and parsed again
+        structure_kept = plan_key is not None
+        return self.predict(
+            workflow,
+            file_path_list=file_path_list,
+            extra_models_list=registered["extra_models_list"],
+            extra_node_urls=registered["extra_node_urls"],
+            stop_server_after_completion=stop_server_after_completion,
+            output_folder=output_folder,
+            output_node_ids=registered["output_node_ids"],
+            ignore_model_list=registered["ignore_model_list"],
+            client_id=client_id,
+            comfy_commit_hash=registered["comfy_commit_hash"],
+            plan_key=plan_key,
+            ir=template.ir if structure_kept else None,
+            validated=structure_kept and registered["validated"],
+        )
+
     def predict(
         self,
         workflow_input,
@@ -436,9 +1147,14 @@ class ComfyRunner:
         ignore_model_list=[],
         client_id=None,
         comfy_commit_hash=None,
+        force_bootstrap=False,
+        plan_key=None,
+        prune_unused_nodes=False,
+        ir=None,
+        validated=False,
     ):
         """
-        workflow_input:                 API json of the workflow. Can be a filepath or str
+        workflow_input:                 API json of the workflow. Can be a filepath, str or dict
         file_path_list:                 files to copy inside the '/input' folder which are being used in the workflow
         extra_models_list:              extra models to be downloaded
         extra_node_urls:                extra nodes to be downloaded (with the option to specify commit version)
@@ -449,173 +1165,57 @@ class ComfyRunner:
         ignore_model_list:              these models won't be downloaded (in cases where these are manually placed)
         client_id:                      this can be used as a tag for the generations
         comfy_commit_hash:              specific comfy commit to checkout
+        force_bootstrap:                re-verify the comfy setup even if nothing changed since the last run
+        plan_key:                       structure hash of the workflow if already known (set by run)
+        prune_unused_nodes:             only submit the nodes output_node_ids depend on
+        ir:                             WorkflowIR of the workflow if already built (set by run)
+        validated:                      skips the validation of the workflow (set by run)
         """
+        # checked again when the generation starts, this skips the setup of a request that would be refused
+        if self.draining:
+            app_logger.log(LoggingType.ERROR, "Comfy server is draining, not accepting new generations")
+            return None
+
         output_list = {}
         try:
-            # TODO: add support for image and normal json files
-            workflow = self.load_workflow(workflow_input)
-            if not workflow:
-                app_logger.log(LoggingType.ERROR, "Invalid workflow file")
-                return
-
-            # cloning comfy repo
-            app_logger.log(LoggingType.DEBUG, "cloning comfy repo")
-            comfy_repo_url = "https://github.com/comfyanonymous/ComfyUI"
-            comfy_manager_url = "https://github.com/ltdrdata/ComfyUI-Manager"
-            if not os.path.exists(COMFY_BASE_PATH):
-                comfy_repo = Repo.clone_from(comfy_repo_url, COMFY_BASE_PATH)
-
-            if comfy_commit_hash is not None:
-                try:
-                    comfy_repo = Repo(COMFY_BASE_PATH)
-                    current_hash = comfy_repo.rev_parse("HEAD")
-                    if str(current_hash) == comfy_commit_hash:
-                        app_logger.log(
-                            LoggingType.DEBUG,
-                            f"ComfyUI at stable commit hash",
-                        )
-                    else:
-                        app_logger.log(
-                            LoggingType.DEBUG,
-                            f"Moving ComfyUI to commit {comfy_commit_hash}",
-                        )
-                        comfy_repo.git.checkout(comfy_commit_hash)
-                except Exception as e:
-                    print("unable to checkout Comfy, aborting")
-                    return None
-
-            if not os.path.exists(COMFY_BASE_PATH + "custom_nodes/ComfyUI-Manager"):
-                os.chdir(COMFY_BASE_PATH + "custom_nodes/")
-                Repo.clone_from(comfy_manager_url, "ComfyUI-Manager")
-                os.chdir("../../")
-
-            # installing requirements
-            app_logger.log(
-                LoggingType.DEBUG, "Checking comfy requirements, please wait..."
-            )
-            subprocess.run(
-                ["pip", "install", "-r", COMFY_BASE_PATH + "requirements.txt"],
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-                check=True,
-            )
-
-            # clearing the previous logs
-            if not self.is_server_running():
-                self.clear_comfy_logs()
-
-            # start the comfy server if not already running
-            self.start_server()
-
-            # download custom nodes
-            res_custom_nodes = self.download_custom_nodes(workflow, extra_node_urls)
-            if not res_custom_nodes["status"]:
-                app_logger.log(LoggingType.ERROR, res_custom_nodes["message"])
-                return
-
-            # download models if not already present
-            res_models = self.download_models(
-                workflow, extra_models_list, ignore_model_list
+            if prune_unused_nodes and output_node_ids:
+                # validation and the setup only see the nodes that are executed
+                workflow = self.load_workflow(workflow_input)
+                if workflow:
+                    workflow_input = prune_workflow(workflow, output_node_ids)
+                    # the given ir and plan_key describe the whole graph
+                    ir = plan_key = None
+
+            workflow = self.prepare_workflow(
+                workflow_input,
+                file_path_list,
+                extra_models_list,
+                extra_node_urls,
+                ignore_model_list,
+                comfy_commit_hash,
+                force_bootstrap=force_bootstrap,
+                plan_key=plan_key,
+                ir=ir,
+                validated=validated,
             )
-            if not res_models["status"]:
-                app_logger.log(LoggingType.ERROR, res_models["message"])
-                if len(res_models["data"]["models_not_found"]):
-                    app_logger.log(
-                        LoggingType.INFO,
-                        "Please provide custom model urls for the models listed below or modify the workflow json to one of the alternative models listed",
-                    )
-                    for model in res_models["data"]["models_not_found"]:
-                        print("Model: ", model["model"])
-                        print("Alternatives: ")
-                        if len(model["similar_models"]):
-                            for alternative in model["similar_models"]:
-                                print(" - ", alternative)
-                        else:
-                            print(" - None")
-                        print("---------------------------")
+            if not workflow:
                 return
 
-            # restart the server if custom nodes or models are installed
-            if (
-                res_custom_nodes["data"]["nodes_installed"]
-                or res_models["data"]["models_downloaded"]
-            ):
-                app_logger.log(LoggingType.INFO, "Restarting the server")
-                self.stop_server()
-                self.start_server()
-
-            if len(file_path_list):
-                clear_directory("./ComfyUI/input")
-                for filepath in file_path_list:
-                    if isinstance(filepath, str):
-                        filepath, dest_path = filepath, "./ComfyUI/input/"
-                    else:
-                        filepath, dest_path = (
-                            filepath["filepath"],
-                            "./ComfyUI/input/" + filepath["dest_folder"] + "/",
-                        )
-                    copy_files(filepath, dest_path, overwrite=True)
-
-            # checkpoints, lora, default etc..
-            comfy_directory = COMFY_BASE_PATH + "models/"
-            comfy_model_folders = [
-                folder
-                for folder in os.listdir(comfy_directory)
-                if os.path.isdir(os.path.join(comfy_directory, folder))
-            ]
-            # update model paths e.g. 'v3_sd15_sparsectrl_rgb.ckpt' --> 'SD1.5/animatediff/v3_sd15_sparsectrl_rgb.ckpt'
-            for node in workflow:
-                if "inputs" in workflow[node]:
-                    for key, input in workflow[node]["inputs"].items():
-                        if (
-                            isinstance(input, str)
-                            and any(input.endswith(ft) for ft in MODEL_FILETYPES)
-                            and not any(input.endswith(m) for m in OPTIONAL_MODELS)
-                        ):
-                            base = None
-                            # if os.path.sep in input:
-                            base, input = os.path.split(input)
-                            model_path_list = find_file_in_directory(
-                                comfy_directory, input
-                            )
-                            if len(model_path_list):
-                                # selecting the model_path which has the base, if neither has the base then selecting the first one
-                                model_path = model_path_list[0]
-                                if base:
-                                    matching_text_seq = (
-                                        ["SD1.5"]
-                                        if base in ["SD1.5", "SD1.x"]
-                                        else ["SDXL"]
-                                    )
-                                    for txt in matching_text_seq:
-                                        for p in model_path_list:
-                                            if txt in p:
-                                                model_path = p
-                                                break
-
-                                model_path = model_path.replace(comfy_directory, "")
-                                if any(
-                                    model_path.startswith(folder)
-                                    for folder in comfy_model_folders
-                                ):
-                                    model_path = model_path.split(os.path.sep, 1)[-1]
-                                app_logger.log(
-                                    LoggingType.DEBUG,
-                                    f"Updating {input} to {model_path}",
-                                )
-                                workflow[node]["inputs"][key] = model_path
-
             # get the result
             app_logger.log(LoggingType.INFO, "Generating output please wait")
             client_id = client_id or str(uuid.uuid4())
-            ws = websocket.WebSocket()
-            host = SERVER_ADDR + ":" + str(APP_PORT)
-            host = host.replace("http://", "").replace("https://", "")
-            ws.connect("ws://{}/ws?clientId={}".format(host, client_id))
-            node_output = self.get_output(ws, workflow, client_id, output_node_ids)
+            port = self.port
+            self._begin_generation(port)
+            try:
+                ws = self.connect_ws(client_id, port)
+                node_output = self.get_output(
+                    ws, workflow, client_id, output_node_ids, ComfyAPI(SERVER_ADDR, port)
+                )
+            finally:
+                self._end_generation(port)
             output_list = []
             for file in node_output["file_list"]:
-                path = find_file_in_directory("./ComfyUI/output", file)
+                path = find_file_in_directory(self.output_dir, file)
                 # some intermediary temp files are deleted at this point
                 if path:
                     output_list.append(
@@ -631,7 +1231,7 @@ class ComfyRunner:
             app_logger.log(
                 LoggingType.DEBUG, f"output file list len: {len(output_list)}"
             )
-            clear_directory("./ComfyUI/output")
+            clear_directory(self.output_dir)
 
             output_list = {
                 "file_paths": output_list,
@@ -664,6 +1264,8 @@ class ComfyRunner:
         ignore_model_list=[],
         client_id=None,
         comfy_commit_hash=None,
+        force_bootstrap=False,
+        lock_file_path=ENV_LOCK_FILE_PATH,
     ):
         """
         workflow_input:                 API json of the workflow. Can be a filepath or str
@@ -677,161 +1279,26 @@ class ComfyRunner:
         ignore_model_list:              these models won't be downloaded (in cases where these are manually placed)
         client_id:                      this can be used as a tag for the generations
         comfy_commit_hash:              specific comfy commit to checkout
+        force_bootstrap:                re-verify the comfy setup even if nothing changed since the last run
+        lock_file_path:                 where the environment lock of the setup is saved (None to skip it)
         """
         output_list = {}
         try:
-            # TODO: add support for image and normal json files
-            workflow = self.load_workflow(workflow_input)
-            if not workflow:
-                app_logger.log(LoggingType.ERROR, "Invalid workflow file")
-                return
-
-            # cloning comfy repo
-            app_logger.log(LoggingType.DEBUG, "cloning comfy repo")
-            comfy_repo_url = "https://github.com/shadel/ComfyUI_setup"
-            comfy_manager_url = "https://github.com/ltdrdata/ComfyUI-Manager"
-            if not os.path.exists(COMFY_BASE_PATH):
-                comfy_repo = Repo.clone_from(comfy_repo_url, COMFY_BASE_PATH)
-
-            if comfy_commit_hash is not None:
-                try:
-                    comfy_repo = Repo(COMFY_BASE_PATH)
-                    current_hash = comfy_repo.rev_parse("HEAD")
-                    if str(current_hash) == comfy_commit_hash:
-                        app_logger.log(
-                            LoggingType.DEBUG,
-                            f"ComfyUI at stable commit hash",
-                        )
-                    else:
-                        app_logger.log(
-                            LoggingType.DEBUG,
-                            f"Moving ComfyUI to commit {comfy_commit_hash}",
-                        )
-                        comfy_repo.git.checkout(comfy_commit_hash)
-                except Exception as e:
-                    print("unable to checkout Comfy, aborting")
-                    return None
-
-            if not os.path.exists(COMFY_BASE_PATH + "custom_nodes/ComfyUI-Manager"):
-                os.chdir(COMFY_BASE_PATH + "custom_nodes/")
-                Repo.clone_from(comfy_manager_url, "ComfyUI-Manager")
-                os.chdir("../../")
-
-            # installing requirements
-            app_logger.log(
-                LoggingType.DEBUG, "Checking comfy requirements, please wait..."
-            )
-            subprocess.run(
-                ["pip", "install", "-r", COMFY_BASE_PATH + "requirements.txt"],
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-                check=True,
+            workflow = self.prepare_workflow(
+                workflow_input,
+                file_path_list,
+                extra_models_list,
+                extra_node_urls,
+                ignore_model_list,
+                comfy_commit_hash,
+                comfy_repo_url="https://github.com/shadel/ComfyUI_setup",
+                force_bootstrap=force_bootstrap,
             )
-
-            # clearing the previous logs
-            if not self.is_server_running():
-                self.clear_comfy_logs()
-
-            # start the comfy server if not already running
-            self.start_server()
-
-            # download custom nodes
-            res_custom_nodes = self.download_custom_nodes(workflow, extra_node_urls)
-            if not res_custom_nodes["status"]:
-                app_logger.log(LoggingType.ERROR, res_custom_nodes["message"])
-                return
-
-            # download models if not already present
-            res_models = self.download_models(
-                workflow, extra_models_list, ignore_model_list
-            )
-            if not res_models["status"]:
-                app_logger.log(LoggingType.ERROR, res_models["message"])
-                if len(res_models["data"]["models_not_found"]):
-                    app_logger.log(
-                        LoggingType.INFO,
-                        "Please provide custom model urls for the models listed below or modify the workflow json to one of the alternative models listed",
-                    )
-                    for model in res_models["data"]["models_not_found"]:
-                        print("Model: ", model["model"])
-                        print("Alternatives: ")
-                        if len(model["similar_models"]):
-                            for alternative in model["similar_models"]:
-                                print(" - ", alternative)
-                        else:
-                            print(" - None")
-                        print("---------------------------")
+            if not workflow:
                 return
 
-            # restart the server if custom nodes or models are installed
-            if (
-                res_custom_nodes["data"]["nodes_installed"]
-                or res_models["data"]["models_downloaded"]
-            ):
-                app_logger.log(LoggingType.INFO, "Restarting the server")
-                self.stop_server()
-                self.start_server()
-
-            if len(file_path_list):
-                clear_directory("./ComfyUI/input")
-                for filepath in file_path_list:
-                    if isinstance(filepath, str):
-                        filepath, dest_path = filepath, "./ComfyUI/input/"
-                    else:
-                        filepath, dest_path = (
-                            filepath["filepath"],
-                            "./ComfyUI/input/" + filepath["dest_folder"] + "/",
-                        )
-                    copy_files(filepath, dest_path, overwrite=True)
-
-            # checkpoints, lora, default etc..
-            comfy_directory = COMFY_BASE_PATH + "models/"
-            comfy_model_folders = [
-                folder
-                for folder in os.listdir(comfy_directory)
-                if os.path.isdir(os.path.join(comfy_directory, folder))
-            ]
-            # update model paths e.g. 'v3_sd15_sparsectrl_rgb.ckpt' --> 'SD1.5/animatediff/v3_sd15_sparsectrl_rgb.ckpt'
-            for node in workflow:
-                if "inputs" in workflow[node]:
-                    for key, input in workflow[node]["inputs"].items():
-                        if (
-                            isinstance(input, str)
-                            and any(input.endswith(ft) for ft in MODEL_FILETYPES)
-                            and not any(input.endswith(m) for m in OPTIONAL_MODELS)
-                        ):
-                            base = None
-                            # if os.path.sep in input:
-                            base, input = os.path.split(input)
-                            model_path_list = find_file_in_directory(
-                                comfy_directory, input
-                            )
-                            if len(model_path_list):
-                                # selecting the model_path which has the base, if neither has the base then selecting the first one
-                                model_path = model_path_list[0]
-                                if base:
-                                    matching_text_seq = (
-                                        ["SD1.5"]
-                                        if base in ["SD1.5", "SD1.x"]
-                                        else ["SDXL"]
-                                    )
-                                    for txt in matching_text_seq:
-                                        for p in model_path_list:
-                                            if txt in p:
-                                                model_path = p
-                                                break
-
-                                model_path = model_path.replace(comfy_directory, "")
-                                if any(
-                                    model_path.startswith(folder)
-                                    for folder in comfy_model_folders
-                                ):
-                                    model_path = model_path.split(os.path.sep, 1)[-1]
-                                app_logger.log(
-                                    LoggingType.DEBUG,
-                                    f"Updating {input} to {model_path}",
-                                )
-                                workflow[node]["inputs"][key] = model_path
+            if lock_file_path:
+                self.create_lock(lock_file_path)
 
             # get the result
             app_logger.log(LoggingType.INFO, "Finish setup workflow")
@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import git
+
+from ..utils.git_cache import GitCache
+
+AUTHOR = git.Actor("test", "test@example.com")
+
+
+class GitCacheTest(unittest.TestCase):
+    """
+    clones through the mirror of a local 'file://' repo (no network)
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.upstream = git.Repo.init(os.path.join(self.tmp_dir, "upstream"), initial_branch="main")
+        self.url = "file://" + self.upstream.working_dir
+        self.first = self.commit("a.py", "a = 1\n")
+        self.second = self.commit("a.py", "a = 2\n")
+        self.git_cache = GitCache(cache_path=os.path.join(self.tmp_dir, "cache"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def commit(self, filename, content):
+        with open(os.path.join(self.upstream.working_dir, filename), "w") as f:
+            f.write(content)
+        self.upstream.index.add([filename])
+        return self.upstream.index.commit(f"update {filename}", author=AUTHOR, committer=AUTHOR).hexsha
+
+    def dest(self, name):
+        return os.path.join(self.tmp_dir, "clones", name)
+
+    def test_clone_without_pin(self):
+        repo = self.git_cache.clone(self.url, self.dest("latest"))
+        self.assertEqual(repo.head.commit.hexsha, self.second)
+        self.assertEqual(repo.remote("origin").url, self.url)
+
+    def test_pinned_clone(self):
+        repo = self.git_cache.clone(self.url, self.dest("pinned"), commit_hash=self.first)
+        self.assertEqual(repo.head.commit.hexsha, self.first)
+        with open(os.path.join(self.dest("pinned"), "a.py")) as f:
+            self.assertEqual(f.read(), "a = 1\n")
+
+    def test_short_hash(self):
+        repo = self.git_cache.clone(self.url, self.dest("short"), commit_hash=self.first[:7])
+        self.assertEqual(repo.head.commit.hexsha, self.first)
+
+    def test_tag(self):
+        self.upstream.create_tag("v1", ref=self.first)
+        repo = self.git_cache.clone(self.url, self.dest("tag"), commit_hash="v1")
+        self.assertEqual(repo.head.commit.hexsha, self.first)
+
+    def test_clone_after_upstream_update(self):
+        self.git_cache.clone(self.url, self.dest("before"))
+        third = self.commit("b.py", "b = 1\n")
+
+        # pinned to a commit the mirror doesn't have yet, by its short hash
+        repo = self.git_cache.clone(self.url, self.dest("pinned"), commit_hash=third[:8])
+        self.assertEqual(repo.head.commit.hexsha, third)
+
+        repo = self.git_cache.clone(self.url, self.dest("latest"))
+        self.assertEqual(repo.head.commit.hexsha, third)
+
+    def test_pull_refs_not_mirrored(self):
+        self.upstream.git.update_ref("refs/pull/1/head", self.first)
+        self.git_cache.update_mirror(self.url)
+        mirror = git.Repo(self.git_cache.mirror_path(self.url))
+        refs = mirror.git.for_each_ref("--format=%(refname)").splitlines()
+        self.assertIn("refs/heads/main", refs)
+        self.assertNotIn("refs/pull/1/head", refs)
+
+    def test_old_mirror_refs_removed(self):
+        # mirrors created with --mirror fetched every ref
+        self.upstream.git.update_ref("refs/pull/1/head", self.first)
+        mirror = git.Repo.clone_from(self.url, self.git_cache.mirror_path(self.url), mirror=True)
+        self.assertIn("refs/pull/1/head", mirror.git.for_each_ref("--format=%(refname)"))
+
+        self.git_cache.update_mirror(self.url)
+        self.assertNotIn("refs/pull/1/head", mirror.git.for_each_ref("--format=%(refname)"))
+        self.assertEqual(
+            mirror.git.config("--get-all", "remote.origin.fetch").splitlines(),
+            ["+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"],
+        )
+
+    def test_unknown_commit_cleans_up(self):
+        dest = self.dest("missing")
+        with self.assertRaises(Exception):
+            self.git_cache.clone(self.url, dest, commit_hash="0" * 40)
+        self.assertFalse(os.path.exists(dest))
+
+        with self.assertRaises(ValueError):
+            self.git_cache.clone(self.url, dest, commit_hash="deadbee")
+        self.assertFalse(os.path.exists(dest))
+
+
+if __name__ == "__main__":
+    unittest.main()
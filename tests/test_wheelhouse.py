@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import zipfile
+
+from ..utils.wheelhouse import Wheelhouse, WheelhouseError
+
+PACKAGE = "comfy_runner_offline_probe"
+
+
+def make_wheel(wheel_dir, name=PACKAGE, version="1.0"):
+    # minimal pure python wheel, built by hand so that nothing (setuptools..) is downloaded
+    dist_info = f"{name}-{version}.dist-info"
+    files = {
+        f"{name}/__init__.py": "VALUE = 1\n",
+        f"{dist_info}/METADATA": f"Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n",
+        f"{dist_info}/WHEEL": "Wheel-Version: 1.0\nGenerator: test\nRoot-Is-Purelib: true\nTag: py3-none-any\n",
+    }
+    files[f"{dist_info}/RECORD"] = "".join(f"{path},,\n" for path in files) + f"{dist_info}/RECORD,,\n"
+    with zipfile.ZipFile(os.path.join(wheel_dir, f"{name}-{version}-py3-none-any.whl"), "w") as wheel:
+        for path, content in files.items():
+            wheel.writestr(path, content)
+
+
+class OfflineWheelhouseTest(unittest.TestCase):
+    """
+    installs into a --target folder with the index pointed to an unreachable address, anything
+    not served by the wheelhouse can't be installed
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.wheel_dir = os.path.join(self.tmp_dir, "wheels")
+        self.target = os.path.join(self.tmp_dir, "site")
+        os.makedirs(self.wheel_dir)
+        make_wheel(self.wheel_dir)
+        unreachable = {"PIP_INDEX_URL": "http://127.0.0.1:9/simple", "PIP_RETRIES": "0", "PIP_TIMEOUT": "1"}
+        self.env = mock.patch.dict(os.environ, unreachable)
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_installs_from_wheelhouse(self):
+        Wheelhouse(self.wheel_dir, offline=True).install(["--target", self.target, PACKAGE], quiet=True)
+        self.assertTrue(os.path.exists(os.path.join(self.target, PACKAGE, "__init__.py")))
+
+    def test_missing_wheel_fails(self):
+        with self.assertRaises(WheelhouseError) as ctx:
+            Wheelhouse(self.wheel_dir, offline=True).install(
+                ["--target", self.target, "comfy-runner-not-in-wheelhouse"], quiet=True
+            )
+        self.assertIn("comfy-runner-not-in-wheelhouse", str(ctx.exception))
+
+    def test_missing_wheelhouse_fails(self):
+        with self.assertRaises(WheelhouseError):
+            Wheelhouse(os.path.join(self.tmp_dir, "missing"), offline=True).install(
+                ["--target", self.target, PACKAGE], quiet=True
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import shutil
+import tarfile
+import zipfile
+
+from ..constants import DOWNLOAD_CHUNK_SIZE
+from .logger import LoggingType, app_logger
+
+
+class UnsafeArchiveError(Exception):
+    pass
+
+
+def get_member_path(dest, name):
+    # destination of an archive member, members that would land outside dest are rejected
+    dest = os.path.abspath(dest)
+    target = os.path.normpath(os.path.join(dest, name))
+    if os.path.isabs(name) or os.path.commonpath([dest, target]) != dest:
+        raise UnsafeArchiveError(f"archive member {name} is outside of {dest}")
+    return target
+
+
+def write_member(source, target, mode=None):
+    # written next to the target and renamed, a partially extracted member is never left in place
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_path = f"{target}.part"
+    with open(tmp_path, "wb") as f:
+        shutil.copyfileobj(source, f, DOWNLOAD_CHUNK_SIZE)
+    if mode is not None:
+        os.chmod(tmp_path, mode & 0o755)
+    os.replace(tmp_path, target)
+
+
+class ProgressReader:
+    # file object reporting the number of bytes read through it
+    def __init__(self, fileobj, progress):
+        self.fileobj = fileobj
+        self.progress = progress
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.progress(len(data))
+        return data
+
+
+def extract_tar_stream(fileobj, dest):
+    """
+    extracts a (optionally compressed) tar read sequentially from fileobj, e.g. an http body.
+    only files and directories are extracted, links and special files are skipped
+    returns the list of extracted files
+    """
+    res = []
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+        for member in tar:
+            target = get_member_path(dest, member.name)
+            if member.isdir():
+                os.makedirs(target, exist_ok=True)
+            elif member.isfile():
+                write_member(tar.extractfile(member), target, member.mode)
+                res.append(target)
+            else:
+                app_logger.log(LoggingType.DEBUG, f"skipping archive member {member.name}")
+    return res
+
+
+def extract_zip(file_path, dest):
+    """
+    returns the list of extracted files
+    """
+    res = []
+    with zipfile.ZipFile(file_path, "r") as zip_ref:
+        # checked before anything is written
+        members = [(info, get_member_path(dest, info.filename)) for info in zip_ref.infolist()]
+        for info, target in members:
+            if info.is_dir():
+                os.makedirs(target, exist_ok=True)
+                continue
+            with zip_ref.open(info) as source:
+                write_member(source, target)
+            res.append(target)
+    return res
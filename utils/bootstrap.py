@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import sys
+
+from .logger import LoggingType, app_logger
+
+
+def read_git_head(repo_path):
+    # resolves HEAD by reading the .git files directly, a lot cheaper than opening the repo
+    git_dir = os.path.join(repo_path, ".git")
+    try:
+        if os.path.isfile(git_dir):
+            # worktrees and submodules point to the real git dir
+            with open(git_dir, "r") as f:
+                git_dir = os.path.join(repo_path, f.read().strip()[len("gitdir: "):])
+
+        with open(os.path.join(git_dir, "HEAD"), "r") as f:
+            head = f.read().strip()
+        if not head.startswith("ref: "):
+            return head  # detached HEAD
+
+        ref = head[len("ref: "):]
+        ref_path = os.path.join(git_dir, ref)
+        if os.path.exists(ref_path):
+            with open(ref_path, "r") as f:
+                return f.read().strip()
+
+        packed_refs_path = os.path.join(git_dir, "packed-refs")
+        if os.path.exists(packed_refs_path):
+            with open(packed_refs_path, "r") as f:
+                for line in f:
+                    if line.strip().endswith(" " + ref):
+                        return line.split(" ")[0]
+    except OSError:
+        pass
+
+    return None
+
+
+def hash_file(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class BootstrapState:
+    """
+    fingerprint of a bootstrapped comfy setup (requirements, comfy and manager commits and
+    the interpreter). when it matches the recorded one the bootstrap can be skipped
+    """
+
+    def __init__(self, comfy_path, state_file=".comfy_runner_bootstrap.json"):
+        self.comfy_path = comfy_path
+        self.manager_path = os.path.join(comfy_path, "custom_nodes", "ComfyUI-Manager")
+        self.requirements_path = os.path.join(comfy_path, "requirements.txt")
+        self.state_path = os.path.join(comfy_path, state_file)
+
+    def load(self):
+        try:
+            with open(self.state_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def fingerprint(self, previous=None):
+        try:
+            stat = os.stat(self.requirements_path)
+        except OSError:
+            return None
+
+        # requirements are only rehashed when their size or mtime changed
+        previous_req = (previous or {}).get("requirements", {})
+        if previous_req.get("size") == stat.st_size and previous_req.get("mtime") == stat.st_mtime:
+            req_hash = previous_req["sha256"]
+        else:
+            req_hash = hash_file(self.requirements_path)
+
+        return {
+            "interpreter": sys.executable,
+            "requirements": {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": req_hash},
+            "comfy_head": read_git_head(self.comfy_path),
+            "manager_head": read_git_head(self.manager_path),
+        }
+
+    def is_current(self, comfy_commit_hash=None):
+        previous = self.load()
+        if not previous:
+            return False
+
+        current = self.fingerprint(previous)
+        if not current or not current["comfy_head"] or not current["manager_head"]:
+            return False
+
+        if comfy_commit_hash is not None and current["comfy_head"] != comfy_commit_hash:
+            return False
+
+        # only the content hash matters for the requirements
+        for key in ["interpreter", "comfy_head", "manager_head"]:
+            if current[key] != previous.get(key):
+                app_logger.log(LoggingType.DEBUG, f"bootstrap state changed: {key}")
+                return False
+        if current["requirements"]["sha256"] != previous["requirements"]["sha256"]:
+            app_logger.log(LoggingType.DEBUG, "bootstrap state changed: requirements")
+            return False
+
+        # requirements touched but not changed, recording the new mtime to skip the rehash
+        if current["requirements"] != previous["requirements"]:
+            self._write(current)
+        return True
+
+    def _write(self, state):
+        with open(self.state_path, "w") as f:
+            json.dump(state, f, indent=4)
+
+    def save(self):
+        state = self.fingerprint(self.load())
+        if state:
+            self._write(state)
+
+    def clear(self):
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
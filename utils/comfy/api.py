@@ -1,4 +1,5 @@
 import json
+import threading
 import requests
 
 
@@ -52,12 +53,23 @@ class ComfyAPI(BaseAPI):
         super().__init__(base_url=f"{server_addr}:{port}")
         self.server_addr = server_addr
         self.port = port
+        self.switch_lock = threading.Lock()
 
         self._set_urls()
 
-    def _set_urls(self):
-        self.SERVER_URL = f"{self.server_addr}:{self.port}"
+    # NOTE: base_url is the only attribute holding the server, it is replaced in a single
+    # assignment so readers (which don't take the lock) use either the old or the new server
+    def switch_server(self, server_addr, port):
+        with self.switch_lock:
+            self.server_addr = server_addr
+            self.port = port
+            self.base_url = f"{server_addr}:{port}"
+
+    @property
+    def SERVER_URL(self):
+        return self.base_url
 
+    def _set_urls(self):
         self.QUEUE_PROMPT_URL = "/prompt"
         self.HISTORY_URL = "/history"
         self.CUSTOM_NODE_LIST_URL = "/customnode/getlist"
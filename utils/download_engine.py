@@ -0,0 +1,554 @@
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from tqdm import tqdm
+
+from ..constants import (
+    DOWNLOAD_BANDWIDTH_LIMIT,
+    DOWNLOAD_CHUNK_SIZE,
+    DOWNLOAD_HOST_CONNECTIONS,
+    DOWNLOAD_MIN_SEGMENT_SIZE,
+    DOWNLOAD_SEGMENTS,
+    DOWNLOAD_STATE_INTERVAL,
+    DOWNLOAD_TIMEOUT,
+)
+from .archive import ProgressReader, extract_tar_stream, extract_zip
+from .logger import LoggingType, app_logger
+
+SEGMENT_RETRIES = 3
+
+
+class DownloadError(Exception):
+    pass
+
+
+def preallocate(fd, size):
+    # reserves the blocks up front (no fragmentation, fails early if the disk is full)
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size)
+
+
+def sync(fd):
+    getattr(os, "fdatasync", os.fsync)(fd)
+
+
+_seek_lock = threading.Lock()
+
+
+def write_at(fd, data, offset):
+    if hasattr(os, "pwrite"):
+        os.pwrite(fd, data, offset)
+    else:
+        # windows has no pwrite, the seek and the write must not interleave between threads
+        with _seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, data)
+
+
+def read_at(fd, size, offset):
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    # same as write_at, the file offset is shared with the writers
+    with _seek_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+class SegmentHasher:
+    """
+    sha256 of a file whose segments are written in parallel. a thread hashes the bytes as soon as
+    every byte before them is written, reading them back while they are still in the page cache,
+    so the complete file doesn't have to be read again
+    """
+
+    def __init__(self, fd, segments, chunk_size=DOWNLOAD_CHUNK_SIZE, interval=0.2):
+        """
+        segments:   [start, end (inclusive), bytes written] updated by the segment workers
+        interval:   how often (in secs) the written part of the file is checked
+        """
+        self.fd = fd
+        self.segments = segments
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.sha256 = hashlib.sha256()
+        self.offset = 0
+        self.finished = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _written_prefix(self):
+        # end of the part of the file written without gaps
+        end = 0
+        for start, segment_end, written in self.segments:
+            if start != end:
+                break
+            end = start + written
+            if end <= segment_end:
+                break
+        return end
+
+    def _run(self):
+        while True:
+            # checked before hashing so that the last pass sees every byte
+            finished = self.finished.is_set()
+            end = self._written_prefix()
+            while self.offset < end:
+                data = read_at(self.fd, min(self.chunk_size, end - self.offset), self.offset)
+                if not data:
+                    break
+                self.sha256.update(data)
+                self.offset += len(data)
+            if finished:
+                return
+            self.finished.wait(self.interval)
+
+    def start(self):
+        self.thread.start()
+
+    def finish(self, total_size):
+        # returns the sha256, None if the file isn't complete
+        self.finished.set()
+        self.thread.join()
+        return self.sha256.hexdigest() if self.offset == total_size else None
+
+
+class TokenBucket:
+    # limits the rate of consume calls to rate bytes/sec (with bursts of up to a sec), 0 disables it
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.allowance = rate
+        self.last = time.monotonic()
+
+    def consume(self, size):
+        if not self.rate:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= size
+            delay = -self.allowance / self.rate if self.allowance < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class TransferControl:
+    """
+    shared by all the downloads of the process: the number of connections open to each host,
+    the global bandwidth cap and the aggregated progress of the running downloads
+    """
+
+    def __init__(self, host_connections=DOWNLOAD_HOST_CONNECTIONS, bandwidth_limit=DOWNLOAD_BANDWIDTH_LIMIT):
+        self.host_connections = host_connections
+        self.bandwidth = TokenBucket(bandwidth_limit)
+        self.lock = threading.Lock()
+        self.host_semaphores = {}  # host -> semaphore
+        self.active = 0
+        # totals since the process started, progress is measured between two snapshots of them
+        self.total = 0
+        self.downloaded = 0
+        self.batch_start = self.snapshot()
+
+    def snapshot(self):
+        return {"downloaded": self.downloaded, "total": self.total, "time": time.monotonic()}
+
+    @contextmanager
+    def connection(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(self.host_connections)
+            semaphore = self.host_semaphores[host]
+        with semaphore:
+            yield
+
+    @contextmanager
+    def transfer(self):
+        with self.lock:
+            if not self.active:
+                self.batch_start = self.snapshot()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def add_total(self, size):
+        with self.lock:
+            self.total += size
+
+    def update(self, size):
+        self.bandwidth.consume(size)
+        with self.lock:
+            self.downloaded += size
+
+    def get_progress(self, since=None):
+        """
+        since:  a snapshot taken before, by default the progress is counted from the first of
+                the downloads running now
+        returns {'active', 'downloaded', 'total', 'speed', 'eta'} (bytes, bytes/sec and secs),
+        total only counts the downloads whose size is known
+        """
+        with self.lock:
+            start = since or self.batch_start
+            now = self.snapshot()
+            downloaded = now["downloaded"] - start["downloaded"]
+            total = now["total"] - start["total"]
+            elapsed = now["time"] - start["time"]
+            speed = downloaded / elapsed if elapsed > 0 else 0
+            return {
+                "active": self.active,
+                "downloaded": downloaded,
+                "total": total,
+                "speed": speed,
+                "eta": max(0, total - downloaded) / speed if speed else None,
+            }
+
+
+shared_transfer_control = TransferControl()
+
+
+class DownloadEngine:
+    """
+    downloads large files over several connections (http range requests), every segment is
+    written at its offset of a preallocated file. servers that don't support ranges are
+    downloaded over a single stream
+
+    files are written to '<file_path>.part' and renamed to file_path once complete. the progress
+    of ranged downloads is saved to '<file_path>.part.json' (etag / last-modified and the bytes
+    written per segment), an interrupted download resumes from there if the file on the server
+    is still the same
+    """
+
+    def __init__(
+        self,
+        segments=DOWNLOAD_SEGMENTS,
+        min_segment_size=DOWNLOAD_MIN_SEGMENT_SIZE,
+        chunk_size=DOWNLOAD_CHUNK_SIZE,
+        timeout=DOWNLOAD_TIMEOUT,
+        state_interval=DOWNLOAD_STATE_INTERVAL,
+        transfer_control=None,
+    ):
+        """
+        segments:           max parallel connections per file
+        min_segment_size:   files are only split if every segment gets at least this many bytes
+        chunk_size:         size of the reads from the connections
+        timeout:            connect/read timeout (in secs) of the requests
+        state_interval:     how often (in secs) the progress of ranged downloads is saved
+        transfer_control:   host connection limits and bandwidth cap, shared by the process if not given
+        """
+        self.segments = segments
+        self.min_segment_size = min_segment_size
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.state_interval = state_interval
+        self.transfer_control = transfer_control or shared_transfer_control
+
+    def probe(self, url, headers={}):
+        """
+        asks for the first byte, returns (response, final url, total size, ranges supported).
+        the response is still open, it holds the whole body if ranges are not supported
+        """
+        with self.transfer_control.connection(url):
+            response = requests.get(
+                url, headers={**headers, "Range": "bytes=0-0"}, stream=True, timeout=self.timeout
+            )
+        # the first byte of an empty file can't be asked for, some servers answer 416 to it
+        empty = response.status_code == 416 and re.match(
+            r"bytes \*/0$", response.headers.get("content-range", "").strip()
+        )
+        if not empty:
+            response.raise_for_status()
+
+        if response.status_code == 206 or empty:
+            match = re.match(r"bytes \d+-\d+/(\d+)", response.headers.get("content-range", ""))
+            if match:
+                return response, response.url, int(match.group(1)), True
+
+            # unknown total size (or empty file), starting over without the range header
+            response.close()
+            with self.transfer_control.connection(url):
+                response = requests.get(url, headers=headers, stream=True, timeout=self.timeout)
+            response.raise_for_status()
+
+        total_size = int(response.headers.get("content-length", 0)) if response.status_code == 200 else 0
+        return response, response.url, total_size, False
+
+    @staticmethod
+    def _get_validators(response):
+        return {
+            "etag": response.headers.get("etag"),
+            "last_modified": response.headers.get("last-modified"),
+        }
+
+    @staticmethod
+    def _if_range(validators):
+        # weak etags can't be used in If-Range
+        etag = validators.get("etag")
+        if etag and not etag.startswith("W/"):
+            return etag
+        return validators.get("last_modified")
+
+    @staticmethod
+    def _load_state(state_path):
+        try:
+            with open(state_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _save_state(state_path, state):
+        tmp_path = f"{state_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, state_path)
+
+    @staticmethod
+    def _remove(*path_list):
+        for path in path_list:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _split(self, total_size):
+        count = max(1, min(self.segments, total_size // max(self.min_segment_size, 1)))
+        segment_size = total_size // count
+        # [start, end (inclusive), bytes written]
+        return [
+            [i * segment_size, total_size - 1 if i == count - 1 else (i + 1) * segment_size - 1, 0]
+            for i in range(count)
+        ]
+
+    def _download_segment(self, url, fd, segment, progress, headers, stop_event):
+        start, end, _ = segment
+        for attempt in range(SEGMENT_RETRIES):
+            if stop_event.is_set():
+                return
+            offset = start + segment[2]
+            if offset > end:
+                return
+            try:
+                # the connection counts towards the host limit until the segment is read
+                with self.transfer_control.connection(url):
+                    response = requests.get(
+                        url,
+                        headers={**headers, "Range": f"bytes={offset}-{end}"},
+                        stream=True,
+                        timeout=self.timeout,
+                    )
+                    if response.status_code != 206:
+                        # If-Range answers with the whole file (200) when it changed on the server
+                        response.close()
+                        raise DownloadError(f"range request failed with status {response.status_code}")
+
+                    with response:
+                        for data in response.iter_content(chunk_size=self.chunk_size):
+                            data = data[: end - offset + 1]
+                            write_at(fd, data, offset)
+                            offset += len(data)
+                            segment[2] += len(data)
+                            progress(len(data))
+                            if offset > end or stop_event.is_set():
+                                break
+
+                if stop_event.is_set():
+                    return
+
+                if offset > end:
+                    return
+                raise DownloadError(f"connection closed at byte {offset} of segment {start}-{end}")
+            except (requests.RequestException, DownloadError) as e:
+                app_logger.log(
+                    LoggingType.DEBUG, f"segment {start}-{end} attempt {attempt + 1} failed: {e}"
+                )
+                if attempt == SEGMENT_RETRIES - 1:
+                    raise
+
+    def _download_segments(
+        self, url, file_path, total_size, segments, progress, headers, save_state, compute_sha256=False
+    ):
+        """
+        returns the sha256 of the file if compute_sha256 (None otherwise)
+        """
+        # O_BINARY: windows opens files in text mode by default
+        fd = os.open(file_path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+        stop_event = threading.Event()
+        hasher = None
+        try:
+            size = os.fstat(fd).st_size
+            if size > total_size:
+                os.ftruncate(fd, total_size)
+            elif size < total_size:
+                preallocate(fd, total_size)
+            if compute_sha256:
+                # the bytes already written by a previous attempt are hashed first
+                hasher = SegmentHasher(fd, segments, self.chunk_size)
+                hasher.start()
+            pending = [s for s in segments if s[0] + s[2] <= s[1]]
+            with ThreadPoolExecutor(max_workers=max(1, len(pending))) as executor:
+                futures = [
+                    executor.submit(self._download_segment, url, fd, s, progress, headers, stop_event)
+                    for s in pending
+                ]
+                try:
+                    not_done = futures
+                    while not_done:
+                        done, not_done = wait(not_done, timeout=self.state_interval, return_when=FIRST_EXCEPTION)
+                        if any(future.exception() for future in done):
+                            break
+                        # the recorded progress never exceeds what is on the disk
+                        sync(fd)
+                        save_state()
+                finally:
+                    # stops the other segments on errors (and interrupts)
+                    stop_event.set()
+                for future in futures:
+                    future.result()
+        finally:
+            try:
+                sync(fd)
+                save_state()
+            finally:
+                # the hasher reads from fd, it has to be done before fd is closed
+                sha256 = hasher.finish(total_size) if hasher else None
+                os.close(fd)
+        return sha256
+
+    def _download_stream(self, response, file_path, progress, compute_sha256=False):
+        # can't be resumed, starts over every time. returns (bytes written, sha256 or None)
+        written = 0
+        sha256 = hashlib.sha256() if compute_sha256 else None
+        with response, open(file_path, "wb", buffering=self.chunk_size) as handle:
+            for data in response.iter_content(chunk_size=self.chunk_size):
+                handle.write(data)
+                if sha256:
+                    sha256.update(data)
+                written += len(data)
+                progress(len(data))
+            handle.flush()
+            sync(handle.fileno())
+        return written, sha256.hexdigest() if sha256 else None
+
+    def download(self, url, file_path, headers={}, show_progress=True, compute_sha256=False):
+        """
+        compute_sha256:     hashes the file while it is written (no second read of the file)
+        returns (number of bytes written to file_path, sha256 of the file or None)
+        """
+        part_path = f"{file_path}.part"
+        state_path = f"{part_path}.json"
+        response, final_url, total_size, ranges = self.probe(url, headers)
+        validators = self._get_validators(response)
+        if_range = self._if_range(validators)
+
+        # resuming only if the file on the server can be checked to be the same
+        state = self._load_state(state_path) if ranges and if_range else None
+        if (
+            state
+            and state.get("url") == url
+            and state.get("total_size") == total_size
+            and state.get("validators") == validators
+            and os.path.exists(part_path)
+        ):
+            segments = state["segments"]
+        else:
+            segments = self._split(total_size) if ranges else None
+            self._remove(part_path, state_path)
+
+        initial = sum(s[2] for s in segments) if segments else 0
+        progress_bar = tqdm(
+            total=total_size, initial=initial, unit="B", unit_scale=True, disable=not show_progress
+        )
+        progress_lock = threading.Lock()
+
+        def progress(size):
+            # throttled by the bandwidth cap before the next read
+            self.transfer_control.update(size)
+            with progress_lock:
+                progress_bar.update(size)
+
+        def save_state():
+            self._save_state(
+                state_path,
+                {"url": url, "total_size": total_size, "validators": validators, "segments": segments},
+            )
+
+        try:
+            with self.transfer_control.transfer():
+                self.transfer_control.add_total(total_size - initial)
+                if ranges:
+                    response.close()
+                    if initial:
+                        app_logger.log(LoggingType.INFO, f"resuming {file_path} from {initial} of {total_size} bytes")
+                    app_logger.log(
+                        LoggingType.DEBUG, f"downloading {total_size} bytes over {len(segments)} connection(s)"
+                    )
+                    range_headers = {**headers, "If-Range": if_range} if if_range else headers
+                    sha256 = self._download_segments(
+                        final_url, part_path, total_size, segments, progress, range_headers,
+                        save_state if if_range else lambda: None, compute_sha256,
+                    )
+                    written = total_size
+                else:
+                    with self.transfer_control.connection(url):
+                        written, sha256 = self._download_stream(response, part_path, progress, compute_sha256)
+        finally:
+            progress_bar.close()
+
+        # the file only appears at its final path once complete
+        os.replace(part_path, file_path)
+        self._remove(state_path)
+        return written, sha256
+
+    def download_archive(self, url, dest, headers={}, show_progress=True, archive_format=None):
+        """
+        extracts a .tar (optionally compressed) or .zip into dest without keeping the archive.
+        tars are extracted while the body is read, zips need to be seekable so they are
+        downloaded to dest first (resumable) and removed after the extraction
+
+        archive_format:     'zip' or 'tar', taken from the url if not given
+        returns the list of extracted files
+        """
+        os.makedirs(dest, exist_ok=True)
+        url_path = urlparse(url).path
+        if archive_format is None:
+            archive_format = "zip" if url_path.endswith(".zip") else "tar"
+
+        if archive_format == "zip":
+            spill_path = os.path.join(dest, f".{os.path.basename(url_path) or 'archive.zip'}")
+            self.download(url, spill_path, headers, show_progress)
+            try:
+                return extract_zip(spill_path, dest)
+            finally:
+                os.remove(spill_path)
+
+        progress_bar = tqdm(unit="B", unit_scale=True, disable=not show_progress)
+
+        def progress(size):
+            self.transfer_control.update(size)
+            progress_bar.update(size)
+
+        try:
+            with self.transfer_control.transfer(), self.transfer_control.connection(url):
+                response = requests.get(url, headers=headers, stream=True, timeout=self.timeout)
+                response.raise_for_status()
+                total_size = int(response.headers.get("content-length", 0))
+                progress_bar.total = total_size
+                self.transfer_control.add_total(total_size)
+                with response:
+                    # transfer encodings (gzip..) are decoded, tar compression is handled by tarfile
+                    response.raw.decode_content = True
+                    return extract_tar_stream(ProgressReader(response.raw, progress), dest)
+        finally:
+            progress_bar.close()
@@ -0,0 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from tqdm import tqdm
+
+from ..constants import DOWNLOAD_WORKERS
+from .download_engine import shared_transfer_control
+from .logger import LoggingType, app_logger
+
+
+class DownloadScheduler:
+    """
+    runs a batch of downloads at the same time. the connections per host and the bandwidth are
+    limited by the TransferControl shared with the DownloadEngines, the progress of the whole
+    batch is shown as a single bar (with its eta)
+    """
+
+    def __init__(self, max_workers=DOWNLOAD_WORKERS, transfer_control=shared_transfer_control, show_progress=True):
+        """
+        max_workers:        files downloaded at the same time
+        transfer_control:   the one used by the DownloadEngines running the downloads
+        show_progress:      aggregated progress bar, the tasks shouldn't show their own
+        """
+        self.max_workers = max_workers
+        self.transfer_control = transfer_control
+        self.show_progress = show_progress
+        self.start = None
+
+    def get_progress(self):
+        # {'active', 'downloaded', 'total', 'speed', 'eta'} of the batch being run
+        return self.transfer_control.get_progress(self.start)
+
+    def run(self, task_list):
+        """
+        task_list:  callables each running a download
+        returns their results in the same order, the first exception is raised once all the
+        tasks are done
+        """
+        if not len(task_list):
+            return []
+
+        self.start = self.transfer_control.snapshot()
+        progress_bar = tqdm(total=0, unit="B", unit_scale=True, disable=not self.show_progress)
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [executor.submit(task) for task in task_list]
+                not_done = futures
+                while not_done:
+                    _, not_done = wait(not_done, timeout=1)
+                    progress = self.get_progress()
+                    progress_bar.total = progress["total"]
+                    progress_bar.update(progress["downloaded"] - progress_bar.n)
+
+            progress = self.get_progress()
+            app_logger.log(
+                LoggingType.DEBUG,
+                f"downloaded {progress['downloaded']} bytes in {len(task_list)} task(s)",
+            )
+            return [future.result() for future in futures]
+        finally:
+            progress_bar.close()
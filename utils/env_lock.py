@@ -0,0 +1,175 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from importlib import metadata
+
+from ..constants import MODEL_FILETYPES
+from .bootstrap import read_git_head
+from .logger import LoggingType, app_logger
+
+
+def pip_freeze():
+    res = subprocess.run(
+        [sys.executable, "-m", "pip", "freeze"], capture_output=True, text=True, check=True
+    )
+    return [line.strip() for line in res.stdout.splitlines() if line.strip()]
+
+
+def read_git_remote_url(repo_path, remote="origin"):
+    # parses .git/config directly, opening the repo is a lot slower
+    try:
+        with open(os.path.join(repo_path, ".git", "config"), "r") as f:
+            config = f.read()
+    except OSError:
+        return None
+
+    section = re.search(
+        r'\[remote "' + re.escape(remote) + r'"\]([^\[]*)', config
+    )
+    if not section:
+        return None
+    url = re.search(r"^\s*url\s*=\s*(.+)$", section.group(1), re.MULTILINE)
+    return url.group(1).strip() if url else None
+
+
+def normalize_package_name(name):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+class EnvironmentLock:
+    """
+    snapshot of a provisioned comfy setup: the comfy commit, the url and commit of every
+    custom node, the models (path, size and source url) and the pip packages installed on
+    top of the base environment. a fresh worker can be provisioned straight from it
+    """
+
+    def __init__(self, comfy_path, data=None):
+        self.comfy_path = comfy_path
+        self.data = data or {}
+
+    @staticmethod
+    def pip_baseline_path(comfy_path):
+        return os.path.join(comfy_path, ".comfy_runner_pip_baseline.txt")
+
+    @staticmethod
+    def save_pip_baseline(comfy_path):
+        # packages present before comfy and the nodes were installed
+        baseline_path = EnvironmentLock.pip_baseline_path(comfy_path)
+        if not os.path.exists(baseline_path):
+            with open(baseline_path, "w") as f:
+                f.write("\n".join(pip_freeze()))
+
+    def _pip_delta(self):
+        baseline = set()
+        baseline_path = self.pip_baseline_path(self.comfy_path)
+        if os.path.exists(baseline_path):
+            with open(baseline_path, "r") as f:
+                baseline = set(line.strip() for line in f)
+
+        return [pkg for pkg in pip_freeze() if pkg not in baseline]
+
+    def _custom_nodes(self):
+        custom_nodes_path = os.path.join(self.comfy_path, "custom_nodes")
+        nodes = []
+        for entry in sorted(os.listdir(custom_nodes_path)):
+            node_path = os.path.join(custom_nodes_path, entry)
+            if not os.path.exists(os.path.join(node_path, ".git")):
+                continue
+
+            nodes.append(
+                {
+                    "name": entry,
+                    "url": read_git_remote_url(node_path),
+                    "commit": read_git_head(node_path),
+                }
+            )
+        return nodes
+
+    def _models(self, get_model_url):
+        models_path = os.path.join(self.comfy_path, "models")
+        models = []
+        for root, dirs, files in os.walk(models_path, followlinks=True):
+            for file in sorted(files):
+                if not any(file.endswith(ft) for ft in MODEL_FILETYPES):
+                    continue
+
+                file_path = os.path.join(root, file)
+                models.append(
+                    {
+                        "path": os.path.relpath(file_path, self.comfy_path),
+                        "size": os.path.getsize(file_path),
+                        "url": get_model_url(file),
+                    }
+                )
+        return models
+
+    def create(self, get_model_url=lambda filename: None):
+        """
+        get_model_url: returns the source url of a model filename (None if unknown)
+        """
+        self.data = {
+            "created_at": time.time(),
+            "comfy": {
+                "url": read_git_remote_url(self.comfy_path),
+                "commit": read_git_head(self.comfy_path),
+            },
+            "custom_nodes": self._custom_nodes(),
+            "models": self._models(get_model_url),
+            "pip": self._pip_delta(),
+        }
+
+        missing_urls = [m["path"] for m in self.data["models"] if not m["url"]]
+        if missing_urls:
+            app_logger.log(
+                LoggingType.WARNING,
+                f"Source url unknown for {len(missing_urls)} model(s), they can't be restored from the lock",
+            )
+        return self.data
+
+    def save(self, lock_file_path):
+        with open(lock_file_path, "w") as f:
+            json.dump(self.data, f, indent=4)
+
+    @classmethod
+    def load(cls, comfy_path, lock_file_path):
+        with open(lock_file_path, "r") as f:
+            return cls(comfy_path, json.load(f))
+
+    def verify(self):
+        """
+        fast check of the worker against the lock (git HEADs, model sizes and package versions),
+        returns a list of mismatches
+        """
+        mismatches = []
+        if read_git_head(self.comfy_path) != self.data["comfy"]["commit"]:
+            mismatches.append("comfy commit")
+
+        for node in self.data["custom_nodes"]:
+            node_path = os.path.join(self.comfy_path, "custom_nodes", node["name"])
+            if read_git_head(node_path) != node["commit"]:
+                mismatches.append(f"custom node {node['name']}")
+
+        for model in self.data["models"]:
+            model_path = os.path.join(self.comfy_path, model["path"])
+            try:
+                if os.path.getsize(model_path) != model["size"]:
+                    mismatches.append(f"model {model['path']} size")
+            except OSError:
+                mismatches.append(f"model {model['path']} missing")
+
+        installed = {
+            normalize_package_name(dist.metadata["Name"]): dist.version
+            for dist in metadata.distributions()
+            if dist.metadata["Name"]
+        }
+        for pkg in self.data["pip"]:
+            if "==" not in pkg:
+                continue  # vcs / local installs can't be checked without pip
+            name, version = pkg.split("==", 1)
+            if installed.get(normalize_package_name(name)) != version:
+                mismatches.append(f"package {pkg}")
+
+        return mismatches
@@ -1,17 +1,32 @@
 from enum import Enum
 import os
+import sqlite3
+import threading
 
-import requests
-import tarfile
-import zipfile
-import json
-from tqdm import tqdm
 from ..constants import APP_PORT, COMFY_BASE_PATH, COMFY_MODEL_PATH_LIST, SERVER_ADDR
 from .comfy.api import ComfyAPI
 
-from .common import find_git_root, convert_to_relative_path, fuzzy_text_match, get_default_save_path, get_file_size, search_file
+from .download_engine import DownloadEngine
+from .integrity import HashCache
+from .model_catalog import ModelCatalog
+from .model_store import ModelStore
+from .trigram_index import TrigramIndex
+from .common import get_default_save_path, get_file_size, search_file
 from .logger import LoggingType, app_logger
 
+def get_model_key(file_path):
+    # path relative to the models folder, e.g. 'clip_vision/SD1.5/pytorch_model.bin'
+    models_path = os.path.abspath(os.path.join(COMFY_BASE_PATH, "models"))
+    return os.path.relpath(os.path.abspath(file_path), models_path).replace(os.sep, "/")
+
+
+def get_save_path(model):
+    # save_path of a comfy model list entry
+    if model["save_path"] and model["save_path"].endswith("default"):
+        return get_default_save_path(model["type"])
+    return model["save_path"]
+
+
 class FileStatus(Enum):
     NEW_DOWNLOAD = 'new_download'
     ALREADY_PRESENT = 'already_present'
@@ -19,9 +34,15 @@ class FileStatus(Enum):
 
 class FileDownloader:
     def __init__(self):
-        pass
-
-    def is_file_downloaded(self, filename, url, dest):
+        self.download_sources = {}  # filename -> url of the files handled by this downloader
+        self.expected_hashes = {}   # model key (see get_model_key) -> sha256 of the files that have one in their catalog entry
+        self.hash_cache = HashCache()
+        self.download_engine = DownloadEngine()
+        self.model_store = None  # ModelStore the downloads are deduplicated through (if any)
+        self.lock = threading.Lock()
+        self.path_locks = {}  # dest path -> lock, the same file is never downloaded twice at once
+
+    def is_file_downloaded(self, filename, url, dest, sha256=None):
         zip_file = False
         percentage_diff = lambda a,b : int(round(abs(a - b) / b, 2) * 100)
         if url.endswith(".zip") or url.endswith(".tar"):
@@ -30,7 +51,13 @@ class FileDownloader:
 
         dest_path = f"{dest}/{filename}"
         app_logger.log(LoggingType.DEBUG, "checking file: ", dest_path)
-        return os.path.exists(dest_path)
+        if not os.path.exists(dest_path):
+            return False
+        # archives are extracted after the download, so their hash can't be checked here
+        if sha256 and not zip_file and not self.hash_cache.is_valid(dest_path, sha256):
+            app_logger.log(LoggingType.WARNING, f"{filename} doesn't match its sha256, downloading it again")
+            return False
+        return True
         #     downloaded_file_size = os.path.getsize(dest_path)
         #     url_file_size = get_file_size(url)
         #     # NOTE: hackish sol of checking if zip file is downloaded or not (by checking if the extracted file is approximately the same size)
@@ -39,121 +66,171 @@ class FileDownloader:
         #         percentage_diff(downloaded_file_size, url_file_size) <= 2
         # return False
 
-    def download_file(self, filename, url, dest):
+    def download_file(self, filename, url, dest, sha256=None, show_progress=True):
+        # downloads running at the same time (DownloadScheduler) wait for the one writing the same file
+        with self.lock:
+            path_lock = self.path_locks.setdefault(os.path.abspath(f"{dest}/{filename}"), threading.Lock())
+        with path_lock:
+            return self._download_file(filename, url, dest, sha256, show_progress)
+
+    def _download_file(self, filename, url, dest, sha256, show_progress):
         os.makedirs(dest, exist_ok=True)
+        self.download_sources[filename] = url
+        if sha256:
+            self.expected_hashes[get_model_key(f"{dest}/{filename}")] = sha256
 
         # checking if the file is already downloaded
-        if self.is_file_downloaded(filename, url, dest):
+        if self.is_file_downloaded(filename, url, dest, sha256):
             app_logger.log(LoggingType.DEBUG, f"{filename} already present")
             return True, FileStatus.ALREADY_PRESENT.value
         else:
-            # deleting partial downloads
+            # downloads are only moved to dest once complete, a file here failed its sha256 check
             if os.path.exists(f"{dest}/{filename}"):
                 os.remove(f"{dest}/{filename}")
 
-        # download progress bar
+        archive = url.endswith(".zip") or url.endswith(".tar")
+        if self._materialize_from_store(filename, url, dest, None if archive else sha256):
+            return True, FileStatus.NEW_DOWNLOAD.value
+
         app_logger.log(LoggingType.INFO, f"Downloading {filename}")
-        response = requests.get(url, stream=True)
-        total_size = int(response.headers.get('content-length', 0))
-        progress_bar = tqdm(total=total_size, unit='B', unit_scale=True)
-        with open(f"{dest}/{filename}", "wb") as handle:
-            for data in tqdm(response.iter_content(chunk_size=1024)):
-                handle.write(data)
-                progress_bar.update(len(data))
-
-        # extract files if the downloaded file is a .zip or .tar
-        if url.endswith(".zip") or url.endswith(".tar"):
-            new_filename = filename + (".zip" if url.endswith(".zip") else ".tar")
-            os.rename(f"{dest}/{filename}", f"{dest}/{new_filename}")
-            if url.endswith(".zip"):
-                with zipfile.ZipFile(f"{dest}/{new_filename}", "r") as zip_ref:
-                    zip_ref.extractall(dest)
-            else:
-                with tarfile.open(f"{dest}/{new_filename}", "r") as tar_ref:
-                    tar_ref.extractall(dest)
-            os.remove(f"{dest}/{new_filename}")
-                    
+        if archive:
+            # extracted while downloading, the archive itself is never written to dest
+            extracted_files = self.download_engine.download_archive(url, dest, show_progress=show_progress)
+            # archives holding just the model (e.g. replicate weights) are stored by their url
+            if extracted_files == [os.path.abspath(f"{dest}/{filename}")]:
+                self._add_to_store(f"{dest}/{filename}", url)
+            return True, FileStatus.NEW_DOWNLOAD.value
+
+        # parallel ranged download (single stream if the server doesn't support ranges), interrupted
+        # downloads resume from their .part file
+        # hashed while it is written, the complete file isn't read again
+        _, file_hash = self.download_engine.download(
+            url, f"{dest}/{filename}", show_progress=show_progress, compute_sha256=True
+        )
+
+        if sha256 and file_hash.lower() != sha256.lower():
+            app_logger.log(LoggingType.ERROR, f"{filename} doesn't match its sha256, removing it")
+            os.remove(f"{dest}/{filename}")
+            return False, FileStatus.UNAVAILABLE.value
+
+        self.hash_cache.store(f"{dest}/{filename}", file_hash)
+        self._add_to_store(f"{dest}/{filename}", url, file_hash)
         return True, FileStatus.NEW_DOWNLOAD.value
 
+    def _materialize_from_store(self, filename, url, dest, sha256):
+        # the same file was already downloaded (under another name, folder or comfy install)
+        if self.model_store is None:
+            return False
+
+        stored_hash = self.model_store.find(url, sha256)
+        if not stored_hash:
+            return False
+        try:
+            self.model_store.materialize(stored_hash, f"{dest}/{filename}")
+        except OSError as e:
+            app_logger.log(LoggingType.WARNING, f"unable to link {filename} from the model store: {e}")
+            return False
+        app_logger.log(LoggingType.INFO, f"{filename} found in the model store")
+        return True
+
+    def _add_to_store(self, file_path, url, sha256=None):
+        if self.model_store is None:
+            return
+
+        try:
+            self.model_store.add(file_path, url, sha256)
+        except (OSError, sqlite3.Error) as e:
+            # the file is downloaded, it just isn't shared
+            app_logger.log(LoggingType.WARNING, f"unable to add {file_path} to the model store: {e}")
+
 
 class ModelDownloader(FileDownloader):
     def __init__(self, model_weights_file_path_list, download_similar_model=False):
         super().__init__()
-        self.model_download_dict = self.comfy_model_dict = {}
+        self.model_store = ModelStore(hash_cache=self.hash_cache)
+        # compiled on first use, entries are looked up one at a time
+        self.catalog = ModelCatalog(model_weights_file_path_list, COMFY_MODEL_PATH_LIST)
         self.download_similar_model = download_similar_model
+        # built on the first lookup of a missing model
+        self.local_name_index = self.comfy_name_index = None
         self.comfy_api = ComfyAPI(SERVER_ADDR, APP_PORT)
 
-        # loading local data
-        for model_weights_file_path in model_weights_file_path_list:
-            current_dir = find_git_root(os.path.dirname(__file__))      # finding root
-            file_path = os.path.abspath(os.path.join(current_dir, model_weights_file_path))
-            # print("------- opening file path: ", file_path)
-            with open(file_path, 'r', encoding="utf-8") as file:
-                data = json.load(file)
-                for model_name in data:
-                    # weight files with lower index have preference
-                    if model_name not in self.model_download_dict:
-                        self.model_download_dict[model_name] = {
-                            'url': data[model_name]['url'],
-                            'dest': convert_to_relative_path(data[model_name]['dest'])
-                        }
-
     def _get_similar_models(self, model_name):
         app_logger.log(LoggingType.DEBUG, "matching model: ", model_name)
         # matching with local data
-        model_list = self.model_download_dict.keys()
-        similar_models = fuzzy_text_match(model_list, model_name)
+        if self.local_name_index is None:
+            self.local_name_index = TrigramIndex(self.catalog.local_names())
+        similar_models = self.local_name_index.match(model_name)
 
         # matching with comfy data
-        model_list = self.comfy_model_dict.keys()
-        similar_models += fuzzy_text_match(model_list, model_name)
+        if self.comfy_name_index is None:
+            self.comfy_name_index = TrigramIndex(self.catalog.comfy_names())
+        similar_models += self.comfy_name_index.match(model_name)
 
         return similar_models
 
+    def get_model_url(self, filename):
+        if filename in self.download_sources:
+            return self.download_sources[filename]
+        comfy_models = self.catalog.get_comfy(filename)
+        if len(comfy_models):
+            return comfy_models[0]["url"]
+        local_model = self.catalog.get_local(filename)
+        return local_model["url"] if local_model else None
+
+    def get_model_hash(self, model_key):
+        """
+        model_key:  path relative to the models folder (see get_model_key)
+        returns the expected sha256 of the file, None if no catalog entry for this path has one
+        """
+        if model_key in self.expected_hashes:
+            return self.expected_hashes[model_key]
+        filename = os.path.basename(model_key)
+        for model in self.catalog.get_comfy(filename):
+            dest = os.path.join(COMFY_BASE_PATH, "models", get_save_path(model))
+            if model.get("sha256") and get_model_key(os.path.join(dest, filename)) == model_key:
+                return model["sha256"]
+        local_model = self.catalog.get_local(filename)
+        if local_model and local_model["sha256"] \
+                and get_model_key(os.path.join(local_model["dest"], filename)) == model_key:
+            return local_model["sha256"]
+        return None
+
     def load_comfy_models(self):
-        self.comfy_model_dict = {}
-        for model_list_path in COMFY_MODEL_PATH_LIST:
-            current_dir = find_git_root(os.path.dirname(__file__))      # finding root
-            model_list_path = os.path.abspath(os.path.join(current_dir, model_list_path))
-            if not os.path.exists(model_list_path):
-                app_logger.log(LoggingType.DEBUG, f"model list path not found - {model_list_path}")
-                continue
-
-            with open(model_list_path, 'rb') as file:
-                model_list = json.load(file)["models"]
-                
-            # loading comfy data
-            for model in model_list:
-                if model['filename'] not in self.comfy_model_dict:
-                    self.comfy_model_dict[model['filename']] = [model]
-                else:
-                    self.comfy_model_dict[model['filename']].append(model)
-
-    def download_model(self, model_name):
+        # the manager updates its model-list.json, the catalog is compiled again when it changes
+        if self.catalog.refresh():
+            self.local_name_index = self.comfy_name_index = None
+
+    def download_model(self, model_name, show_progress=True):
         # handling nomenclature like "SD1.5/pytorch_model.bin"
         base, model_name = (model_name.split("/")[0], model_name.split("/")[-1]) if "/" in model_name else ("", model_name)
         file_status = FileStatus.NEW_DOWNLOAD.value
         
-        if model_name in self.comfy_model_dict:
-            for model in self.comfy_model_dict[model_name]:
+        comfy_models = self.catalog.get_comfy(model_name)
+        local_model = self.catalog.get_local(model_name) if not len(comfy_models) else None
+        status = True
+        if len(comfy_models):
+            for model in comfy_models:
                 # if ((base and model['base'] == base) or not base or (base in ["SD1.5", "SD1.x"] and model["base"] in ["SD1.5", "SD1.x"])):
                 #     app_logger.log(LoggingType.INFO, f"Downloading {model['filename']}")
                 #     file_status = FileStatus.ALREADY_PRESENT.value if search_file(model['filename'], COMFY_BASE_PATH) else FileStatus.NEW_DOWNLOAD.value
                 #     self.comfy_api.install_custom_model(model)  # TODO: remove/streamline api dependency
-                if model["save_path"] and model["save_path"].endswith("default"):
-                    model["save_path"] = get_default_save_path(model["type"])
-                    
-                _, file_status = self.download_file(
+                downloaded, file_status = self.download_file(
                     filename=model['filename'],
                     url=model['url'],
-                    dest=os.path.join(COMFY_BASE_PATH, "models", model["save_path"])
+                    dest=os.path.join(COMFY_BASE_PATH, "models", get_save_path(model)),
+                    sha256=model.get('sha256'),
+                    show_progress=show_progress
                 )
+                status = status and downloaded
 
-        elif model_name in self.model_download_dict:
-            _, file_status = self.download_file(
+        elif local_model:
+            status, file_status = self.download_file(
                 filename=model_name,
-                url=self.model_download_dict[model_name]['url'],
-                dest=convert_to_relative_path(self.model_download_dict[model_name]['dest'])
+                url=local_model['url'],
+                dest=local_model['dest'],
+                sha256=local_model['sha256'],
+                show_progress=show_progress
             )
             
         else:
@@ -164,5 +241,5 @@ class ModelDownloader(FileDownloader):
             else:
                 return (False, similar_models, FileStatus.UNAVAILABLE.value)
             
-        return (True, [], file_status)
+        return (status, [], file_status)
     
\ No newline at end of file
@@ -0,0 +1,158 @@
+import os
+import re
+import shutil
+import subprocess
+import threading
+from urllib.parse import urlparse
+
+import git
+
+from ..constants import GIT_CACHE_PATH
+from .logger import LoggingType, app_logger
+
+# only branches and tags are mirrored, a '--mirror' refspec (+refs/*:refs/*) also pulls every
+# github pull request (refs/pull/*)
+MIRROR_REFSPECS = ["+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"]
+FULL_SHA_REGEX = re.compile(r"[0-9a-fA-F]{40}")
+
+
+class GitCache:
+    """
+    directory of bare mirrors shared by every clone on the machine. clones are made locally
+    from the mirror (hardlinked objects) so the network is only used to fetch the objects
+    the mirror is missing
+    """
+
+    _locks = {}
+    _locks_lock = threading.Lock()
+
+    def __init__(self, cache_path=GIT_CACHE_PATH, pinned_depth=1):
+        """
+        cache_path:     folder holding the mirrors
+        pinned_depth:   history depth of clones checked out at a pinned commit (None for the full history)
+        """
+        self.cache_path = cache_path
+        self.pinned_depth = pinned_depth
+
+    def mirror_path(self, url):
+        parsed = urlparse(url)
+        name = re.sub(r"[^A-Za-z0-9._-]", "_", (parsed.netloc + parsed.path).strip("/"))
+        if not name.endswith(".git"):
+            name += ".git"
+        return os.path.join(self.cache_path, name)
+
+    def _get_lock(self, mirror_path):
+        with self._locks_lock:
+            if mirror_path not in self._locks:
+                self._locks[mirror_path] = threading.Lock()
+            return self._locks[mirror_path]
+
+    def resolve_commit(self, mirror, commit_hash):
+        # full sha of a (short) hash or tag, None if the mirror doesn't have it
+        try:
+            return mirror.git.rev_parse("--verify", "--quiet", f"{commit_hash}^{{commit}}")
+        except git.GitCommandError:
+            return None
+
+    def has_commit(self, mirror, commit_hash):
+        return self.resolve_commit(mirror, commit_hash) is not None
+
+    def _set_refspecs(self, mirror):
+        try:
+            refspecs = mirror.git.config("--get-all", "remote.origin.fetch").splitlines()
+        except git.GitCommandError:
+            refspecs = []
+        if refspecs == MIRROR_REFSPECS:
+            return
+
+        if refspecs:
+            mirror.git.config("--unset-all", "remote.origin.fetch")
+        for refspec in MIRROR_REFSPECS:
+            mirror.git.config("--add", "remote.origin.fetch", refspec)
+
+        # refs fetched by the previous refspec (mirrors created with --mirror)
+        stale_refs = [
+            ref
+            for ref in mirror.git.for_each_ref("--format=%(refname)").splitlines()
+            if not ref.startswith(("refs/heads/", "refs/tags/"))
+        ]
+        if stale_refs:
+            app_logger.log(LoggingType.DEBUG, f"removing {len(stale_refs)} refs from {mirror.git_dir}")
+            subprocess.run(
+                ["git", "update-ref", "--stdin"],
+                cwd=mirror.git_dir,
+                input="".join(f"delete {ref}\n" for ref in stale_refs),
+                text=True,
+                check=True,
+            )
+
+    def _set_head(self, mirror):
+        # HEAD of the mirror follows the default branch of the remote, unpinned clones check it out
+        try:
+            for line in mirror.git.ls_remote("--symref", "origin", "HEAD").splitlines():
+                if line.startswith("ref: ") and line.endswith("\tHEAD"):
+                    mirror.git.symbolic_ref("HEAD", line[len("ref: "):].split("\t")[0])
+                    return
+        except git.GitCommandError as e:
+            app_logger.log(LoggingType.DEBUG, f"unable to read the default branch of {mirror.git_dir}: {e}")
+
+    def update_mirror(self, url, commit_hash=None, progress=None):
+        mirror_path = self.mirror_path(url)
+        with self._get_lock(mirror_path):
+            if not os.path.exists(mirror_path):
+                app_logger.log(LoggingType.DEBUG, f"creating git mirror for {url}")
+                os.makedirs(self.cache_path, exist_ok=True)
+                mirror = git.Repo.init(mirror_path, bare=True)
+                mirror.create_remote("origin", url)
+                self._set_refspecs(mirror)
+                # lets the clones fetch pinned commits that no branch points to
+                mirror.git.config("uploadpack.allowAnySHA1InWant", "true")
+                try:
+                    mirror.remote("origin").fetch(progress=progress)
+                    self._set_head(mirror)
+                except Exception:
+                    shutil.rmtree(mirror_path, ignore_errors=True)
+                    raise
+            else:
+                mirror = git.Repo(mirror_path)
+                self._set_refspecs(mirror)
+                if commit_hash is None or not self.has_commit(mirror, commit_hash):
+                    app_logger.log(LoggingType.DEBUG, f"updating git mirror for {url}")
+                    mirror.remote("origin").fetch(prune=True, progress=progress)
+
+            if commit_hash is not None and not self.has_commit(mirror, commit_hash):
+                # commits that are no longer on any branch (e.g. force pushed away) can only be
+                # fetched by their full sha, short hashes and tags have to be on a branch/tag
+                if not FULL_SHA_REGEX.fullmatch(commit_hash):
+                    raise ValueError(f"{commit_hash} not found in {url}")
+                mirror.git.fetch("origin", commit_hash)
+
+        return mirror_path
+
+    def clone(self, url, dest, commit_hash=None, recursive=True, progress=None):
+        mirror_path = self.update_mirror(url, commit_hash, progress)
+
+        dest_existed = os.path.exists(dest)
+        try:
+            if commit_hash is None:
+                repo = git.Repo.clone_from(mirror_path, dest)
+            else:
+                # short hashes and tags can't be fetched by name, resolved to the full sha first
+                full_hash = self.resolve_commit(git.Repo(mirror_path), commit_hash)
+                # only the objects of the pinned commit are copied over
+                repo = git.Repo.init(dest)
+                repo.create_remote("origin", "file://" + os.path.abspath(mirror_path))
+                fetch_args = ["--depth", str(self.pinned_depth)] if self.pinned_depth else []
+                repo.git.fetch(*fetch_args, "origin", full_hash)
+                repo.git.checkout(full_hash)
+
+            repo.remote("origin").set_url(url)
+            if recursive and os.path.exists(os.path.join(dest, ".gitmodules")):
+                repo.git.submodule("update", "--init", "--recursive")
+        except Exception:
+            # a half made clone would be taken for an installed node
+            if not dest_existed:
+                shutil.rmtree(dest, ignore_errors=True)
+            raise
+
+        return repo
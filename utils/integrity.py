@@ -0,0 +1,134 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from ..constants import MODEL_HASH_DB_PATH
+from .logger import LoggingType, app_logger
+
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def hash_file(file_path):
+    # large reads into a reused buffer, hashlib releases the gil while hashing them
+    sha256 = hashlib.sha256()
+    buffer = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(file_path, "rb", buffering=0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            sha256.update(view[:size])
+    return sha256.hexdigest()
+
+
+class HashCache:
+    """
+    sha256 of the model files cached in a sqlite sidecar, keyed by (inode, size, mtime)
+    so that a file is only hashed again when it changes
+    """
+
+    def __init__(self, db_path=MODEL_HASH_DB_PATH):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self._conn = None
+
+    def _get_conn(self):
+        # opened lazily, the folder might not exist before comfy is cloned
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS hashes ("
+                "path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime_ns INTEGER, sha256 TEXT)"
+            )
+        return self._conn
+
+    @staticmethod
+    def _file_key(file_path):
+        stat = os.stat(file_path)
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def get_cached(self, file_path):
+        file_path = os.path.abspath(file_path)
+        key = self._file_key(file_path)
+        with self.lock:
+            row = self._get_conn().execute(
+                "SELECT inode, size, mtime_ns, sha256 FROM hashes WHERE path = ?", (file_path,)
+            ).fetchone()
+        return row[3] if row and tuple(row[:3]) == key else None
+
+    def store(self, file_path, sha256, key=None):
+        file_path = os.path.abspath(file_path)
+        inode, size, mtime_ns = key or self._file_key(file_path)
+        with self.lock:
+            conn = self._get_conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)",
+                (file_path, inode, size, mtime_ns, sha256),
+            )
+            conn.commit()
+
+    def get_hash(self, file_path):
+        sha256 = self.get_cached(file_path)
+        if sha256 is None:
+            key = self._file_key(file_path)
+            sha256 = hash_file(file_path)
+            self.store(file_path, sha256, key)
+        return sha256
+
+    def is_valid(self, file_path, expected_sha256):
+        if not expected_sha256:
+            return True
+        return self.get_hash(file_path).lower() == expected_sha256.lower()
+
+    def verify_files(self, file_list, expected_hashes={}, max_workers=None):
+        """
+        file_list:          paths to verify
+        expected_hashes:    {file_path: sha256}, files without an entry are only hashed
+        the uncached files are hashed in a process pool. returns
+        {'valid': [path, ...], 'invalid': [path, ...], 'unknown': [path, ...]}
+        a file that can't be read (e.g. deleted meanwhile) is invalid if it has an expected hash,
+        unknown otherwise
+        """
+        hashes, to_hash = {}, []
+        for file_path in file_list:
+            try:
+                cached = self.get_cached(file_path)
+                if cached:
+                    hashes[file_path] = cached
+                else:
+                    to_hash.append((file_path, self._file_key(file_path)))
+            except OSError as e:
+                app_logger.log(LoggingType.WARNING, f"Unable to read {file_path} - {e}")
+
+        if to_hash:
+            app_logger.log(LoggingType.INFO, f"Hashing {len(to_hash)} model file(s)")
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                # one future per file, a failing file doesn't abort the others
+                futures = [
+                    (file_path, key, executor.submit(hash_file, file_path))
+                    for file_path, key in to_hash
+                ]
+                for file_path, key, future in futures:
+                    try:
+                        sha256 = future.result()
+                    except OSError as e:
+                        app_logger.log(LoggingType.WARNING, f"Unable to read {file_path} - {e}")
+                        continue
+                    self.store(file_path, sha256, key)
+                    hashes[file_path] = sha256
+
+        report = {"valid": [], "invalid": [], "unknown": []}
+        for file_path in file_list:
+            expected = expected_hashes.get(file_path)
+            if not expected:
+                report["unknown"].append(file_path)
+            elif file_path in hashes and hashes[file_path].lower() == expected.lower():
+                report["valid"].append(file_path)
+            else:
+                report["invalid"].append(file_path)
+
+        return report
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+from ..constants import MODEL_CATALOG_DIR
+from .common import convert_to_relative_path, find_git_root
+from .logger import LoggingType, app_logger
+
+CATALOG_VERSION = 1
+
+
+class ModelCatalog:
+    """
+    the model weight files (data/*.json) and the comfy model lists compiled into a single sqlite
+    file with the precedence already applied. lookups only read the rows they need (the file is
+    memory mapped) and the catalog is compiled again only when one of its sources changes
+    """
+
+    def __init__(self, local_source_list, comfy_source_list, catalog_dir=MODEL_CATALOG_DIR):
+        """
+        local_source_list:  {model_name: {'url', 'dest'}} json files, lower index has preference
+        comfy_source_list:  {'models': [...]} json files in the comfy manager format
+        paths are relative to the root of this repo
+        """
+        root_dir = find_git_root(os.path.dirname(__file__))
+        self.local_source_list = [os.path.abspath(os.path.join(root_dir, p)) for p in local_source_list]
+        self.comfy_source_list = [os.path.abspath(os.path.join(root_dir, p)) for p in comfy_source_list]
+        # one catalog per set of sources, checkouts sharing the cache dir don't overwrite each other
+        source_key = hashlib.sha256(
+            json.dumps([self.local_source_list, self.comfy_source_list]).encode("utf-8")
+        ).hexdigest()[:16]
+        self.catalog_path = os.path.join(catalog_dir, f"model_catalog_{source_key}.db")
+        # guards _conn, refresh replaces it while the download threads run lookups (reentrant as
+        # the first lookup opens the connection through refresh)
+        self.lock = threading.RLock()
+        self._conn = None
+
+    def _source_mtimes(self):
+        res = {}
+        for path in self.local_source_list + self.comfy_source_list:
+            try:
+                res[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                res[path] = None
+        return res
+
+    def _is_current(self, conn, source_mtimes):
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'sources'").fetchone()
+            version = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        except sqlite3.DatabaseError:
+            return False
+        return bool(row and version) and json.loads(row[0]) == source_mtimes \
+            and int(version[0]) == CATALOG_VERSION
+
+    def _compile(self, source_mtimes):
+        app_logger.log(LoggingType.DEBUG, f"compiling the model catalog {self.catalog_path}")
+        os.makedirs(os.path.dirname(self.catalog_path), exist_ok=True)
+        tmp_path = f"{self.catalog_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        conn = sqlite3.connect(tmp_path)
+        conn.executescript(
+            "CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);"
+            "CREATE TABLE local_models (name TEXT PRIMARY KEY, url TEXT, dest TEXT, sha256 TEXT);"
+            "CREATE TABLE comfy_models (name TEXT, position INTEGER, data TEXT);"
+        )
+
+        for file_path in self.local_source_list:
+            if not source_mtimes[file_path]:
+                app_logger.log(LoggingType.DEBUG, f"model weights file not found - {file_path}")
+                continue
+            with open(file_path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+            # weight files with lower index have preference
+            conn.executemany(
+                "INSERT OR IGNORE INTO local_models VALUES (?, ?, ?, ?)",
+                [
+                    (name, entry["url"], entry["dest"], entry.get("sha256"))
+                    for name, entry in data.items()
+                ],
+            )
+
+        position = 0
+        for file_path in self.comfy_source_list:
+            if not source_mtimes[file_path]:
+                app_logger.log(LoggingType.DEBUG, f"model list path not found - {file_path}")
+                continue
+            with open(file_path, "rb") as file:
+                model_list = json.load(file)["models"]
+            rows = []
+            for model in model_list:
+                rows.append((model["filename"], position, json.dumps(model)))
+                position += 1
+            conn.executemany("INSERT INTO comfy_models VALUES (?, ?, ?)", rows)
+
+        conn.execute("CREATE INDEX comfy_models_name ON comfy_models (name, position)")
+        conn.executemany(
+            "INSERT INTO meta VALUES (?, ?)",
+            [("sources", json.dumps(source_mtimes)), ("version", str(CATALOG_VERSION))],
+        )
+        conn.commit()
+        conn.close()
+        os.replace(tmp_path, self.catalog_path)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.catalog_path, check_same_thread=False)
+        conn.execute("PRAGMA mmap_size = 268435456")
+        return conn
+
+    def refresh(self):
+        # compiles the catalog again if a source changed, returns True if it did
+        source_mtimes = self._source_mtimes()
+        with self.lock:
+            if self._conn is not None and self._is_current(self._conn, source_mtimes):
+                return False
+
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+            rebuilt = False
+            if os.path.exists(self.catalog_path):
+                conn = self._connect()
+                if not self._is_current(conn, source_mtimes):
+                    conn.close()
+                    conn = None
+            else:
+                conn = None
+
+            if conn is None:
+                self._compile(source_mtimes)
+                conn = self._connect()
+                rebuilt = True
+
+            self._conn = conn
+            return rebuilt
+
+    def _get_conn(self):
+        # opened on the first lookup, the caller holds the lock
+        if self._conn is None:
+            self.refresh()
+        return self._conn
+
+    def _query(self, sql, args=()):
+        # the connection is taken under the lock, a concurrent refresh can't close it mid query
+        with self.lock:
+            return self._get_conn().execute(sql, args).fetchall()
+
+    def get_local(self, name):
+        # {'url', 'dest', 'sha256'} of a model in the weight files, None if not present
+        rows = self._query("SELECT url, dest, sha256 FROM local_models WHERE name = ?", (name,))
+        if not rows:
+            return None
+        url, dest, sha256 = rows[0]
+        return {"url": url, "dest": convert_to_relative_path(dest), "sha256": sha256}
+
+    def get_comfy(self, name):
+        # entries of a model in the comfy model lists (in list order)
+        rows = self._query(
+            "SELECT data FROM comfy_models WHERE name = ? ORDER BY position", (name,)
+        )
+        return [json.loads(row[0]) for row in rows]
+
+    def local_names(self):
+        return [row[0] for row in self._query("SELECT name FROM local_models ORDER BY rowid")]
+
+    def comfy_names(self):
+        # distinct names in order of first appearance
+        return [
+            row[0]
+            for row in self._query(
+                "SELECT name FROM comfy_models GROUP BY name ORDER BY MIN(position)"
+            )
+        ]
@@ -0,0 +1,146 @@
+import json
+import os
+import threading
+
+from ..constants import MODEL_FILETYPES
+from .logger import LoggingType, app_logger
+
+
+class ModelIndex:
+    """
+    filename -> paths index of the model folders. it is built with a single walk and kept up
+    to date by rescanning only the directories whose mtime changed (adding or removing a file
+    updates the mtime of its folder), optionally persisted so new processes start warm
+    """
+
+    IGNORED_DIRS = ["__pycache__", "node_modules"]
+
+    def __init__(self, root_list, persist_path=None):
+        self.root_list = root_list
+        self.persist_path = persist_path
+        self.lock = threading.Lock()
+        # dir -> {'mtime': ns, 'files': [filename, ...], 'dirs': [subdir path, ...]}
+        self.dirs = {}
+        self.files = {}  # filename -> [path, ...]
+        self.version = 0  # bumped every time a refresh finds added/removed model files
+        self._load()
+
+    # ----------- persistence ----------------
+    def _load(self):
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return
+
+        try:
+            with open(self.persist_path, "r") as f:
+                data = json.load(f)
+            if data.get("root_list") == self.root_list:
+                self.dirs = data["dirs"]
+                self._rebuild_files()
+        except (OSError, ValueError, KeyError) as e:
+            app_logger.log(LoggingType.DEBUG, f"unable to load the model index: {e}")
+            self.dirs = {}
+
+    def _save(self):
+        if not self.persist_path:
+            return
+
+        try:
+            tmp_path = self.persist_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"root_list": self.root_list, "dirs": self.dirs}, f)
+            os.replace(tmp_path, self.persist_path)
+        except OSError as e:
+            app_logger.log(LoggingType.DEBUG, f"unable to save the model index: {e}")
+
+    # ----------- scanning ----------------
+    def _rebuild_files(self):
+        # follows the walk order (parents before children) like os.walk does
+        self.files = {}
+        for root in self.root_list:
+            stack = [root]
+            while stack:
+                dir_path = stack.pop(0)
+                entry = self.dirs.get(dir_path)
+                if not entry:
+                    continue
+                for filename in entry["files"]:
+                    self.files.setdefault(filename, []).append(os.path.join(dir_path, filename))
+                stack = entry["dirs"] + stack
+
+    def _scan_dir(self, dir_path, mtime):
+        files, subdirs = [], []
+        try:
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        if not entry.name.startswith(".") and entry.name not in self.IGNORED_DIRS:
+                            subdirs.append(os.path.join(dir_path, entry.name))
+                    else:
+                        files.append(entry.name)
+        except OSError:
+            return
+
+        self.dirs[dir_path] = {"mtime": mtime, "files": sorted(files), "dirs": sorted(subdirs)}
+
+    def _drop_dir(self, dir_path):
+        entry = self.dirs.pop(dir_path, None)
+        if entry:
+            for subdir in entry["dirs"]:
+                self._drop_dir(subdir)
+
+    def _model_files(self):
+        return {
+            filename: path_list
+            for filename, path_list in self.files.items()
+            if any(filename.endswith(ft) for ft in MODEL_FILETYPES)
+        }
+
+    def refresh(self):
+        # stats every known dir and rescans the ones that changed
+        with self.lock:
+            changed = False
+            visited = set()  # real paths, guards against symlink loops
+            stack = [root for root in self.root_list]
+            while stack:
+                dir_path = stack.pop()
+                try:
+                    stat = os.stat(dir_path)
+                except OSError:
+                    if dir_path in self.dirs:
+                        self._drop_dir(dir_path)
+                        changed = True
+                    continue
+
+                real_path = os.path.realpath(dir_path)
+                if real_path in visited:
+                    continue
+                visited.add(real_path)
+
+                entry = self.dirs.get(dir_path)
+                if not entry or entry["mtime"] != stat.st_mtime_ns:
+                    old_subdirs = entry["dirs"] if entry else []
+                    self._scan_dir(dir_path, stat.st_mtime_ns)
+                    new_subdirs = self.dirs.get(dir_path, {"dirs": []})["dirs"]
+                    for subdir in old_subdirs:
+                        if subdir not in new_subdirs:
+                            self._drop_dir(subdir)
+                    changed = True
+
+                stack += self.dirs.get(dir_path, {"dirs": []})["dirs"]
+
+            if changed:
+                model_files = self._model_files()
+                self._rebuild_files()
+                if self._model_files() != model_files:
+                    self.version += 1
+                self._save()
+
+    # ----------- lookups ----------------
+    def find(self, filename):
+        return list(self.files.get(filename, []))
+
+    def contains(self, filename, parent_folder=None):
+        return any(
+            not parent_folder or os.path.basename(os.path.dirname(p)) == parent_folder
+            for p in self.files.get(filename, [])
+        )
@@ -0,0 +1,107 @@
+import os
+import shutil
+import sqlite3
+import threading
+
+from ..constants import MODEL_STORE_PATH
+from .integrity import HashCache
+from .logger import LoggingType, app_logger
+
+
+class ModelStore:
+    """
+    content addressed store of the model files, every file is kept once as
+    '<store_path>/<sha256[:2]>/<sha256>' and the model folders get hardlinks to it (symlinks when
+    the store is on another filesystem). the urls the files were downloaded from are recorded, so
+    a url already downloaded under another name, folder or comfy install isn't downloaded again
+    """
+
+    def __init__(self, store_path=MODEL_STORE_PATH, hash_cache=None):
+        """
+        store_path:     can be shared by several comfy installs on the same host
+        hash_cache:     HashCache used to hash the files added to the store
+        """
+        self.store_path = store_path
+        self.hash_cache = hash_cache or HashCache()
+        self.lock = threading.Lock()
+        self._conn = None
+
+    def _get_conn(self):
+        # opened lazily, nothing is created until a file is added
+        if self._conn is None:
+            os.makedirs(self.store_path, exist_ok=True)
+            self._conn = sqlite3.connect(
+                os.path.join(self.store_path, "urls.db"), check_same_thread=False
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, sha256 TEXT)")
+        return self._conn
+
+    def blob_path(self, sha256):
+        sha256 = sha256.lower()
+        return os.path.join(self.store_path, sha256[:2], sha256)
+
+    def has(self, sha256):
+        return bool(sha256) and os.path.isfile(self.blob_path(sha256))
+
+    def find(self, url=None, sha256=None):
+        # sha256 of the stored file with this hash or downloaded from this url, None if not stored
+        if sha256:
+            return sha256.lower() if self.has(sha256) else None
+        if not url or not os.path.exists(self.store_path):
+            return None
+
+        with self.lock:
+            row = self._get_conn().execute("SELECT sha256 FROM urls WHERE url = ?", (url,)).fetchone()
+        return row[0] if row and self.has(row[0]) else None
+
+    def add(self, file_path, url=None, sha256=None):
+        """
+        moves the content of file_path into the store (file_path is replaced by a link to it).
+        the blob is made read-only, when it is hardlinked file_path is the same inode so the model
+        file becomes read-only too. tools that rewrite models in place have to replace the file
+        (write a new one and rename it) instead, which leaves the store untouched
+        sha256:     hash of the file if already verified (e.g. computed while downloading), computed otherwise
+        returns the sha256 of the file
+        """
+        sha256 = (sha256 or self.hash_cache.get_hash(file_path)).lower()
+        blob_path = self.blob_path(sha256)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            try:
+                # same filesystem, the file becomes the blob without copying anything
+                os.link(file_path, blob_path)
+            except FileExistsError:
+                pass
+            except OSError:
+                tmp_path = f"{blob_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                shutil.copyfile(file_path, tmp_path)
+                os.replace(tmp_path, blob_path)
+            # the blobs are shared, they must not be modified in place
+            os.chmod(blob_path, 0o444)
+
+        if not os.path.samefile(file_path, blob_path):
+            # a duplicate (or a copy on another filesystem), only the blob is kept
+            self.materialize(sha256, file_path)
+
+        if url:
+            with self.lock:
+                conn = self._get_conn()
+                conn.execute("INSERT OR REPLACE INTO urls VALUES (?, ?)", (url, sha256))
+                conn.commit()
+        return sha256
+
+    def materialize(self, sha256, dest_path):
+        # links dest_path to the stored file, hardlink if possible and symlink otherwise
+        blob_path = self.blob_path(sha256)
+        os.makedirs(os.path.dirname(os.path.abspath(dest_path)), exist_ok=True)
+        tmp_path = f"{dest_path}.{os.getpid()}.{threading.get_ident()}.link"
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(blob_path, tmp_path)
+        except OSError as e:
+            app_logger.log(LoggingType.DEBUG, f"unable to hardlink {blob_path} ({e}), using a symlink")
+            os.symlink(os.path.abspath(blob_path), tmp_path)
+        os.replace(tmp_path, dest_path)
+        # the hash is known, is_file_downloaded won't read the file again
+        self.hash_cache.store(dest_path, sha256)
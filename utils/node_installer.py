@@ -2,14 +2,19 @@ import subprocess
 import sys
 import os
 import platform
-import urllib
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
-import zipfile
 
 import git
 from git import RemoteProgress
 from tqdm import tqdm
+from ..constants import NODE_INSTALL_WORKERS
 from .common import find_git_root
+from .download_engine import DownloadEngine
+from .git_cache import GitCache
+from .wheelhouse import Wheelhouse
 
 
 def get_node_installer():
@@ -38,6 +43,9 @@ class NodeInstaller:
             self.comfyui_manager_path, "startup-scripts"
         )
         self.download_url = file_downloader
+        self.download_engine = DownloadEngine()
+        self.git_cache = GitCache()
+        self.wheelhouse = Wheelhouse()
 
     # ----------- helper utils ----------------
     def _is_valid_url(self, url):
@@ -66,59 +74,222 @@ class NodeInstaller:
         else:
             return pkg
 
-    def _execute_install_script(self, url, repo_path):
-        install_script_path = os.path.join(repo_path, "install.py")
+    def _pip_install(self, args, cwd="."):
+        self.wheelhouse.install(args, cwd=cwd)
+
+    def _read_requirements(self, repo_path):
+        # returns (packages, mergeable). requirements with pip options or local paths only
+        # make sense relative to their own repo, so those aren't merged with the others
         requirements_path = os.path.join(repo_path, "requirements.txt")
+        if not os.path.exists(requirements_path):
+            return [], True
+
+        packages, mergeable = [], True
+        with open(requirements_path, "r") as requirements_file:
+            for line in requirements_file:
+                package_name = self._remap_pip_package(line.split(" #")[0].strip())
+                if not package_name or package_name.startswith("#"):
+                    continue
+                if package_name.startswith("-") or package_name.startswith("."):
+                    mergeable = False
+                packages.append(package_name)
+
+        return packages, mergeable
+
+    def _pip_install_requirements(self, packages):
+        with tempfile.NamedTemporaryFile(
+            "w", suffix="-requirements.txt", delete=False
+        ) as requirements_file:
+            requirements_file.write("\n".join(packages))
+        try:
+            self._pip_install(["-r", requirements_file.name])
+        finally:
+            os.remove(requirements_file.name)
+
+    def _install_requirements(self, nodes, results):
+        # a single resolver run for every node, falling back to per node installs
+        # when it fails so that the broken node can be reported
+        merged_packages = []
+        for node in nodes:
+            for pkg in node["packages"]:
+                if pkg not in merged_packages:
+                    merged_packages.append(pkg)
+        if not merged_packages:
+            return
+
+        print(f"Install: pip packages ({len(merged_packages)} requirements, {len(nodes)} nodes)")
+        try:
+            self._pip_install_requirements(merged_packages)
+            return
+        except Exception as e:
+            print(f"combined pip install failed, installing the nodes one by one")
+
+        for node in nodes:
+            if node["packages"]:
+                try:
+                    self._pip_install(node["packages"])
+                except Exception as e:
+                    results[node["url"]] = f"pip install failed: {e}"
+
+    def install_nodes(self, node_list, requirements=None, max_workers=NODE_INSTALL_WORKERS):
+        """
+        node_list:      [{'url': git_url, 'commit_hash': xyz (optional), 'pip': [pkg, ...] (optional)}, ...]
+        requirements:   pinned packages installed instead of the requirements of the repos (e.g. from a lock)
+        clones the repos in parallel, installs every python dependency with one pip call and
+        then runs the install.py scripts. returns {url: error} (error is None on success)
+        """
+        results = {}
+        to_clone = []
+        repo_nodes = {}  # repo_path -> entry installing it
+        duplicates = {}  # url -> url of the entry installing the same repo
+        for node in node_list:
+            url = node["url"][:-1] if node["url"].endswith("/") else node["url"]
+            repo_path = os.path.join(
+                self.custom_nodes_path, os.path.splitext(os.path.basename(url))[0]
+            )
+            # manager entries sharing a repo would be cloned into the same folder at the same time
+            if repo_path in repo_nodes:
+                installed_by = repo_nodes[repo_path]
+                if url != installed_by["url"]:
+                    duplicates[url] = installed_by["url"]
+                if installed_by.get("commit_hash", None) is None and node.get("commit_hash", None):
+                    installed_by["commit_hash"] = node["commit_hash"]
+                continue
+            repo_nodes[repo_path] = {**node, "url": url, "repo_path": repo_path}
+
+        for repo_path, node in repo_nodes.items():
+            state = self._get_checkout_state(repo_path, node.get("commit_hash", None))
+            if state == "installed":
+                print(f"Already installed: {node['url']}")
+                results[node["url"]] = None
+            else:
+                to_clone.append({**node, "state": state})
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            cloned = list(
+                executor.map(
+                    lambda n: self._checkout_pin(n["repo_path"], n["url"], n["commit_hash"])
+                    if n["state"] == "outdated"
+                    else self._gitclone(
+                        self.custom_nodes_path,
+                        n["url"],
+                        n.get("commit_hash", None),
+                        show_progress=False,
+                    ),
+                    to_clone,
+                )
+            )
+
+        merged_nodes = []
+        for node, status in zip(to_clone, cloned):
+            if not status:
+                results[node["url"]] = "git checkout failed" if node["state"] == "outdated" else "git clone failed"
+                continue
+
+            results[node["url"]] = None
+            if requirements is not None:
+                merged_nodes.append({**node, "packages": []})
+                continue
+
+            packages, mergeable = self._read_requirements(node["repo_path"])
+            pip_packages = [self._remap_pip_package(p) for p in node.get("pip", [])]
+            if mergeable:
+                merged_nodes.append({**node, "packages": packages + pip_packages})
+            else:
+                merged_nodes.append({**node, "packages": pip_packages})
+                try:
+                    self._pip_install(["-r", "requirements.txt"], cwd=node["repo_path"])
+                except Exception as e:
+                    results[node["url"]] = f"pip install failed: {e}"
 
-        if os.path.exists(requirements_path):
-            print("Install: pip packages")
-            with open(requirements_path, "r") as requirements_file:
-                for line in requirements_file:
-                    package_name = self._remap_pip_package(line.strip())
-                    if package_name and not package_name.startswith("#"):
-                        install_cmd = [
-                            sys.executable,
-                            "-m",
-                            "pip",
-                            "install",
-                            package_name,
-                        ]
-                        if package_name.strip() != "" and not package_name.startswith(
-                            "#"
-                        ):
-                            try:
-                                self._run_script(install_cmd, cwd=repo_path)
-                            except Exception as e:
-                                print(f"error installing {url} ")
-                                return False
-
-        if os.path.exists(install_script_path):
-            print(f"Install: install script")
-            install_cmd = [sys.executable, "install.py"]
+        if requirements is None:
+            self._install_requirements(merged_nodes, results)
+        elif len(requirements):
+            print(f"Install: pip packages ({len(requirements)} pinned requirements)")
             try:
-                self._run_script(install_cmd, cwd=repo_path)
+                self._pip_install_requirements(requirements)
             except Exception as e:
-                print(f"error installing {url} ")
-                return False
+                for node in merged_nodes:
+                    results[node["url"]] = f"pip install failed: {e}"
 
-        return True
+        for node in merged_nodes:
+            install_script_path = os.path.join(node["repo_path"], "install.py")
+            if results[node["url"]] is None and os.path.exists(install_script_path):
+                print(f"Install: install script ({node['url']})")
+                try:
+                    self._run_script([sys.executable, "install.py"], cwd=node["repo_path"])
+                except Exception as e:
+                    results[node["url"]] = f"install.py failed: {e}"
+
+        for url, installed_by in duplicates.items():
+            results[url] = results[installed_by]
+
+        for url, error in results.items():
+            if error:
+                print(f"error installing {url}: {error}")
+
+        return results
+
+    def _get_checkout_state(self, repo_path, commit_hash=None):
+        """
+        returns 'missing' (to be cloned), 'outdated' (checked out at another commit than the pin)
+        or 'installed'. broken clones (HEAD doesn't resolve) are removed and reported as missing
+        """
+        if not os.path.exists(repo_path):
+            return "missing"
+        if not os.path.exists(os.path.join(repo_path, ".git")):
+            # installed some other way (copy/unzip), nothing to check
+            return "installed"
+
+        try:
+            repo = git.Repo(repo_path)
+            head = repo.head.commit.hexsha
+        except Exception:
+            print(f"removing broken clone {repo_path}")
+            shutil.rmtree(repo_path, ignore_errors=True)
+            return "missing"
+
+        if commit_hash is None:
+            return "installed"
+        try:
+            pinned = repo.git.rev_parse(f"{commit_hash}^{{commit}}")
+        except git.GitCommandError:
+            return "outdated"  # the pinned commit isn't fetched yet
+        return "installed" if pinned == head else "outdated"
+
+    def _checkout_pin(self, repo_path, url, commit_hash):
+        # moves an existing clone to its pinned commit, fetched through the mirror
+        try:
+            print(f"CHECKOUT: {os.path.basename(repo_path)} [{commit_hash}]")
+            mirror_path = self.git_cache.update_mirror(url, commit_hash)
+            full_hash = git.Repo(mirror_path).git.rev_parse(f"{commit_hash}^{{commit}}")
+            repo = git.Repo(repo_path)
+            repo.git.fetch("file://" + os.path.abspath(mirror_path), full_hash)
+            repo.git.checkout(full_hash)
+            if os.path.exists(os.path.join(repo_path, ".gitmodules")):
+                repo.git.submodule("update", "--init", "--recursive")
+            repo.git.clear_cache()
+            repo.close()
+            return True
+        except Exception as e:
+            print(f"checkout of {url} at {commit_hash} failed: {e}")
+            return False
 
-    def _gitclone(self, custom_nodes_path, url, target_hash=None):
+    def _gitclone(self, custom_nodes_path, url, target_hash=None, show_progress=True):
         repo_name = os.path.splitext(os.path.basename(url))[0]
         repo_path = os.path.join(custom_nodes_path, repo_name)
 
         try:
-            repo = git.Repo.clone_from(
+            if target_hash is not None:
+                print(f"CHECKOUT: {repo_name} [{target_hash}]")
+            repo = self.git_cache.clone(
                 url,
                 repo_path,
+                target_hash,
                 recursive=True,
-                progress=GitProgress(),
+                progress=GitProgress() if show_progress else None,
             )
 
-            if target_hash is not None:
-                print(f"CHECKOUT: {repo_name} [{target_hash}]")
-                repo.git.checkout(target_hash)
-
             repo.git.clear_cache()
             repo.close()
             return True
@@ -126,8 +297,7 @@ class NodeInstaller:
             return False
 
     def _unzip_install(self, files):
-        # simply downloads the url and extracts it
-        temp_filename = "manager-temp.zip"
+        # simply downloads the url and extracts it (members are checked to stay in custom_nodes)
         for url in files:
             if url.endswith("/"):
                 url = url[:-1]
@@ -136,17 +306,9 @@ class NodeInstaller:
                     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
                 }
 
-                req = urllib.request.Request(url, headers=headers)
-                response = urllib.request.urlopen(req)
-                data = response.read()
-
-                with open(temp_filename, "wb") as f:
-                    f.write(data)
-
-                with zipfile.ZipFile(temp_filename, "r") as zip_ref:
-                    zip_ref.extractall(self.custom_nodes_path)
-
-                os.remove(temp_filename)
+                self.download_engine.download_archive(
+                    url, self.custom_nodes_path, headers=headers, archive_format="zip"
+                )
             except Exception as e:
                 print(f"Install(unzip) error: {url} / {e}")
                 return False
@@ -178,35 +340,30 @@ class NodeInstaller:
         print("Installation was successful.")
         return True
 
-    def _gitclone_install(self, files, commit_hash_list=[]):
+    def _gitclone_install(self, files, commit_hash_list=[], pip_list=[]):
         print(f"Install: {files}")
+        node_list = []
         for idx, url in enumerate(files):
             if not self._is_valid_url(url):
                 print(f"Invalid git url: '{url}'")
                 return False
 
-            if url.endswith("/"):
-                url = url[:-1]
-            try:
-                print(f"Download: git clone '{url}'")
-                repo_name = os.path.splitext(os.path.basename(url))[0]
-                repo_path = os.path.join(self.custom_nodes_path, repo_name)
-
-                # Clone the repository from the remote URL
-                res = self._gitclone(
-                    self.custom_nodes_path,
-                    url,
-                    commit_hash_list[idx] if idx < len(commit_hash_list) else None,
-                )
-                if not res:
-                    return False
+            node_list.append(
+                {
+                    "url": url,
+                    "commit_hash": commit_hash_list[idx] if idx < len(commit_hash_list) else None,
+                    "pip": pip_list,
+                }
+            )
 
-                if not self._execute_install_script(url, repo_path):
-                    return False
+        try:
+            results = self.install_nodes(node_list)
+        except Exception as e:
+            print(f"Install(git-clone) error: {files} / {e}", file=sys.stderr)
+            return False
 
-            except Exception as e:
-                print(f"Install(git-clone) error: {url} / {e}", file=sys.stderr)
-                return False
+        if any(results.values()):
+            return False
 
         print("Installation was successful.")
         return True
@@ -222,17 +379,17 @@ class NodeInstaller:
             res = self._copy_install(json_data["files"], js_path_name)
 
         elif install_type == "git-clone":
+            # the pip entries are resolved together with the requirements of the repos
             res = self._gitclone_install(
-                json_data["files"], json_data.get("commit_hash", [])
+                json_data["files"], json_data.get("commit_hash", []), json_data.get("pip", [])
             )
 
         # installing the dependencies
-        if "pip" in json_data:
+        if "pip" in json_data and install_type != "git-clone":
             for pname in json_data["pip"]:
                 pkg = self._remap_pip_package(pname)
-                install_cmd = [sys.executable, "-m", "pip", "install", pkg]
                 try:
-                    self._run_script(install_cmd, cwd=".")
+                    self._pip_install([pkg])
                 except Exception as e:
                     print(f"error installing {json_data['files'][0]} ")
 
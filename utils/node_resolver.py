@@ -0,0 +1,147 @@
+import json
+import os
+import re
+import threading
+
+from .logger import LoggingType, app_logger
+from .workflow_validator import get_fingerprint_path
+
+
+class NodeResolver:
+    """
+    finds the custom node repos providing the class_types of a workflow. the manager tables and
+    the registered nodes are fetched once and cached until invalidate is called (node installs
+    and server restarts), class_types already resolved are answered from a dict
+    """
+
+    def __init__(self, comfy_api, snapshot_path=None, fingerprint=None):
+        """
+        snapshot_path:  where /object_info is saved for offline validation (WorkflowValidator)
+        fingerprint:    returns what the server's /object_info depends on (comfy commit, custom
+                        nodes loaded), saved with the snapshot. None if unknown
+        """
+        self.comfy_api = comfy_api
+        self.snapshot_path = snapshot_path
+        self.fingerprint = fingerprint
+        self.lock = threading.Lock()
+        self.tables = None
+        self.registered_nodes = None
+
+    def invalidate(self, registered_only=False):
+        """
+        registered_only:    only the registered nodes changed (e.g. server restart), the manager
+                            tables are kept
+        """
+        with self.lock:
+            self.registered_nodes = None
+            if not registered_only:
+                self.tables = None
+
+    def _build_tables(self):
+        mappings = self.comfy_api.get_node_mapping_list()
+        custom_node_list = self.comfy_api.get_all_custom_node_list()["custom_nodes"]
+
+        name_to_url = {name: url for url, names in mappings.items() for name in names[0]}
+
+        regex_to_url = []
+        for item in custom_node_list:
+            if item.get("nodename_pattern"):
+                regex_to_url.append((re.compile(item["nodename_pattern"]), item["files"][0]))
+
+        # a single alternation rejects the class_types matching no pattern in one pass
+        combined_regex = None
+        if len(regex_to_url):
+            try:
+                combined_regex = re.compile(
+                    "|".join(f"(?:{regex.pattern})" for regex, _ in regex_to_url)
+                )
+            except re.error as e:
+                app_logger.log(LoggingType.DEBUG, f"unable to combine node patterns: {e}")
+
+        url_to_nodes = {}
+        for idx, node in enumerate(custom_node_list):
+            for file in node.get("files", []):
+                url_to_nodes.setdefault(file, []).append(idx)
+
+        return {
+            "custom_node_list": custom_node_list,
+            "name_to_url": name_to_url,
+            "regex_to_url": regex_to_url,
+            "combined_regex": combined_regex,
+            "url_to_nodes": url_to_nodes,
+            "resolved": {},  # class_type -> set of urls
+        }
+
+    def _get_tables(self):
+        with self.lock:
+            if self.tables is None:
+                self.tables = self._build_tables()
+            if self.registered_nodes is None:
+                object_info = self.comfy_api.get_registered_nodes()
+                self._save_snapshot(object_info)
+                self.registered_nodes = set(object_info.keys())
+            return self.tables, self.registered_nodes
+
+    def _save_snapshot(self, object_info):
+        if not self.snapshot_path:
+            return
+
+        fingerprint_path = get_fingerprint_path(self.snapshot_path)
+        try:
+            # an unknown fingerprint never matches, the snapshot isn't trusted to reject workflows
+            if os.path.exists(fingerprint_path):
+                os.remove(fingerprint_path)
+            tmp_path = f"{self.snapshot_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(object_info, f)
+            os.replace(tmp_path, self.snapshot_path)
+
+            fingerprint = self.fingerprint() if self.fingerprint else None
+            if fingerprint is not None:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(fingerprint, f)
+                os.replace(tmp_path, fingerprint_path)
+        except OSError as e:
+            app_logger.log(LoggingType.DEBUG, f"unable to save the object_info snapshot: {e}")
+
+    def get_registered_nodes(self):
+        # fetched again after invalidate (which also updates the snapshot)
+        _, registered_nodes = self._get_tables()
+        return registered_nodes
+
+    def get_custom_node_list(self):
+        tables, _ = self._get_tables()
+        return tables["custom_node_list"]
+
+    def _resolve_class_type(self, tables, node_type):
+        resolved = tables["resolved"]
+        if node_type in resolved:
+            return resolved[node_type]
+
+        urls = set()
+        url = tables["name_to_url"].get(node_type.strip(), "")
+        if url:
+            urls.add(url)
+        elif tables["combined_regex"] is None or tables["combined_regex"].search(node_type):
+            for regex, url in tables["regex_to_url"]:
+                if regex.search(node_type):
+                    urls.add(url)
+
+        resolved[node_type] = urls
+        return urls
+
+    def find_missing_nodes(self, class_types):
+        # manager entries of the custom nodes that provide the unregistered class_types
+        tables, registered_nodes = self._get_tables()
+
+        missing_urls = set()
+        for node_type in class_types:
+            if node_type.startswith("workflow/") or node_type in registered_nodes:
+                continue
+            missing_urls |= self._resolve_class_type(tables, node_type)
+
+        node_idx_list = set()
+        for url in missing_urls:
+            node_idx_list.update(tables["url_to_nodes"].get(url, []))
+
+        return [tables["custom_node_list"][idx] for idx in sorted(node_idx_list)]
@@ -0,0 +1,69 @@
+from enum import Enum
+import os
+
+from .logger import LoggingType, app_logger
+
+
+class RestartAction(Enum):
+    NONE = 'none'
+    REFRESH_MODELS = 'refresh_models'
+    RESTART = 'restart'
+
+
+class RestartPolicy:
+    """
+    decides if the comfy server needs a restart after the setup of a workflow. comfy only
+    loads custom node code on boot, new model files are picked up by rescanning the model
+    folders so they don't need a restart
+    """
+
+    def __init__(self, custom_nodes_path):
+        self.custom_nodes_path = custom_nodes_path
+
+    def _python_signature(self, path):
+        # mtime of the code comfy imports for this entry, None if it has no python code
+        if os.path.isfile(path):
+            return os.path.getmtime(path) if path.endswith(".py") else None
+
+        init_file = os.path.join(path, "__init__.py")
+        if os.path.exists(init_file):
+            return os.path.getmtime(init_file)
+
+        return None
+
+    def snapshot(self):
+        # {entry_name: signature} of every custom node that comfy would import
+        if not os.path.exists(self.custom_nodes_path):
+            return {}
+
+        res = {}
+        for entry in os.listdir(self.custom_nodes_path):
+            if entry.startswith(".") or entry == "__pycache__" or entry.endswith(".disabled"):
+                continue
+
+            signature = self._python_signature(os.path.join(self.custom_nodes_path, entry))
+            if signature is not None:
+                res[entry] = signature
+
+        return res
+
+    def decide(self, before, after, models_downloaded):
+        added = sorted(set(after) - set(before))
+        updated = sorted(n for n in set(after) & set(before) if after[n] != before[n])
+
+        if added or updated:
+            reason = "custom node code changed"
+            if added:
+                reason += f", added: {', '.join(added)}"
+            if updated:
+                reason += f", updated: {', '.join(updated)}"
+            action = RestartAction.RESTART
+        elif models_downloaded:
+            reason = "new models downloaded, no node code changed"
+            action = RestartAction.REFRESH_MODELS
+        else:
+            reason = "no new nodes or models"
+            action = RestartAction.NONE
+
+        app_logger.log(LoggingType.INFO, f"Restart policy: {action.value} ({reason})")
+        return action, reason
@@ -0,0 +1,249 @@
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import psutil
+import requests
+
+from ..constants import (
+    COMFY_BASE_PATH,
+    DEBUG_LOG_ENABLED,
+    SERVER_PROBE_INITIAL_DELAY,
+    SERVER_PROBE_MAX_DELAY,
+    SERVER_QUEUE_POLL_INTERVAL,
+    SERVER_STARTUP_TIMEOUT,
+)
+from .common import find_process_by_port
+from .logger import LoggingType, app_logger
+
+
+class ServerStartError(Exception):
+    pass
+
+
+def get_active_port_path(base_port):
+    return os.path.join(COMFY_BASE_PATH, f"comfy_runner_{base_port}.active")
+
+
+def read_active_port(base_port):
+    # port the server of base_port was swapped to (blue/green restarts), None if unknown
+    try:
+        with open(get_active_port_path(base_port), "r") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def write_active_port(base_port, port):
+    path = get_active_port_path(base_port)
+    try:
+        if port is None or port == base_port:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(port))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        app_logger.log(LoggingType.DEBUG, f"unable to write {path}: {e}")
+
+
+class ServerSupervisor:
+    """
+    owns the comfy server process. liveness is checked through the Popen handle (or the
+    pidfile written on start when the handle belongs to another runner) instead of
+    scanning every process on the host, and readiness is confirmed with a cheap http probe
+    """
+
+    def __init__(
+        self, server_addr, port, main_script="./ComfyUI/main.py", server_args=[], pidfile=None
+    ):
+        self.server_addr = server_addr
+        self.port = port
+        self.main_script = main_script
+        self.server_args = list(server_args)
+        self.pidfile = pidfile or os.path.join(
+            COMFY_BASE_PATH, f"comfy_runner_{port}.pid"
+        )
+        self.process = None
+        self._launch_time = None
+        self.startup_history = []  # [{'port': 4333, 'time_to_ready': 12.3, 'started_at': ts}, ...]
+
+    @property
+    def url(self):
+        return f"{self.server_addr}:{self.port}"
+
+    @property
+    def last_time_to_ready(self):
+        return self.startup_history[-1]["time_to_ready"] if self.startup_history else None
+
+    # ----------- pidfile helpers ----------------
+    def _write_pidfile(self, pid):
+        try:
+            create_time = psutil.Process(pid).create_time()
+            with open(self.pidfile, "w") as f:
+                f.write(f"{pid} {create_time}")
+        except (OSError, psutil.Error) as e:
+            app_logger.log(LoggingType.DEBUG, f"unable to write pidfile {self.pidfile}: {e}")
+
+    def _read_pidfile(self):
+        # returns the pid only if the process that wrote the file is still the one alive
+        # (create_time guards against the os reusing the pid)
+        try:
+            with open(self.pidfile, "r") as f:
+                pid, create_time = f.read().split()
+            pid, create_time = int(pid), float(create_time)
+            proc = psutil.Process(pid)
+            if proc.create_time() == create_time and proc.status() != psutil.STATUS_ZOMBIE:
+                return pid
+        except (OSError, ValueError, psutil.Error):
+            pass
+
+        return None
+
+    def _remove_pidfile(self):
+        if os.path.exists(self.pidfile):
+            os.remove(self.pidfile)
+
+    # ----------- status ----------------
+    def get_pid(self):
+        if self.process is not None and self.process.poll() is None:
+            return self.process.pid
+
+        return self._read_pidfile()
+
+    def is_alive(self):
+        return self.get_pid() is not None
+
+    def probe(self, timeout=1):
+        try:
+            res = requests.get(self.url + "/queue", timeout=timeout)
+            return res.status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
+    def is_running(self):
+        # an unknown process (e.g. started manually) can still be serving on the port
+        return self.is_alive() or self.probe()
+
+    def wait_until_ready(self, timeout=SERVER_STARTUP_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        delay = SERVER_PROBE_INITIAL_DELAY
+        while True:
+            if self.probe():
+                return True
+
+            if self.process is not None and self.process.poll() is not None:
+                raise ServerStartError(
+                    f"comfy server exited with code {self.process.returncode} before becoming ready"
+                )
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, SERVER_PROBE_MAX_DELAY)
+
+    def get_queued_prompt_ids(self, timeout=5):
+        # queue items are [number, prompt_id, prompt, extra_data, outputs_to_execute]
+        res = requests.get(self.url + "/queue", timeout=timeout).json()
+        return [
+            item[1] for item in res.get("queue_running", []) + res.get("queue_pending", [])
+        ]
+
+    def drain(self, timeout):
+        """
+        polls the queue till every running and pending prompt is done or the timeout is hit.
+        returns {'finished': [prompt_id, ...], 'killed': [prompt_id, ...]}, where killed are
+        the prompts still queued at the deadline (they are lost once the server is stopped)
+        """
+        deadline = time.monotonic() + timeout
+        seen, queued = [], []
+        while True:
+            try:
+                queued = self.get_queued_prompt_ids()
+            except (requests.exceptions.RequestException, ValueError):
+                # server is gone, whatever was queued last didn't finish
+                break
+
+            seen += [prompt_id for prompt_id in queued if prompt_id not in seen]
+            if not queued or time.monotonic() >= deadline:
+                break
+
+            time.sleep(SERVER_QUEUE_POLL_INTERVAL)
+
+        return {
+            "finished": [prompt_id for prompt_id in seen if prompt_id not in queued],
+            "killed": [prompt_id for prompt_id in seen if prompt_id in queued],
+        }
+
+    # ----------- lifecycle ----------------
+    def launch(self):
+        # spawns the server without waiting for it, pair with wait_for_start
+        kwargs = {
+            "shell": platform.system() == "Windows",
+        }
+        # TODO: remove comfyUI output from the console
+        if not DEBUG_LOG_ENABLED:
+            kwargs["stdout"] = subprocess.DEVNULL
+            kwargs["stderr"] = subprocess.DEVNULL
+
+        self._launch_time = time.monotonic()
+        self.process = subprocess.Popen(
+            [sys.executable, self.main_script, "--port", str(self.port)] + self.server_args,
+            **kwargs,
+        )
+        self._write_pidfile(self.process.pid)
+
+    def wait_for_start(self, timeout=SERVER_STARTUP_TIMEOUT):
+        if not self.wait_until_ready(timeout):
+            self.stop()
+            raise ServerStartError(
+                f"comfy server not ready on port {self.port} after {timeout}s"
+            )
+
+        time_to_ready = round(time.monotonic() - self._launch_time, 3)
+        self.startup_history.append(
+            {"port": self.port, "time_to_ready": time_to_ready, "started_at": time.time()}
+        )
+        app_logger.log(
+            LoggingType.INFO, f"comfy server ready on port {self.port} in {time_to_ready}s"
+        )
+        return time_to_ready
+
+    def start(self, timeout=SERVER_STARTUP_TIMEOUT):
+        self.launch()
+        return self.wait_for_start(timeout)
+
+    def stop(self, timeout=30):
+        if self.process is not None and self.process.poll() is None:
+            proc = self.process
+        else:
+            # slow path: the server was not started by this supervisor, the port scan
+            # is only needed when something is actually serving on it
+            pid = self._read_pidfile() or (
+                find_process_by_port(self.port) if self.probe() else None
+            )
+            try:
+                proc = psutil.Process(pid) if pid else None
+            except psutil.NoSuchProcess:
+                proc = None
+
+        if proc is not None:
+            try:
+                proc.terminate()
+                try:
+                    proc.wait(timeout)
+                except (subprocess.TimeoutExpired, psutil.TimeoutExpired):
+                    app_logger.log(LoggingType.WARNING, "comfy server did not terminate, killing it")
+                    proc.kill()
+                    proc.wait()
+            except psutil.NoSuchProcess:
+                pass
+
+        self.process = None
+        self._remove_pidfile()
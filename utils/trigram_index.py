@@ -0,0 +1,63 @@
+from collections import defaultdict
+import heapq
+import os
+
+from fuzzywuzzy import utils
+
+from .common import fuzzy_text_match
+
+
+def get_trigrams(text):
+    # of the name without its extension, the common '.safetensors'/'.ckpt' trigrams rank nothing
+    text = f"  {os.path.splitext(text)[0].lower()} "
+    return set(text[i : i + 3] for i in range(len(text) - 2))
+
+
+def is_length_comparable(length, query_length):
+    # fuzzy_text_match only keeps scores > 90, which WRatio can't give to strings whose
+    # (processed) lengths differ by 1.5x or more
+    return 0 < length and 0 < query_length and max(length, query_length) / min(length, query_length) < 1.5
+
+
+class TrigramIndex:
+    """
+    character trigram -> names inverted index. only the names sharing the most trigrams with
+    the query are scored with fuzzy_text_match instead of the whole list. when the cut at
+    max_candidates falls between names sharing as many trigrams (e.g. short queries), the
+    whole list is scanned so the results stay the same as a linear scan
+    """
+
+    def __init__(self, name_list, max_candidates=64):
+        self.name_list = list(name_list)
+        self.max_candidates = max_candidates
+        self.postings = defaultdict(list)  # trigram -> [name idx, ...]
+        self.lengths = []  # processed length of every name (as scored by fuzzy_text_match)
+        for idx, name in enumerate(self.name_list):
+            self.lengths.append(len(utils.full_process(name)))
+            for trigram in get_trigrams(name):
+                self.postings[trigram].append(idx)
+
+    def candidates(self, query):
+        query_length = len(utils.full_process(query))
+        shared = defaultdict(int)
+        for trigram in get_trigrams(query):
+            for idx in self.postings.get(trigram, []):
+                if is_length_comparable(self.lengths[idx], query_length):
+                    shared[idx] += 1
+
+        comparable = [
+            idx for idx, length in enumerate(self.lengths) if is_length_comparable(length, query_length)
+        ]
+        top = heapq.nlargest(self.max_candidates + 1, shared.items(), key=lambda item: item[1])
+        # the names sharing no trigram count as 0
+        scores = [count for _, count in top] + [0] * (self.max_candidates + 1 - len(top))
+        if len(comparable) <= self.max_candidates or scores[self.max_candidates - 1] == scores[self.max_candidates]:
+            idx_list = comparable
+        else:
+            idx_list = sorted(idx for idx, _ in top[: self.max_candidates])
+        # kept in the list order so that ties are scored like a full scan would
+        return [self.name_list[idx] for idx in idx_list]
+
+    def match(self, query, limit=2):
+        candidate_list = self.candidates(query)
+        return fuzzy_text_match(candidate_list, query, limit) if len(candidate_list) else []
@@ -0,0 +1,102 @@
+import os
+import subprocess
+import sys
+
+from ..constants import WHEELHOUSE_OFFLINE, WHEELHOUSE_PATH
+from .logger import LoggingType, app_logger
+
+
+class WheelhouseError(Exception):
+    pass
+
+
+class Wheelhouse:
+    """
+    local folder of wheels for comfy and the custom node dependencies. when it is present the
+    installs don't go to pypi (--no-index --find-links), the folder can be shared by every
+    worker of the fleet (e.g. on a network volume)
+    """
+
+    def __init__(self, path=WHEELHOUSE_PATH, offline=WHEELHOUSE_OFFLINE):
+        """
+        offline:    never install from the index, a missing wheel (or wheelhouse) raises a WheelhouseError
+        """
+        self.path = path
+        self.offline = offline
+
+    def is_available(self):
+        return bool(self.path) and os.path.isdir(self.path) and len(os.listdir(self.path)) > 0
+
+    def pip_args(self):
+        return ["--no-index", "--find-links", self.path] if self.is_available() else []
+
+    def install(self, args, cwd=".", quiet=False):
+        # tries the wheelhouse first and falls back to the index if some wheels are missing (unless offline)
+        kwargs = {"cwd": cwd}
+        if quiet:
+            kwargs["stdout"] = subprocess.DEVNULL
+            kwargs["stderr"] = subprocess.DEVNULL
+
+        install_cmd = [sys.executable, "-m", "pip", "install"]
+        if self.offline:
+            self._install_offline(install_cmd + args, cwd, quiet)
+            return
+
+        if self.is_available():
+            try:
+                subprocess.check_call(install_cmd + self.pip_args() + args, **kwargs)
+                return
+            except subprocess.CalledProcessError:
+                app_logger.log(
+                    LoggingType.WARNING, "Wheelhouse is missing packages, installing from the index"
+                )
+
+        subprocess.check_call(install_cmd + args, **kwargs)
+
+    def _install_offline(self, cmd, cwd, quiet):
+        if not self.is_available():
+            raise WheelhouseError(f"Offline install of {cmd[4:]} but the wheelhouse {self.path} is empty or missing")
+
+        # pip's error (which wheel is missing) is kept for the exception
+        res = subprocess.run(
+            cmd[:4] + self.pip_args() + cmd[4:],
+            cwd=cwd,
+            stdout=subprocess.DEVNULL if quiet else None,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        if res.returncode != 0:
+            if not quiet:
+                sys.stderr.write(res.stderr)
+            error = res.stderr.strip().splitlines()[-1] if res.stderr.strip() else f"exit code {res.returncode}"
+            raise WheelhouseError(f"Offline install from {self.path} failed: {error}")
+
+    def build(self, requirement_files=[], packages=[]):
+        """
+        requirement_files:  requirements.txt files whose packages (and dependencies) are collected
+        packages:           extra requirement specifiers e.g. ['opencv-python==4.9.0.80']
+        """
+        os.makedirs(self.path, exist_ok=True)
+        wheel_cmd = [sys.executable, "-m", "pip", "wheel", "--wheel-dir", self.path]
+        # already collected wheels are reused instead of being downloaded again
+        wheel_cmd += ["--find-links", self.path]
+        for requirement_file in requirement_files:
+            wheel_cmd += ["-r", requirement_file]
+        wheel_cmd += list(packages)
+
+        app_logger.log(
+            LoggingType.INFO,
+            f"Building wheelhouse at {self.path} ({len(requirement_files)} requirement files, {len(packages)} packages)",
+        )
+        subprocess.check_call(wheel_cmd)
+
+    def build_for_comfy(self, comfy_path, packages=[]):
+        # comfy's requirements plus the requirements of every installed custom node
+        requirement_files = [os.path.join(comfy_path, "requirements.txt")]
+        custom_nodes_path = os.path.join(comfy_path, "custom_nodes")
+        for entry in sorted(os.listdir(custom_nodes_path)):
+            requirements_path = os.path.join(custom_nodes_path, entry, "requirements.txt")
+            if os.path.exists(requirements_path):
+                requirement_files.append(requirements_path)
+
+        self.build([f for f in requirement_files if os.path.exists(f)], packages)
@@ -0,0 +1,87 @@
+import os
+
+from ..constants import MODEL_FILETYPES, OPTIONAL_MODELS
+
+# every model filetype is a single extension, so one set lookup replaces the endswith scans
+MODEL_FILETYPE_SET = frozenset(MODEL_FILETYPES)
+OPTIONAL_MODEL_SUFFIXES = tuple(OPTIONAL_MODELS)
+
+
+def is_model_input(value):
+    if not isinstance(value, str):
+        return False
+    dot = value.rfind(".")
+    return (
+        dot != -1
+        and value[dot:] in MODEL_FILETYPE_SET
+        and not value.endswith(OPTIONAL_MODEL_SUFFIXES)
+    )
+
+
+def is_link(value):
+    # links are [source node id, output index]
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str)
+
+
+class ModelRef:
+    def __init__(self, node_id, input_name, value):
+        """
+        value:      model input as written in the workflow e.g. 'SD1.5/animatediff/v3_sd15_adapter.ckpt'
+        base:       folder part of the value ('' if there is none)
+        filename:   name of the model file
+        """
+        self.node_id = node_id
+        self.input_name = input_name
+        self.value = value
+        self.base, self.filename = os.path.split(value)
+
+
+class WorkflowIR:
+    """
+    everything the setup stages need from a workflow, built in a single pass over its nodes:
+    the class_types, the links in both directions and the model inputs
+    """
+
+    def __init__(self, workflow):
+        self.workflow = workflow
+        self.class_types = {}  # node_id -> class_type
+        self.parents = {}  # node_id -> {input_name: (source node id, output index)}
+        self.children = {}  # node_id -> [node_id, ...] using its outputs
+        self.model_refs = []  # [ModelRef, ...] in workflow order
+        # class_types, links and model inputs per node (what the setup of the workflow depends on)
+        self.structure = {}
+
+        for node_id, node in workflow.items():
+            class_type = node.get("class_type", "")
+            self.class_types[node_id] = class_type
+            links, structure_inputs = {}, {}
+            for input_name, value in node.get("inputs", {}).items():
+                if is_link(value):
+                    links[input_name] = (value[0], value[1])
+                    self.children.setdefault(value[0], []).append(node_id)
+                    structure_inputs[input_name] = value
+                elif is_model_input(value):
+                    self.model_refs.append(ModelRef(node_id, input_name, value))
+                    structure_inputs[input_name] = value
+            self.parents[node_id] = links
+            self.structure[node_id] = [class_type, structure_inputs]
+
+    def get_class_types(self):
+        return set(self.class_types.values())
+
+    def get_ancestors(self, node_ids):
+        # the given nodes and every node they depend on
+        stack = [str(node_id) for node_id in node_ids]
+        res = set()
+        while stack:
+            node_id = stack.pop()
+            if node_id in res or node_id not in self.parents:
+                continue
+            res.add(node_id)
+            stack += [source_id for source_id, _ in self.parents[node_id].values()]
+        return res
+
+
+def get_workflow_ir(workflow):
+    # accepts an already built ir so the stages can be called with either
+    return workflow if isinstance(workflow, WorkflowIR) else WorkflowIR(workflow)
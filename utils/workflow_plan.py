@@ -0,0 +1,90 @@
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+
+from ..constants import WORKFLOW_PLAN_CACHE_SIZE
+from .logger import LoggingType, app_logger
+from .workflow_ir import get_workflow_ir
+
+
+def workflow_structure_hash(workflow, extra=None):
+    """
+    hash of what the setup of a workflow depends on: the class_types, the links and the
+    model inputs. scalars (prompts, seeds, etc..) are ignored so every variation of a graph
+    shares the same hash. extra is any other json-able setup input (extra models, node urls..)
+    workflow:   workflow dict or its WorkflowIR
+    """
+    structure = get_workflow_ir(workflow).structure
+    data = json.dumps([structure, extra], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def prune_workflow(workflow, output_node_ids):
+    """
+    returns the subgraph the given output nodes depend on (the nodes reachable going backwards
+    along the links), the other branches of the graph are not executed
+    workflow:   workflow dict or its WorkflowIR
+    """
+    ir = get_workflow_ir(workflow)
+    kept = ir.get_ancestors(output_node_ids)
+    return {node_id: node for node_id, node in ir.workflow.items() if node_id in kept}
+
+
+class WorkflowPlan:
+    def __init__(self, model_rewrites, node_snapshot, model_index_version):
+        """
+        model_rewrites:         [(node_id, input key, model path), ...] applied to the workflow
+        node_snapshot:          custom nodes installed when the plan was made (RestartPolicy.snapshot)
+        model_index_version:    ModelIndex.version when the plan was made
+        """
+        self.model_rewrites = model_rewrites
+        self.node_snapshot = node_snapshot
+        self.model_index_version = model_index_version
+
+    def apply(self, workflow):
+        # copy on write, the nodes of the given workflow are left untouched
+        workflow = dict(workflow)
+        for node_id, key, model_path in self.model_rewrites:
+            node = dict(workflow[node_id])
+            node["inputs"] = dict(node["inputs"])
+            node["inputs"][key] = model_path
+            workflow[node_id] = node
+        return workflow
+
+
+class WorkflowPlanCache:
+    """
+    setup results of the workflows already provisioned, keyed by workflow_structure_hash.
+    a plan is dropped as soon as the installed custom nodes or the model files change
+    """
+
+    def __init__(self, max_size=WORKFLOW_PLAN_CACHE_SIZE):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.plans = OrderedDict()
+
+    def get(self, key, node_snapshot, model_index_version):
+        with self.lock:
+            plan = self.plans.get(key)
+            if not plan:
+                return None
+
+            if plan.node_snapshot != node_snapshot or plan.model_index_version != model_index_version:
+                app_logger.log(LoggingType.DEBUG, "nodes or models changed, workflow plan invalidated")
+                del self.plans[key]
+                return None
+
+            self.plans.move_to_end(key)
+            return plan
+
+    def put(self, key, plan):
+        with self.lock:
+            self.plans[key] = plan
+            self.plans.move_to_end(key)
+            while len(self.plans) > self.max_size:
+                self.plans.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.plans.clear()
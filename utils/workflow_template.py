@@ -0,0 +1,60 @@
+from .workflow_ir import is_link, is_model_input
+
+
+class WorkflowTemplate:
+    """
+    parsed workflow with named parameters bound to node inputs. every run gets a copy-on-write
+    view of the template, only the nodes whose inputs change are copied
+    """
+
+    def __init__(self, name, workflow, parameters={}, plan_key=None, ir=None):
+        """
+        workflow:       parsed API json
+        parameters:     {name: 'node_id.inputs.input_name'} e.g. {'seed': '3.inputs.seed'}
+        plan_key:       workflow_structure_hash of the workflow and its setup args
+        ir:             WorkflowIR of the workflow, valid for every run that keeps the plan_key
+        """
+        self.name = name
+        self.workflow = workflow
+        self.plan_key = plan_key
+        self.ir = ir
+        self.bindings = {}  # name -> (node_id, input_name)
+        for param, target in parameters.items():
+            parts = str(target).split(".", 2)
+            if len(parts) != 3 or parts[1] != "inputs":
+                raise ValueError(f"Invalid binding {param} -> {target}, expected 'node_id.inputs.input_name'")
+
+            node_id, _, input_name = parts
+            if node_id not in workflow:
+                raise ValueError(f"Invalid binding {param}: node {node_id} not found in {name}")
+            if input_name not in workflow[node_id].get("inputs", {}):
+                raise ValueError(f"Invalid binding {param}: node {node_id} has no input {input_name}")
+            self.bindings[param] = (node_id, input_name)
+
+    def bind(self, **values):
+        """
+        returns (workflow, plan_key) with the values applied. plan_key is None when a value
+        changes the structure of the graph (links or model inputs) and the key has to be recomputed
+        """
+        workflow = dict(self.workflow)
+        copied = set()
+        structure_changed = False
+        for param, value in values.items():
+            if param not in self.bindings:
+                raise ValueError(f"Unknown parameter {param} for workflow {self.name}")
+
+            node_id, input_name = self.bindings[param]
+            if node_id not in copied:
+                node = dict(workflow[node_id])
+                node["inputs"] = dict(node["inputs"])
+                workflow[node_id] = node
+                copied.add(node_id)
+
+            old_value = self.workflow[node_id]["inputs"][input_name]
+            if value != old_value and any(
+                f(v) for f in (is_link, is_model_input) for v in (value, old_value)
+            ):
+                structure_changed = True
+            workflow[node_id]["inputs"][input_name] = value
+
+        return workflow, None if structure_changed else self.plan_key
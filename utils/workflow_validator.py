@@ -0,0 +1,242 @@
+from enum import Enum
+import json
+import os
+import threading
+
+from .logger import LoggingType, app_logger
+from .workflow_ir import is_link, is_model_input
+
+
+class ValidationErrorType(Enum):
+    UNKNOWN_CLASS_TYPE = "unknown_class_type"
+    MISSING_MODEL = "missing_model"
+    MISSING_FILE = "missing_file"
+    INVALID_NODE = "invalid_node"
+    MISSING_REQUIRED_INPUT = "missing_required_input"
+    INVALID_LINK = "invalid_link"
+    TYPE_MISMATCH = "type_mismatch"
+    INVALID_TYPE = "invalid_type"
+    OUT_OF_RANGE = "out_of_range"
+    INVALID_CHOICE = "invalid_choice"
+
+
+# errors that the setup can fix by installing the missing nodes, models and input files
+PROVISIONABLE_ERRORS = [
+    ValidationErrorType.UNKNOWN_CLASS_TYPE.value,
+    ValidationErrorType.MISSING_MODEL.value,
+    ValidationErrorType.MISSING_FILE.value,
+]
+
+SCALAR_CONVERTERS = {
+    "INT": int,
+    "FLOAT": float,
+    "STRING": str,
+    "BOOLEAN": bool,
+}
+
+
+def get_fingerprint_path(snapshot_path):
+    # the comfy commit and custom nodes the snapshot was taken with
+    return f"{snapshot_path}.fingerprint.json"
+
+
+class WorkflowValidator:
+    """
+    checks a workflow against a snapshot of the server's /object_info (class_types, required
+    inputs, value types, enum choices and links) without the server running. the snapshot is
+    saved by the NodeResolver every time it fetches /object_info
+    """
+
+    def __init__(self, snapshot_path):
+        self.snapshot_path = snapshot_path
+        self.lock = threading.Lock()
+        self.object_info = None
+        self.snapshot_mtime = None
+
+    def has_snapshot(self):
+        return os.path.exists(self.snapshot_path)
+
+    def is_current(self, fingerprint):
+        # True if the snapshot was taken with this fingerprint (see NodeResolver), an older snapshot
+        # can reject inputs that the current comfy commit or custom nodes accept
+        try:
+            with open(get_fingerprint_path(self.snapshot_path), "r", encoding="utf-8") as f:
+                return fingerprint is not None and json.load(f) == json.loads(json.dumps(fingerprint))
+        except (OSError, ValueError):
+            return False
+
+    def _get_object_info(self):
+        # parsed once and reloaded when the snapshot is updated
+        try:
+            mtime = os.stat(self.snapshot_path).st_mtime_ns
+        except OSError:
+            return None
+
+        with self.lock:
+            if self.object_info is None or mtime != self.snapshot_mtime:
+                try:
+                    with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                        self.object_info = json.load(f)
+                    self.snapshot_mtime = mtime
+                except (OSError, ValueError) as e:
+                    app_logger.log(LoggingType.DEBUG, f"unable to load the object_info snapshot: {e}")
+                    return None
+            return self.object_info
+
+    @staticmethod
+    def _error(error_type, node_id, class_type, message, input_name=None):
+        return {
+            "type": error_type.value,
+            "node_id": node_id,
+            "class_type": class_type,
+            "input": input_name,
+            "message": message,
+        }
+
+    @staticmethod
+    def _input_specs(class_info):
+        # {input_name: (spec, required)}
+        res = {}
+        inputs = class_info.get("input", {})
+        for section, required in (("required", True), ("optional", False)):
+            for name, spec in (inputs.get(section) or {}).items():
+                res[name] = (spec, required)
+        return res
+
+    def _validate_link(self, workflow, object_info, node_id, class_type, name, value, input_type):
+        source_id, output_idx = value
+        if source_id not in workflow or not isinstance(output_idx, int):
+            return self._error(
+                ValidationErrorType.INVALID_LINK, node_id, class_type,
+                f"link to missing node {source_id}", name,
+            )
+
+        source_class = workflow[source_id].get("class_type")
+        if source_class not in object_info:
+            return None  # checked once the node is installed
+
+        output_types = object_info[source_class].get("output", [])
+        if output_idx < 0 or output_idx >= len(output_types):
+            return self._error(
+                ValidationErrorType.INVALID_LINK, node_id, class_type,
+                f"{source_class} (node {source_id}) has no output {output_idx}", name,
+            )
+
+        output_type = output_types[output_idx]
+        if (
+            isinstance(input_type, str)
+            and isinstance(output_type, str)
+            and "*" not in (input_type, output_type)
+            and input_type != "COMBO"
+            and not set(output_type.split(",")) & set(input_type.split(","))
+        ):
+            return self._error(
+                ValidationErrorType.TYPE_MISMATCH, node_id, class_type,
+                f"expected {input_type}, {source_class} (node {source_id}) outputs {output_type}", name,
+            )
+        return None
+
+    def _validate_value(self, node_id, class_type, name, value, spec):
+        input_type = spec[0] if isinstance(spec, (list, tuple)) and len(spec) else spec
+        options = spec[1] if isinstance(spec, (list, tuple)) and len(spec) > 1 else {}
+        options = options if isinstance(options, dict) else {}
+
+        choices = input_type if isinstance(input_type, list) else None
+        if input_type == "COMBO":
+            choices = options.get("options")
+
+        if choices is not None:
+            if value in choices:
+                return None
+            if is_model_input(value):
+                return self._error(
+                    ValidationErrorType.MISSING_MODEL, node_id, class_type,
+                    f"model {value} not found on the server", name,
+                )
+            if isinstance(value, str) and os.path.splitext(value)[1]:
+                # input files (images, videos..) are copied in during the setup
+                return self._error(
+                    ValidationErrorType.MISSING_FILE, node_id, class_type,
+                    f"file {value} not found on the server", name,
+                )
+            return self._error(
+                ValidationErrorType.INVALID_CHOICE, node_id, class_type,
+                f"{value} is not one of {choices[:10]}{'...' if len(choices) > 10 else ''}", name,
+            )
+
+        if input_type not in SCALAR_CONVERTERS:
+            return None  # link only types (MODEL, IMAGE..) are reported as missing inputs
+
+        # comfy converts the values before validating them, e.g. "5" is a valid INT
+        try:
+            value = SCALAR_CONVERTERS[input_type](value)
+        except (TypeError, ValueError):
+            return self._error(
+                ValidationErrorType.INVALID_TYPE, node_id, class_type,
+                f"expected {input_type}, got {type(value).__name__}", name,
+            )
+
+        if input_type in ("INT", "FLOAT"):
+            if ("min" in options and value < options["min"]) or ("max" in options and value > options["max"]):
+                return self._error(
+                    ValidationErrorType.OUT_OF_RANGE, node_id, class_type,
+                    f"{value} is outside [{options.get('min')}, {options.get('max')}]", name,
+                )
+        return None
+
+    def validate(self, workflow):
+        """
+        returns a list of errors {'type', 'node_id', 'class_type', 'input', 'message'},
+        empty if the workflow is valid (or if there is no snapshot yet)
+        """
+        object_info = self._get_object_info()
+        if object_info is None:
+            return []
+
+        errors = []
+        for node_id, node in workflow.items():
+            if not isinstance(node, dict) or not isinstance(node.get("inputs", {}), dict):
+                errors.append(self._error(ValidationErrorType.INVALID_NODE, node_id, None, "malformed node"))
+                continue
+
+            class_type = node.get("class_type")
+            if class_type not in object_info:
+                errors.append(
+                    self._error(
+                        ValidationErrorType.UNKNOWN_CLASS_TYPE, node_id, class_type,
+                        f"{class_type} is not registered on the server",
+                    )
+                )
+                continue
+
+            inputs = node.get("inputs", {})
+            for name, (spec, required) in self._input_specs(object_info[class_type]).items():
+                if name not in inputs:
+                    if required:
+                        errors.append(
+                            self._error(
+                                ValidationErrorType.MISSING_REQUIRED_INPUT, node_id, class_type,
+                                f"required input {name} is missing", name,
+                            )
+                        )
+                    continue
+
+                value = inputs[name]
+                input_type = spec[0] if isinstance(spec, (list, tuple)) and len(spec) else spec
+                if isinstance(value, list):
+                    if is_link(value):
+                        error = self._validate_link(
+                            workflow, object_info, node_id, class_type, name, value, input_type
+                        )
+                    else:
+                        error = self._error(
+                            ValidationErrorType.INVALID_LINK, node_id, class_type,
+                            "links are [node_id, output_index]", name,
+                        )
+                else:
+                    error = self._validate_value(node_id, class_type, name, value, spec)
+
+                if error:
+                    errors.append(error)
+
+        return errors
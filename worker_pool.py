@@ -0,0 +1,134 @@
+import os
+import threading
+
+from .constants import COMFY_BASE_PATH, WORKER_POOL_PORT_RANGE
+from .inf import ComfyRunner
+from .utils.logger import LoggingType, app_logger
+
+
+class ComfyWorker:
+    def __init__(self, port, server_args=[], provision_lock=None, runner_class=ComfyRunner):
+        # every instance shares the models and custom nodes of the ComfyUI install but
+        # gets its own input/output/temp folders so that runs don't clear each other's files
+        self.port = port
+        self.worker_dir = os.path.join(COMFY_BASE_PATH, "workers", str(port))
+        input_dir = os.path.join(self.worker_dir, "input")
+        output_dir = os.path.join(self.worker_dir, "output")
+        temp_dir = os.path.join(self.worker_dir, "temp")
+
+        self.runner = runner_class(
+            port=port,
+            input_dir=input_dir,
+            output_dir=output_dir,
+            server_args=[
+                "--input-directory",
+                input_dir,
+                "--output-directory",
+                output_dir,
+                "--temp-directory",
+                temp_dir,
+            ]
+            + list(server_args),
+            provision_lock=provision_lock,
+        )
+        self.inflight = 0  # predict calls routed here that haven't returned yet
+
+    def make_dirs(self):
+        for folder in ["input", "output", "temp"]:
+            os.makedirs(os.path.join(self.worker_dir, folder), exist_ok=True)
+
+    def get_queue_depth(self):
+        # None means the instance is not healthy
+        if not self.runner.server_supervisor.is_alive():
+            return None
+
+        try:
+            queue = self.runner.comfy_api.get_queue()
+            return len(queue.get("queue_running", [])) + len(queue.get("queue_pending", []))
+        except Exception as e:
+            app_logger.log(LoggingType.DEBUG, f"worker {self.port} unreachable: {e}")
+            return None
+
+
+class ComfyWorkerPool:
+    """
+    runs several ComfyUI instances on a port range, all sharing the same install (and thus
+    the same models directory). predict calls are routed to the least loaded healthy instance
+    """
+
+    def __init__(
+        self,
+        num_workers=None,
+        port_range=WORKER_POOL_PORT_RANGE,
+        server_args=[],
+        runner_class=ComfyRunner,
+    ):
+        """
+        num_workers:    number of instances, defaults to one per port in the range
+        port_range:     (start, end) ports, end excluded
+        server_args:    extra cli args passed to every instance (e.g. ['--cpu'])
+        runner_class:   runner used for each instance (e.g. ComfyRunnerServerless)
+        """
+        ports = list(range(*port_range))
+        num_workers = num_workers or len(ports)
+        if num_workers > len(ports):
+            raise ValueError(
+                f"{num_workers} workers requested but port range {port_range} only has {len(ports)} ports"
+            )
+
+        # node/model installs touch the shared ComfyUI folder so only one worker does it at a time
+        self.provision_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.workers = [
+            ComfyWorker(port, server_args, self.provision_lock, runner_class)
+            for port in ports[:num_workers]
+        ]
+
+    def start(self):
+        # launching everything before waiting so that the instances boot in parallel
+        for worker in self.workers:
+            worker.make_dirs()
+            if not worker.runner.is_server_running():
+                worker.runner.server_supervisor.launch()
+
+        for worker in self.workers:
+            supervisor = worker.runner.server_supervisor
+            if supervisor.process is not None:
+                supervisor.wait_for_start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.runner.stop_server()
+
+    def get_worker(self):
+        # least loaded healthy worker, the local inflight count covers the calls that are
+        # still provisioning and haven't reached the comfy queue yet
+        queue_depths = [(worker, worker.get_queue_depth()) for worker in self.workers]
+        with self.lock:
+            best_worker, best_load = None, None
+            for worker, depth in queue_depths:
+                if depth is None:
+                    continue
+                load = max(depth, worker.inflight)
+                if best_load is None or load < best_load:
+                    best_worker, best_load = worker, load
+
+            # no healthy instance, predict will start the server of the idlest one
+            if best_worker is None:
+                best_worker = min(self.workers, key=lambda w: w.inflight)
+
+            best_worker.inflight += 1
+            return best_worker
+
+    def predict(self, workflow_input, **kwargs):
+        """
+        same params as ComfyRunner.predict
+        """
+        worker = self.get_worker()
+        app_logger.log(LoggingType.DEBUG, f"running workflow on worker {worker.port}")
+        try:
+            worker.make_dirs()
+            return worker.runner.predict(workflow_input, **kwargs)
+        finally:
+            with self.lock:
+                worker.inflight -= 1